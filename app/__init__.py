@@ -2,7 +2,13 @@ from flask import Flask
 from os import getenv
 from dotenv import load_dotenv
 from .chat.views import chat_blueprint
+from .commands import register_commands
+from .utils.db import close_connection
+from .utils import instrumentation
+from .utils import helpers
+from .utils import uploads
 from flask_wtf.csrf import CSRFProtect
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 
 def create_app():
@@ -10,6 +16,8 @@ def create_app():
 
     app = Flask(__name__)
     app.secret_key = getenv("SECRET_KEY")
+    # Oversized uploads are refused before they are read, leaving room for the other form fields.
+    app.config["MAX_CONTENT_LENGTH"] = uploads.max_upload_bytes() + 1024 * 1024
     if getenv("ENV", "") == "PROD":
         CSRFProtect(app)
 
@@ -20,6 +28,15 @@ def create_app():
             SESSION_COOKIE_SAMESITE="Strict",
         )
 
+    # Behind reverse proxies the client address, which rate limits are counted by, comes from X-Forwarded-For.
+    trusted_proxies = int(getenv("TRUSTED_PROXIES", "0"))
+    if trusted_proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxies, x_proto=trusted_proxies)
+
     app.register_blueprint(chat_blueprint)
+    app.teardown_appcontext(close_connection)
+    app.add_template_filter(helpers.iso_time)
+    instrumentation.init_app(app)
+    register_commands(app)
 
     return app
@@ -1,14 +1,19 @@
-from pathlib import Path
-import uuid
-import os
-from flask import request, render_template, redirect, session, Blueprint, url_for, flash
+from flask import request, render_template, redirect, session, Blueprint, url_for, flash, Response, jsonify
 from flask_wtf.csrf import generate_csrf
 from ..utils import helpers
+from ..utils.db import Database
+from ..utils import live
+from ..utils import delta
+from ..utils import conditional
+from ..utils import fragments
+from ..utils import attachments
+from ..utils import passwords
+from ..utils import uploads
 from ..models.area import Area
 from ..models.thread import Thread
 from ..models.user import User
 from ..models.message import Message
-from ..utils.decorators import login_required, captcha_required
+from ..utils.decorators import login_required, api_login_required, captcha_required, rate_limited
 
 
 # Blueprint setup for chat functionality, enabling modularization and URL prefixing.
@@ -19,7 +24,20 @@ chat_blueprint = Blueprint('chat', __name__, url_prefix='/', static_folder='../s
 @login_required
 def index():
     user_id = session["user_id"]
-    return render_template("index.html", areas=helpers.get_areas(user_id), is_admin=helpers.is_admin(), turnstile_sitekey=helpers.get_turnstile_sitekey(), csrf_token=generate_csrf(), notifications=helpers.get_notifications(user_id))
+
+    # Answer with 304 before loading the areas if the browser has the current version of the page.
+    etag = conditional.page_etag(conditional.index_version(user_id))
+    if conditional.is_not_modified(etag):
+        return conditional.not_modified(etag)
+
+    return conditional.with_etag(render_template(
+        "index.html",
+        area_list=fragments.area_list(helpers.get_areas(user_id)),
+        is_admin=helpers.is_admin(),
+        turnstile_sitekey=helpers.get_turnstile_sitekey(),
+        csrf_token=generate_csrf(),
+        unread_notifications=helpers.count_unread_notifications(user_id)
+    ), etag)
 
 
 @chat_blueprint.route("/create_area", methods=['POST'])
@@ -30,7 +48,13 @@ def create_area():
     if not helpers.is_valid_area_topic(request.form["topic"]):
         user_id = session["user_id"]
         flash("Invalid area topic", "error")
-        return render_template("index.html", areas=helpers.get_areas(user_id), turnstile_sitekey=helpers.get_turnstile_sitekey(), csrf_token=generate_csrf(), notifications=helpers.get_notifications(user_id))
+        return render_template(
+            "index.html",
+            area_list=fragments.area_list(helpers.get_areas(user_id)),
+            turnstile_sitekey=helpers.get_turnstile_sitekey(),
+            csrf_token=generate_csrf(),
+            unread_notifications=helpers.count_unread_notifications(user_id)
+        )
 
     is_secret = helpers.is_admin() and request.form.get("is_secret", "") == "on"
 
@@ -48,17 +72,35 @@ def create_area():
 @captcha_required
 def view_area(area_id):
     user_id = session["user_id"]
+
+    # Answer with 304 before loading the threads if the browser has the current version of the page.
+    etag = conditional.page_etag(conditional.area_version(area_id, user_id))
+    if conditional.is_not_modified(etag):
+        return conditional.not_modified(etag)
+
     area = Area.create_from_db(area_id, user_id)
 
     if not area:
         flash("Area does not exist", "error")
         return redirect(url_for("chat.index"))
 
+    # Render a single page of threads, most recently active first, unless it is cached for the area's version.
+    thread_list = fragments.thread_list(area, after=request.args.get("after"))
+
     # If the area is secret and the user is an admin, fetch a list of users with access.
     access_list = helpers.get_access_list(area.id) if area.is_secret and helpers.is_admin() else []
 
     # Render the area page with appropriate data and access controls.
-    return render_template("area.html", area=area, is_admin=helpers.is_admin(), access_list=access_list, turnstile_sitekey=helpers.get_turnstile_sitekey(), csrf_token=generate_csrf(), notifications=helpers.get_notifications(user_id))
+    return conditional.with_etag(render_template(
+        "area.html",
+        area=area,
+        thread_list=thread_list,
+        is_admin=helpers.is_admin(),
+        access_list=access_list,
+        turnstile_sitekey=helpers.get_turnstile_sitekey(),
+        csrf_token=generate_csrf(),
+        unread_notifications=helpers.count_unread_notifications(user_id)
+    ), etag)
 
 
 @chat_blueprint.route("/area/<int:area_id>/create_thread", methods=['POST'])
@@ -67,13 +109,22 @@ def create_thread(area_id):
     if not helpers.is_valid_thread_title(request.form["title"]):
         user_id = session["user_id"]
         flash("Invalid thread title", "error")
-        return render_template("area.html", area=Area.create_from_db(area_id, user_id), turnstile_sitekey=helpers.get_turnstile_sitekey(), csrf_token=generate_csrf(), notifications=helpers.get_notifications(user_id))
-
-    # Create a new thread and its first message in the database.
-    new_thread = Thread(area_id, request.form["title"], session["user_id"])
-    new_thread.insert()
-    new_message = Message(new_thread.id, session["user_id"], request.form["message"])
-    new_message.insert()
+        area = Area.create_from_db(area_id, user_id)
+        return render_template(
+            "area.html",
+            area=area,
+            thread_list=fragments.thread_list(area),
+            turnstile_sitekey=helpers.get_turnstile_sitekey(),
+            csrf_token=generate_csrf(),
+            unread_notifications=helpers.count_unread_notifications(user_id)
+        )
+
+    # Create a new thread and its first message in the database in a single transaction.
+    with Database().transaction():
+        new_thread = Thread(area_id, request.form["title"], session["user_id"])
+        new_thread.insert()
+        new_message = Message(new_thread.id, session["user_id"], request.form["message"])
+        new_message.insert()
 
     # Redirect back to the area page after creating a new thread.
     flash("Thread created successfully", "success")
@@ -84,45 +135,132 @@ def create_thread(area_id):
 @login_required
 def view_thread(thread_id):
     user_id = session['user_id']
+
+    # Answer with 304 before loading the messages if the browser has the current version of the page.
+    etag = conditional.page_etag(conditional.thread_version(thread_id, user_id))
+    if conditional.is_not_modified(etag):
+        return conditional.not_modified(etag)
+
     thread = Thread.create_from_db(thread_id)
     if not thread:
         flash("Thread does not exist", "error")
         return redirect(url_for("chat.index"))
+
+    # Admins can read the whole thread on one page, rendered while the messages are read.
+    if request.args.get("all") == "1" and helpers.is_admin():
+        helpers.mark_notifications_read(user_id, thread_id)
+        return conditional.with_etag(fragments.stream_page(
+            "thread.html",
+            thread=thread,
+            messages=thread.stream_messages(),
+            turnstile_sitekey=helpers.get_turnstile_sitekey(),
+            is_admin=True,
+            csrf_token=generate_csrf(),
+            is_subscribed=helpers.is_subscribed(thread_id, user_id),
+            unread_notifications=helpers.count_unread_notifications(user_id)
+        ), etag)
+
+    # Render a single page of messages, located by the cursor or message ID in the query string,
+    # unless it is cached for the thread's version.
+    message_list = fragments.message_list(
+        thread,
+        before=request.args.get("before"),
+        after=request.args.get("after"),
+        around=request.args.get("around", type=int),
+        first=request.args.get("first") == "1"
+    )
+    helpers.mark_notifications_read(user_id, thread_id)
     is_subscribed = helpers.is_subscribed(thread_id, user_id)
 
-    return render_template("thread.html", thread=thread, turnstile_sitekey=helpers.get_turnstile_sitekey(), is_admin=helpers.is_admin(), csrf_token=generate_csrf(), is_subscribed=is_subscribed, notifications=helpers.get_notifications(user_id))
+    return conditional.with_etag(render_template(
+        "thread.html",
+        thread=thread,
+        message_list=message_list,
+        turnstile_sitekey=helpers.get_turnstile_sitekey(),
+        is_admin=helpers.is_admin(),
+        csrf_token=generate_csrf(),
+        is_subscribed=is_subscribed,
+        unread_notifications=helpers.count_unread_notifications(user_id)
+    ), etag)
+
+
+@chat_blueprint.route("/thread/<int:thread_id>/events", methods=['GET'])
+@login_required
+def thread_events(thread_id):
+    thread = Thread.create_from_db(thread_id)
+    if not thread or not Area.create_from_db(thread.area, session["user_id"]):
+        return Response(status=404)
+
+    # Browsers send Last-Event-ID when reconnecting, the page passes the newest rendered message on the first connection.
+    last_id = request.headers.get("Last-Event-ID", type=int)
+    if last_id is None:
+        last_id = request.args.get("last_event_id", type=int)
+
+    return Response(
+        live.event_stream(thread_id, last_id),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 @chat_blueprint.route("/thread/<int:thread_id>/send_message", methods=['POST'])
 @login_required
+@rate_limited("send_message", 120, 60, scope="user")
 @captcha_required
 def send_message(thread_id):
     # Validate message
     if not helpers.is_valid_message(request.form["message"]):
         flash("Invalid message", "error")
         user_id = session["user_id"]
-        return render_template("thread.html", thread=Thread.create_from_db(thread_id), turnstile_sitekey=helpers.get_turnstile_sitekey(), csrf_token=generate_csrf(), notifications=helpers.get_notifications(user_id))
-
+        thread = Thread.create_from_db(thread_id)
+        return render_template(
+            "thread.html",
+            thread=thread,
+            message_list=fragments.message_list(thread),
+            turnstile_sitekey=helpers.get_turnstile_sitekey(),
+            csrf_token=generate_csrf(),
+            unread_notifications=helpers.count_unread_notifications(user_id)
+        )
+
+    # Validate, re-encode and store the attached image together with its thumbnails.
     filename = None
     if "image" in request.files and request.files["image"].filename != "":
-        Path("./app/static/uploads").mkdir(parents=True, exist_ok=True)
-        image = request.files["image"]
-        rand = str(uuid.uuid4())
-        filename = "./app/static/uploads/" + rand + ".jpg"
-        image.save(filename)
-        filename = "/static/uploads/" + rand + ".jpg"
-
-    # Create and insert the new message into the thread.
-    new_message = Message(thread_id, session["user_id"], request.form["message"], image_url=filename)
-    new_message = new_message.insert()
-
-    # Create a new notification for the new message.
-    helpers.create_notification(thread_id, new_message.text)
+        try:
+            filename = uploads.save_image(request.files["image"])
+        except uploads.UploadError as error:
+            flash(str(error), "error")
+            return redirect(url_for("chat.view_thread", thread_id=thread_id))
+
+    # Insert the new message and notify subscribers in a single transaction.
+    with Database().transaction():
+        new_message = Message(thread_id, session["user_id"], request.form["message"], image_url=filename)
+        new_message = new_message.insert()
+        helpers.create_notification(thread_id, new_message.text)
 
     # Redirect back to the thread page after adding a new message.
     return redirect(url_for("chat.view_thread", thread_id=thread_id))
 
 
+@chat_blueprint.app_errorhandler(413)
+def request_too_large(error):
+    # Raised by Werkzeug before the view runs when the request body exceeds MAX_CONTENT_LENGTH.
+    flash(f"Image is too large, the maximum size is {uploads.max_upload_bytes() / (1024 * 1024):g} MB", "error")
+    return redirect(request.referrer or url_for("chat.index"))
+
+
+@chat_blueprint.app_errorhandler(passwords.PoolBusyError)
+def auth_busy(error):
+    # Raised when password hashing is saturated, so that a burst of logins fails fast instead of queueing.
+    flash(str(error), "error")
+    return redirect(request.path if request.method == "POST" else url_for("chat.index"))
+
+
+@chat_blueprint.route("/attachments/<name>", methods=['GET'])
+def attachment(name):
+    # Named by content, so the response is cached as immutable; the storage backend decides who sends the file.
+    return attachments.send(name)
+
+
 @chat_blueprint.route("/thread/<int:thread_id>/edit_message/<int:message_id>", methods=['POST'])
 @login_required
 def edit_message(thread_id, message_id):
@@ -139,7 +277,7 @@ def edit_message(thread_id, message_id):
         return redirect(url_for('chat.view_thread', thread_id=thread_id))
 
     message.text = new_text
-    message.update(new_text)
+    message.update(new_text, message.image_url)
 
     return redirect(url_for("chat.view_thread", thread_id=thread_id))
 
@@ -199,10 +337,6 @@ def delete_thread(thread_id):
 @chat_blueprint.route("/delete_message/<int:message_id>/<int:thread_id>", methods=['POST'])
 @login_required
 def delete_message(message_id, thread_id):
-    image = helpers.get_message_image(message_id)
-    if image:
-        os.remove("./app" + image)
-
     helpers.delete_message(thread_id, message_id, session["user_id"])
 
     # Redirect back to the thread view.
@@ -220,19 +354,72 @@ def delete_area(area_id):
     return redirect(url_for("chat.index"))
 
 
+@chat_blueprint.route("/notifications", methods=['GET'])
+@login_required
+def notifications():
+    user_id = session["user_id"]
+    notification_page, next_cursor = helpers.get_notifications(user_id, before=request.args.get("before"))
+
+    return render_template(
+        "notifications.html",
+        notification_page=notification_page,
+        next_cursor=next_cursor,
+        csrf_token=generate_csrf(),
+        unread_notifications=helpers.count_unread_notifications(user_id)
+    )
+
+
+@chat_blueprint.route("/notifications/mark_read", methods=['POST'])
+@login_required
+def mark_notifications_read():
+    helpers.mark_notifications_read(session["user_id"])
+
+    return redirect(url_for("chat.notifications"))
+
+
 @chat_blueprint.route("/search", methods=['GET'])
 @login_required
 def search():
     query = request.args.get('query', '')
-
-    areas, threads, messages = helpers.full_search(query)
+    page = max(request.args.get('page', 1, type=int), 1)
 
     user_id = session["user_id"]
 
-    return render_template("search_results.html", areas=areas, threads=threads, messages=messages, csrf_token=generate_csrf(), notifications=helpers.get_notifications(user_id))
+    is_admin = helpers.is_admin()
+
+    # Admins can list every match on one page, rendered while the matches are read.
+    if request.args.get("all") == "1" and is_admin:
+        areas, threads, messages = helpers.full_search(query, user_id, None)
+        return fragments.stream_page(
+            "search_results.html",
+            query=query,
+            page=None,
+            areas=areas,
+            threads=threads,
+            messages=messages,
+            is_admin=is_admin,
+            csrf_token=generate_csrf(),
+            unread_notifications=helpers.count_unread_notifications(user_id)
+        )
+
+    areas, threads, messages = helpers.full_search(query, user_id, page)
+
+    return render_template(
+        "search_results.html",
+        query=query,
+        page=page,
+        areas=areas,
+        threads=threads,
+        messages=messages,
+        is_admin=is_admin,
+        csrf_token=generate_csrf(),
+        unread_notifications=helpers.count_unread_notifications(user_id)
+    )
 
 
 @chat_blueprint.route("/login", methods=['GET', 'POST'])
+@rate_limited("login", 30, 60)
+@rate_limited("login", 20, 60, scope="username")
 @captcha_required
 def login():
     # Display login form on GET request.
@@ -262,6 +449,7 @@ def login():
 
 
 @chat_blueprint.route("/register", methods=['GET', 'POST'])
+@rate_limited("register", 20, 3600)
 @captcha_required
 def register():
     # Display registration form on GET request.
@@ -307,3 +495,38 @@ def logout():
 
     # Redirect to the main page (index) after logging out.
     return redirect(url_for("chat.index"))
+
+
+@chat_blueprint.route("/api/threads/<int:thread_id>/messages", methods=['GET'])
+@api_login_required
+def api_thread_messages(thread_id):
+    after_id = request.args.get("after", 0, type=int)
+    limit = min(max(request.args.get("limit", delta.DEFAULT_LIMIT, type=int), 1), delta.MAX_LIMIT)
+
+    result = delta.thread_messages_after(thread_id, session["user_id"], after_id, limit)
+    if result is None:
+        return jsonify(error="Thread not found"), 404
+
+    messages, has_more = result
+    # Clients pass last_id back as "after" on their next poll.
+    last_id = messages[-1]["id"] if messages else after_id
+    return jsonify(thread=thread_id, messages=messages, has_more=has_more, last_id=last_id)
+
+
+@chat_blueprint.route("/api/areas/<int:area_id>/threads", methods=['GET'])
+@api_login_required
+def api_area_threads(area_id):
+    since = None
+    if request.args.get("since"):
+        since = delta.parse_since(request.args["since"])
+        if since is None:
+            return jsonify(error="Invalid since parameter"), 400
+    limit = min(max(request.args.get("limit", delta.DEFAULT_LIMIT, type=int), 1), delta.MAX_LIMIT)
+
+    result = delta.area_threads_since(area_id, session["user_id"], since, limit)
+    if result is None:
+        return jsonify(error="Area not found"), 404
+
+    threads, has_more, cursor = result
+    # Clients pass the cursor back as "since" on their next poll.
+    return jsonify(area=area_id, threads=threads, has_more=has_more, cursor=cursor)
@@ -0,0 +1,79 @@
+import time
+from os import getenv
+import click
+from sqlalchemy import create_engine
+from .utils import migrations
+from .utils import helpers
+from .utils import stats
+from .utils import attachments
+
+
+@click.command("rebuild-stats")
+def rebuild_stats_command():
+    """Recompute area and thread statistics from scratch."""
+    area_count, thread_count = stats.rebuild_stats()
+    click.echo(f"Rebuilt statistics for {area_count} areas and {thread_count} threads")
+
+
+@click.command("prune-notifications")
+@click.option("--read-days", type=int, default=30, show_default=True, help="Age after which read notifications are deleted.")
+@click.option("--unread-days", type=int, default=180, show_default=True,
+              help="Age after which unread notifications are deleted.")
+@click.option("--batch-size", type=int, default=5000, show_default=True, help="Number of rows deleted per statement.")
+def prune_notifications_command(read_days, unread_days, batch_size):
+    """Delete old notifications in small batches."""
+    deleted = helpers.prune_notifications(read_days, unread_days, batch_size)
+    click.echo(f"Deleted {deleted} notifications")
+
+
+@click.command("sweep-attachments")
+@click.option("--grace-seconds", type=int, default=attachments.ORPHAN_GRACE_SECONDS, show_default=True,
+              help="Time an attachment stays orphaned before it is deleted.")
+@click.option("--batch-size", type=int, default=500, show_default=True, help="Number of attachments deleted per transaction.")
+@click.option("--interval", type=int, default=None, help="Keep running and sweep every this many seconds.")
+def sweep_attachments_command(grace_seconds, batch_size, interval):
+    """Delete the files of attachments no message references."""
+    while True:
+        deleted, reclaimed = attachments.sweep(grace_seconds, batch_size)
+        click.echo(f"Deleted {deleted} attachments, reclaimed {reclaimed} bytes")
+        if interval is None:
+            return
+        time.sleep(interval)
+
+
+@click.group("db")
+def db_command():
+    """Manage the database schema."""
+
+
+@db_command.command("upgrade")
+@click.option("--target", type=int, default=None, help="Version to upgrade to, defaults to the latest.")
+def upgrade_command(target):
+    """Apply pending schema migrations."""
+    applied = migrations.upgrade(create_engine(getenv("DB_URL")), target)
+    for migration in applied:
+        click.echo(f"Applied {migration.version:04d}_{migration.name}")
+    if not applied:
+        click.echo("Database schema is up to date")
+
+
+@db_command.command("status")
+def status_command():
+    """Show applied and pending schema migrations."""
+    for migration, applied_at in migrations.status(create_engine(getenv("DB_URL"))):
+        state = f"applied {applied_at:%Y-%m-%d %H:%M:%S}" if applied_at else "pending"
+        click.echo(f"{migration.version:04d}_{migration.name}: {state}")
+
+
+def register_commands(app):
+    """
+    Registers the maintenance commands with the Flask CLI.
+
+    Args:
+        app (Flask): The application to register the commands on.
+    """
+
+    app.cli.add_command(db_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(prune_notifications_command)
+    app.cli.add_command(sweep_attachments_command)
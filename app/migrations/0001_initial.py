@@ -0,0 +1,88 @@
+"""
+Creates the initial schema.
+"""
+
+TRANSACTIONAL = True
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS areas (
+        id SERIAL PRIMARY KEY,
+        topic TEXT NOT NULL,
+        is_secret boolean NOT NULL,
+        search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', topic)) STORED
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id SERIAL PRIMARY KEY,
+        username TEXT NOT NULL UNIQUE,
+        password bytea NOT NULL,
+        is_admin boolean NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS threads (
+        id SERIAL PRIMARY KEY,
+        area integer NOT NULL REFERENCES areas(id) ON DELETE CASCADE,
+        title TEXT NOT NULL,
+        owner_id integer NOT NULL REFERENCES users(id),
+        search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', title)) STORED
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS messages (
+        id SERIAL PRIMARY KEY,
+        thread integer NOT NULL REFERENCES threads(id) ON DELETE CASCADE,
+        sender integer NOT NULL REFERENCES users(id),
+        text TEXT NOT NULL,
+        image_url TEXT,
+        sent_time TIMESTAMP WITHOUT TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+        search_vector tsvector GENERATED ALWAYS AS (to_tsvector('simple', text)) STORED
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS secret_area_privileges (
+        id SERIAL PRIMARY KEY,
+        area_id integer NOT NULL REFERENCES areas(id) ON DELETE CASCADE,
+        user_id integer NOT NULL UNIQUE REFERENCES users(id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS thread_subscriptions (
+        id SERIAL PRIMARY KEY,
+        thread_id integer NOT NULL REFERENCES threads(id) ON DELETE CASCADE,
+        user_id integer NOT NULL REFERENCES users(id),
+        UNIQUE (thread_id, user_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS notifications (
+        id SERIAL PRIMARY KEY,
+        user_id integer NOT NULL REFERENCES users(id),
+        thread_id integer NOT NULL REFERENCES threads(id) ON DELETE CASCADE,
+        sender_id integer NOT NULL REFERENCES users(id),
+        message TEXT NOT NULL,
+        sent_time TIMESTAMP WITHOUT TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS area_stats (
+        area_id integer PRIMARY KEY REFERENCES areas(id) ON DELETE CASCADE,
+        thread_count integer NOT NULL DEFAULT 0,
+        message_count integer NOT NULL DEFAULT 0,
+        last_message_time TIMESTAMP WITHOUT TIME ZONE,
+        last_message_id integer
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS thread_stats (
+        thread_id integer PRIMARY KEY REFERENCES threads(id) ON DELETE CASCADE,
+        area_id integer NOT NULL REFERENCES areas(id) ON DELETE CASCADE,
+        message_count integer NOT NULL DEFAULT 0,
+        last_message_time TIMESTAMP WITHOUT TIME ZONE,
+        last_message_id integer,
+        last_activity TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+    )
+    """,
+]
@@ -0,0 +1,22 @@
+"""
+Adds the secondary indexes used by the thread, area, search and notification queries.
+
+The indexes are built concurrently so that the migration does not block writes on a live
+database, which requires running outside of a transaction.
+"""
+
+TRANSACTIONAL = False
+
+STATEMENTS = [
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_thread_sent_time_idx ON messages (thread, sent_time, id)""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS threads_area_idx ON threads (area)""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS notifications_user_sent_time_idx ON notifications (user_id, sent_time DESC)""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS thread_subscriptions_user_idx ON thread_subscriptions (user_id)""",
+    """
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS thread_stats_area_activity_idx
+    ON thread_stats (area_id, last_activity DESC, thread_id DESC)
+    """,
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS areas_search_idx ON areas USING GIN (search_vector)""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS threads_search_idx ON threads USING GIN (search_vector)""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_search_idx ON messages USING GIN (search_vector)""",
+]
@@ -0,0 +1,15 @@
+"""
+Adds read state to notifications, with indexes for counting unread notifications and for
+pruning old ones.
+
+Runs outside of a transaction so that the indexes can be built concurrently; every statement
+is idempotent so that a failed run can be retried.
+"""
+
+TRANSACTIONAL = False
+
+STATEMENTS = [
+    """ALTER TABLE notifications ADD COLUMN IF NOT EXISTS is_read boolean NOT NULL DEFAULT false""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS notifications_unread_idx ON notifications (user_id) WHERE NOT is_read""",
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS notifications_sent_time_idx ON notifications (sent_time)""",
+]
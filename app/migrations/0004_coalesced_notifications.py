@@ -0,0 +1,33 @@
+"""
+Coalesces notifications into one row per user and thread.
+
+Existing rows are merged into the most recent notification of each thread, which keeps the
+number of unread messages in unread_count, and a unique constraint makes new notifications
+update that row instead of adding another one.
+"""
+
+TRANSACTIONAL = True
+
+STATEMENTS = [
+    """ALTER TABLE notifications ADD COLUMN unread_count integer NOT NULL DEFAULT 0""",
+    """
+    UPDATE notifications n SET unread_count = g.unread_count, is_read = g.unread_count = 0
+    FROM (
+        SELECT DISTINCT ON (user_id, thread_id) id,
+               COUNT(*) FILTER (WHERE NOT is_read) OVER (PARTITION BY user_id, thread_id) AS unread_count
+        FROM notifications
+        ORDER BY user_id, thread_id, sent_time DESC, id DESC
+    ) g
+    WHERE n.id = g.id
+    """,
+    """
+    DELETE FROM notifications WHERE id IN (
+        SELECT id FROM (
+            SELECT id, row_number() OVER (PARTITION BY user_id, thread_id ORDER BY sent_time DESC, id DESC) AS position
+            FROM notifications
+        ) ranked
+        WHERE position > 1
+    )
+    """,
+    """ALTER TABLE notifications ADD CONSTRAINT notifications_user_thread_key UNIQUE (user_id, thread_id)""",
+]
@@ -0,0 +1,12 @@
+"""
+Adds an index for reading the messages of a thread after a given message ID, used by live
+updates and the delta API.
+
+Built concurrently outside of a transaction, like the other indexes.
+"""
+
+TRANSACTIONAL = False
+
+STATEMENTS = [
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_thread_id_idx ON messages (thread, id)""",
+]
@@ -0,0 +1,10 @@
+"""
+Adds a counter of message edits to thread_stats, part of the version of a thread page used
+for conditional requests.
+"""
+
+TRANSACTIONAL = True
+
+STATEMENTS = [
+    """ALTER TABLE thread_stats ADD COLUMN edit_count integer NOT NULL DEFAULT 0""",
+]
@@ -0,0 +1,18 @@
+"""
+Adds the attachments table, which counts the messages referencing each stored image so that
+identical uploads share one set of files.
+"""
+
+TRANSACTIONAL = True
+
+STATEMENTS = [
+    """
+    CREATE TABLE attachments (
+        name TEXT PRIMARY KEY,
+        files TEXT[] NOT NULL,
+        size BIGINT NOT NULL,
+        ref_count INTEGER NOT NULL DEFAULT 0,
+        created_time TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+    """,
+]
@@ -0,0 +1,12 @@
+"""
+Marks attachments without references as orphaned instead of deleting them inline, with an index
+for the sweeper that deletes them in the background.
+"""
+
+TRANSACTIONAL = True
+
+STATEMENTS = [
+    """ALTER TABLE attachments ADD COLUMN orphaned_time TIMESTAMP""",
+    """UPDATE attachments SET orphaned_time = created_time WHERE ref_count = 0""",
+    """CREATE INDEX attachments_orphaned_idx ON attachments (orphaned_time) WHERE orphaned_time IS NOT NULL""",
+]
@@ -0,0 +1,19 @@
+"""
+Adds the token buckets of the Postgres rate limiter, shared by every web worker and node.
+
+The table is unlogged: it is written on every limited request, and losing it in a crash only
+resets the limits.
+"""
+
+TRANSACTIONAL = True
+
+STATEMENTS = [
+    """
+    CREATE UNLOGGED TABLE rate_limits (
+        key TEXT PRIMARY KEY,
+        tokens DOUBLE PRECISION NOT NULL,
+        allowed BOOLEAN NOT NULL,
+        updated_time TIMESTAMP NOT NULL
+    )
+    """,
+]
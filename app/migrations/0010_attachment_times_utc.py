@@ -0,0 +1,16 @@
+"""
+Stores the times of attachments in UTC, like the rest of the schema, so that the grace period of
+the sweeper does not depend on the time zone of the database server. Existing times were written
+with NOW() in the server's time zone and are converted.
+"""
+
+TRANSACTIONAL = True
+
+STATEMENTS = [
+    """ALTER TABLE attachments ALTER COLUMN created_time SET DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')""",
+    """
+    UPDATE attachments SET
+        created_time = (created_time AT TIME ZONE current_setting('TimeZone')) AT TIME ZONE 'UTC',
+        orphaned_time = (orphaned_time AT TIME ZONE current_setting('TimeZone')) AT TIME ZONE 'UTC'
+    """,
+]
@@ -0,0 +1,6 @@
+"""
+Ordered schema migrations, applied by app.utils.migrations.
+
+Each module is named <version>_<name>.py and defines STATEMENTS, a list of SQL statements, and
+TRANSACTIONAL, which tells whether the statements are run in a single transaction.
+"""
@@ -1,9 +1,16 @@
 from sqlalchemy import text
 from ..utils import helpers
 from ..utils.db import Database
+from ..utils import loaders
+from ..utils import access
+from ..utils import stats
 from .thread import Thread
 
 
+# The number of threads shown on one page of an area.
+THREADS_PER_PAGE = 50
+
+
 class Area:
     """
     Represents an area on the discussion platform.
@@ -11,12 +18,17 @@ class Area:
     An area is a section or category under which threads can be created. It can be either secret or public.
 
     Attributes:
-        db (Database): An instance of the Database class for database operations.
         topic (str): The topic or title of the area.
         is_secret (bool): Flag indicating if the area is secret.
         id (int, optional): The unique identifier of the area in the database.
+        threads (list[Thread]): The currently loaded page of threads in the area.
+        has_more (bool): Whether there are less recently active threads than the loaded page.
+        version (tuple, optional): The thread count, message count, last message ID and latest thread
+            activity of the area, which change whenever its thread listing does. Set when loaded with create_from_db.
     """
 
+    __slots__ = ("topic", "is_secret", "id", "threads", "has_more", "version", "_stats")
+
     def __init__(self, topic, is_secret=False, id=None):
         """
         Initializes an Area object.
@@ -27,10 +39,13 @@ class Area:
             id (int, optional): The unique identifier of the area in the database. Defaults to None.
         """
 
-        self.db = Database()
         self.topic = topic
         self.is_secret = is_secret
         self.id = id
+        self.threads: list[Thread] = []
+        self.has_more = False
+        self.version = None
+        self._stats = None
 
     @classmethod
     def create_from_db(cls, area_id, user_id):
@@ -45,21 +60,41 @@ class Area:
             Area or None: An instance of Area if found and accessible by the user, otherwise None.
         """
 
+        visible = access.visible_areas(user_id)
+        if visible is None or area_id not in visible:
+            return None
+
         sql = text("""
-        SELECT a.topic, a.is_secret
+        SELECT a.topic, a.is_secret, s.thread_count, s.message_count, s.last_message_id,
+            (SELECT MAX(ts.last_activity) FROM thread_stats ts WHERE ts.area_id = a.id) AS last_activity
         FROM areas a
-        LEFT JOIN secret_area_privileges sap ON a.id = sap.area_id AND sap.user_id = :user_id
-        INNER JOIN users u ON u.id = :user_id
-        WHERE a.id = :area_id AND (u.is_admin = true OR a.is_secret = false OR sap.user_id IS NOT NULL)
+        LEFT JOIN area_stats s ON s.area_id = a.id
+        WHERE a.id = :area_id
         """)
 
         try:
-            result = Database().fetch_one(sql, {"area_id": area_id, "user_id": user_id})
+            result = Database().fetch_one(sql, {"area_id": area_id})
             instance = cls(result["topic"], result["is_secret"], area_id)
+            instance.version = (
+                result["thread_count"], result["message_count"], result["last_message_id"], result["last_activity"]
+            )
             return instance
         except Exception:
             return None
 
+    @property
+    def stats(self):
+        """
+        Aggregated statistics of the area, loaded on first access unless prefetched.
+
+        Returns:
+            dict: The thread count, message count and last message time of the area.
+        """
+
+        if self._stats is None:
+            loaders.prefetch_area_stats([self])
+        return self._stats
+
     @property
     def thread_count(self):
         """
@@ -69,8 +104,7 @@ class Area:
             int: The count of threads within the area.
         """
 
-        sql = text("""SELECT COUNT(*) FROM threads t WHERE t.area = :area_id""")
-        return self.db.fetch_one(sql, {"area_id": self.id})["count"]
+        return self.stats["thread_count"]
 
     @property
     def message_count(self):
@@ -81,8 +115,18 @@ class Area:
             int: The count of messages within all threads of the area.
         """
 
-        sql = text("""SELECT COUNT(*) FROM messages m WHERE m.thread in (SELECT t.id FROM threads t WHERE t.area = :area_id)""")
-        return self.db.fetch_one(sql, {"area_id": self.id})["count"]
+        return self.stats["message_count"]
+
+    @property
+    def last_message_time(self):
+        """
+        The time of the last message sent in the area.
+
+        Returns:
+            datetime or None: The time the last message was sent, or None if no messages.
+        """
+
+        return self.stats["last_message_time"]
 
     @property
     def last_message(self):
@@ -93,27 +137,64 @@ class Area:
             str or None: A human-readable string of the time since the last message was sent, or None if no messages.
         """
 
-        sql = text("""SELECT MAX(m.sent_time) FROM messages m WHERE m.thread in (SELECT t.id FROM threads t WHERE t.area = :area_id)""")
-        last_message_time = self.db.fetch_one(sql, {"area_id": self.id})["max"]
+        last_message_time = self.stats["last_message_time"]
         if last_message_time:
             return helpers.time_ago(last_message_time)
         return None
 
-    @property
-    def threads(self):
+    def load_threads(self, after=None, limit=THREADS_PER_PAGE):
         """
-        A list of threads in the area.
+        Loads one page of the area's threads, most recently active first.
+
+        Threads are ordered by the last activity stored in thread_stats, so the listing is served
+        by an index and stays stable between requests. Pages are located with keyset cursors.
+
+        Args:
+            after (str, optional): Cursor of a thread; loads the page of threads following it.
+            limit (int, optional): The maximum number of threads on a page. Defaults to THREADS_PER_PAGE.
 
         Returns:
-            list[Thread]: A list of Thread objects representing the threads in the area.
+            Area: The instance of the Area with threads and has_more set.
         """
 
-        sql = text("""SELECT t.id,t.area,t.title,t.owner_id,a.topic FROM threads t, areas a WHERE t.area = :area_id AND t.area = a.id""")
+        cursor = helpers.decode_cursor(after)
+        condition = "AND (ts.last_activity, ts.thread_id) < (:cursor_time, :cursor_id)" if cursor else ""
+        sql = text(f"""
+        SELECT t.id, t.title, t.owner_id, ts.message_count, ts.last_message_time, ts.last_activity
+        FROM thread_stats ts
+        JOIN threads t ON t.id = ts.thread_id
+        WHERE ts.area_id = :area_id {condition}
+        ORDER BY ts.last_activity DESC, ts.thread_id DESC
+        LIMIT :limit
+        """)
+        params = {"area_id": self.id, "limit": limit + 1}
+        if cursor:
+            params["cursor_time"], params["cursor_id"] = cursor
+
         threads: list[Thread] = []
-        for thread_result in self.db.fetch_all(sql, {"area_id": self.id}):
-            thread = Thread(thread_result["area"], thread_result["title"], thread_result["owner_id"], thread_result["id"], thread_result["topic"])
+        for thread_id, title, owner_id, message_count, last_message_time, last_activity in Database().fetch_rows(sql, params):
+            thread = Thread(self.id, title, owner_id, thread_id, self.topic)
+            # The listing already joins the statistics, so they are attached without another query.
+            thread._stats = {"message_count": message_count, "last_message_time": last_message_time}
+            thread.last_activity = last_activity
             threads.append(thread)
-        return threads
+
+        self.has_more = len(threads) > limit
+        self.threads = threads[:limit]
+        return self
+
+    @property
+    def next_cursor(self):
+        """
+        The cursor for the page following the loaded threads.
+
+        Returns:
+            str or None: The cursor of the least recently active loaded thread, or None if there are no more threads.
+        """
+
+        if not self.has_more or not self.threads:
+            return None
+        return helpers.encode_cursor(self.threads[-1].last_activity, self.threads[-1].id)
 
     def insert(self):
         """
@@ -124,5 +205,9 @@ class Area:
         """
 
         sql = text("""INSERT INTO areas (topic, is_secret) VALUES (:topic, :is_secret) RETURNING id""")
-        self.id = self.db.execute(sql, {"topic": self.topic, "is_secret": self.is_secret})["id"]
+        db = Database()
+        with db.transaction():
+            self.id = db.execute(sql, {"topic": self.topic, "is_secret": self.is_secret})["id"]
+            stats.create_area_stats(self.id)
+            access.invalidate()
         return self
@@ -1,7 +1,11 @@
 from datetime import datetime
 from sqlalchemy import text
 from ..utils.db import Database
+from ..utils import attachments
 from ..utils import helpers
+from ..utils import live
+from ..utils import stats
+from ..utils import uploads
 
 
 class Message:
@@ -9,9 +13,9 @@ class Message:
     Represents a message in the discussion platform.
 
     A message is a user's post in a thread. It can contain text and optionally an image URL.
+    Long threads load many messages per page, so instances use slots instead of a dictionary.
 
     Attributes:
-        db (Database): An instance of the Database class for database operations.
         thread (int): The ID of the thread to which the message belongs.
         sender (int): The ID of the user who sent the message.
         text (str): The text content of the message.
@@ -22,6 +26,8 @@ class Message:
         sent_time (datetime, optional): The timestamp when the message was sent.
     """
 
+    __slots__ = ("thread", "sender", "text", "image_url", "sent_time", "id", "thread_title", "sender_name")
+
     def __init__(self, thread, sender, text, image_url=None, message_id=None, thread_title=None, sender_name=None, sent_time=None):
         """
         Initializes a Message object.
@@ -37,7 +43,6 @@ class Message:
             sent_time (datetime, optional): The timestamp when the message was sent. Defaults to the current time.
         """
 
-        self.db = Database()
         self.thread = thread
         self.sender = sender
         self.text = text
@@ -87,6 +92,23 @@ class Message:
         except Exception:
             return None
 
+    @classmethod
+    def from_row(cls, row, thread, thread_title=None):
+        """
+        Creates a Message from a row of a thread's messages, without a lookup by column name.
+
+        Args:
+            row (tuple): The id, sender, text, image_url, sent_time and sender name of the message, in this order.
+            thread (int): The ID of the thread to which the message belongs.
+            thread_title (str, optional): The title of the thread. Defaults to None.
+
+        Returns:
+            Message: The message.
+        """
+
+        message_id, sender, text, image_url, sent_time, sender_name = row
+        return cls(thread, sender, text, image_url, message_id, thread_title, sender_name, sent_time)
+
     @property
     def sent_time_ago(self):
         """
@@ -98,27 +120,73 @@ class Message:
 
         return helpers.time_ago(self.sent_time)
 
+    @property
+    def thumbnail_url(self):
+        """
+        The URL of the largest thumbnail of the attached image, shown in the thread.
+
+        Returns:
+            str or None: The thumbnail URL, or None if the message has no image.
+        """
+
+        return uploads.thumbnail_url(self.image_url) if self.image_url else None
+
+    @property
+    def thumbnail_srcset(self):
+        """
+        The srcset attribute listing the thumbnails of the attached image.
+
+        Returns:
+            str or None: The srcset value, or None if the message has no image or the image has no thumbnails.
+        """
+
+        return uploads.thumbnail_srcset(self.image_url) if self.image_url else None
+
     def insert(self):
         """
-        Inserts the message into the database.
+        Inserts the message into the database and announces it to clients following the thread.
 
         Returns:
             Message: The instance of the Message with its ID updated from the database.
         """
 
         sql = text("""INSERT INTO messages (thread, sender, text, image_url, sent_time) VALUES (:thread, :sender, :text, :image_url, :sent_time) RETURNING id""")
-        self.id = self.db.execute(sql, {"thread": self.thread, "sender": self.sender, "text": self.text, "image_url": self.image_url, "sent_time": self.sent_time})["id"]
+        db = Database()
+        with db.transaction():
+            params = {
+                "thread": self.thread,
+                "sender": self.sender,
+                "text": self.text,
+                "image_url": self.image_url,
+                "sent_time": self.sent_time,
+            }
+            self.id = db.execute(sql, params)["id"]
+            stats.record_message(self.thread, self.id, self.sent_time)
+            attachments.acquire(self.image_url)
+            live.publish(self.thread, "message", self.id)
         return self
 
     def update(self, new_text, new_image_url=None):
         """
-        Updates the text and optionally the image URL of the message in the database.
+        Updates the text and optionally the image URL of the message in the database and announces
+        the edit to clients following the thread. A replaced image is deleted in the background once no
+        other message references it.
 
         Args:
             new_text (str): The new text content of the message.
             new_image_url (str, optional): The new URL of the image attached to the message, if any. Defaults to None.
         """
         sql = text("""UPDATE messages SET text = :new_text, image_url = :new_image_url WHERE id = :message_id""")
-        self.db.execute(sql, {"new_text": new_text, "new_image_url": new_image_url, "message_id": self.id}, False)
+        replaced = new_image_url != self.image_url
+        released_urls = [self.image_url] if replaced and self.image_url else []
+        db = Database()
+        with db.transaction():
+            db.execute(sql, {"new_text": new_text, "new_image_url": new_image_url, "message_id": self.id}, False)
+            if replaced:
+                attachments.acquire(new_image_url)
+            attachments.release(released_urls)
+            stats.record_edit(self.thread)
+            live.publish(self.thread, "edit", self.id)
+        uploads.delete_released(released_urls)
         self.text = new_text
         self.image_url = new_image_url
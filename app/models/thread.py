@@ -1,9 +1,15 @@
 from sqlalchemy import text
 from ..utils import helpers
 from ..utils.db import Database
+from ..utils import loaders
+from ..utils import stats
 from .message import Message
 
 
+# The number of messages shown on one page of a thread.
+MESSAGES_PER_PAGE = 50
+
+
 class Thread:
     """
     Represents a discussion thread in a forum or discussion platform.
@@ -11,15 +17,24 @@ class Thread:
     A thread is a sequence of messages under a specific topic within an area.
 
     Attributes:
-        db (Database): An instance of the Database class for database operations.
         area (int): The ID of the area to which the thread belongs.
         title (str): The title of the thread.
         id (int, optional): The unique identifier of the thread in the database.
         area_name (str, optional): The name of the area to which the thread belongs.
         owner_id (int): The ID of the user who created the thread.
-        messages (list[Message]): A list of Message objects in the thread.
+        last_activity (datetime, optional): The time of the last activity in the thread, set when listed in an area.
+        messages (list[Message]): The currently loaded page of Message objects in the thread.
+        has_older (bool): Whether there are messages older than the loaded page.
+        has_newer (bool): Whether there are messages newer than the loaded page.
+        version (tuple, optional): The last message ID, message count and edit counter of the thread,
+            which change whenever its messages do. Set when loaded with create_from_db.
     """
 
+    __slots__ = (
+        "area", "title", "id", "area_name", "owner_id", "last_activity",
+        "messages", "has_older", "has_newer", "version", "_stats",
+    )
+
     def __init__(self, area, title, owner_id, id=None, area_name=None):
         """
         Initializes a Thread object.
@@ -32,19 +47,26 @@ class Thread:
             area_name (str, optional): The name of the area to which the thread belongs. Defaults to None.
         """
 
-        self.db = Database()
         self.area = area
         self.title = title
         self.id = id
         self.area_name = area_name
         self.owner_id = owner_id
-        self.messages: list[Thread] = []
+        self.last_activity = None
+        self.messages: list[Message] = []
+        self.has_older = False
+        self.has_newer = False
+        self.version = None
+        self._stats = None
 
     @classmethod
     def create_from_db(cls, id):
         """
         Creates a Thread instance from the database based on the thread ID.
 
+        Only the thread itself and its version are loaded, its messages are loaded a page at a time
+        with load_messages.
+
         Args:
             id (int): The ID of the thread to be fetched.
 
@@ -53,16 +75,152 @@ class Thread:
         """
 
         sql = text("""
-SELECT m.id, t.title, t.owner_id, u.id as sender_id, u.username, m.text, m.image_url, m.sent_time, t.area, a.topic FROM messages m
-JOIN users u ON m.sender = u.id
-JOIN threads t ON m.thread = t.id
-JOIN areas a on t.area = a.id WHERE m.thread = :thread_id ORDER BY m.sent_time""")
-        instance = None
-        for row in Database().fetch_all(sql, {"thread_id": id}):
-            if not instance:
-                instance = cls(row["area"], row["title"], row["owner_id"], id, row["topic"])
-            instance.messages.append(Message(id, row["sender_id"], row["text"], image_url=row["image_url"], message_id=row["id"], thread_title=row["title"], sender_name=row["username"], sent_time=row["sent_time"]))
-        return instance
+        SELECT t.area, t.title, t.owner_id, a.topic, s.last_message_id, s.message_count, s.edit_count
+        FROM threads t
+        JOIN areas a ON t.area = a.id
+        LEFT JOIN thread_stats s ON s.thread_id = t.id
+        WHERE t.id = :thread_id
+        """)
+        row = Database().fetch_one(sql, {"thread_id": id})
+        if not row:
+            return None
+        thread = cls(row["area"], row["title"], row["owner_id"], id, row["topic"])
+        thread.version = (row["last_message_id"], row["message_count"], row["edit_count"])
+        return thread
+
+    def load_messages(self, before=None, after=None, around=None, first=False, limit=MESSAGES_PER_PAGE):
+        """
+        Loads one page of messages into the thread, ordered by (sent_time, id).
+
+        Pages are located with keyset cursors, so the cost of loading a page does not depend on its
+        position in the thread. Without arguments the newest page is loaded.
+
+        Args:
+            before (str, optional): Cursor of a message; loads the page of messages preceding it.
+            after (str, optional): Cursor of a message; loads the page of messages following it.
+            around (int, optional): ID of a message; loads the page containing it.
+            first (bool, optional): If true, loads the oldest page. Defaults to False.
+            limit (int, optional): The maximum number of messages on a page. Defaults to MESSAGES_PER_PAGE.
+
+        Returns:
+            Thread: The instance of the Thread with messages, has_older and has_newer set.
+        """
+
+        before = helpers.decode_cursor(before)
+        after = helpers.decode_cursor(after)
+
+        if around is not None:
+            anchor = self._message_position(around)
+            if anchor:
+                # Up to half a page ending with the anchor, then fill the rest with newer messages.
+                half = max(limit // 2, 1)
+                older = self._fetch_messages("<=", anchor, "DESC", half + 1)
+                self.has_older = len(older) > half
+                older = older[:half]
+                older.reverse()
+                remaining = limit - len(older)
+                newer = self._fetch_messages(">", anchor, "ASC", remaining + 1)
+                self.has_newer = len(newer) > remaining
+                self.messages = older + newer[:remaining]
+                return self
+
+        if after:
+            messages = self._fetch_messages(">", after, "ASC", limit + 1)
+            self.has_older, self.has_newer = True, len(messages) > limit
+            self.messages = messages[:limit]
+        elif first:
+            messages = self._fetch_messages(None, None, "ASC", limit + 1)
+            self.has_older, self.has_newer = False, len(messages) > limit
+            self.messages = messages[:limit]
+        else:
+            if before:
+                messages = self._fetch_messages("<", before, "DESC", limit + 1)
+            else:
+                messages = self._fetch_messages(None, None, "DESC", limit + 1)
+            self.has_older, self.has_newer = len(messages) > limit, before is not None
+            self.messages = messages[:limit]
+            self.messages.reverse()
+
+        return self
+
+    def stream_messages(self):
+        """
+        Yields every message of the thread, oldest first, reading them from a server-side cursor
+        while they are consumed, so that even the longest thread is never loaded at once.
+
+        Yields:
+            Message: Each message of the thread.
+        """
+
+        sql = text("""
+        SELECT m.id, m.sender, m.text, m.image_url, m.sent_time, u.username
+        FROM messages m
+        JOIN users u ON m.sender = u.id
+        WHERE m.thread = :thread_id
+        ORDER BY m.sent_time, m.id
+        """)
+        for row in Database().stream_rows(sql, {"thread_id": self.id}):
+            yield Message.from_row(row, self.id, self.title)
+
+    @property
+    def older_cursor(self):
+        """
+        The cursor for the page preceding the loaded messages.
+
+        Returns:
+            str or None: The cursor of the oldest loaded message, or None if there are no older messages.
+        """
+
+        if not self.has_older or not self.messages:
+            return None
+        return helpers.encode_cursor(self.messages[0].sent_time, self.messages[0].id)
+
+    @property
+    def newer_cursor(self):
+        """
+        The cursor for the page following the loaded messages.
+
+        Returns:
+            str or None: The cursor of the newest loaded message, or None if there are no newer messages.
+        """
+
+        if not self.has_newer or not self.messages:
+            return None
+        return helpers.encode_cursor(self.messages[-1].sent_time, self.messages[-1].id)
+
+    def _message_position(self, message_id):
+        sql = text("""SELECT m.sent_time, m.id FROM messages m WHERE m.id = :message_id AND m.thread = :thread_id""")
+        row = Database().fetch_one(sql, {"message_id": message_id, "thread_id": self.id})
+        return (row["sent_time"], row["id"]) if row else None
+
+    def _fetch_messages(self, comparison, cursor, order, limit):
+        # Only the fixed operator and direction strings above are interpolated, values are bound.
+        condition = f"AND (m.sent_time, m.id) {comparison} (:cursor_time, :cursor_id)" if comparison else ""
+        sql = text(f"""
+        SELECT m.id, m.sender, m.text, m.image_url, m.sent_time, u.username
+        FROM messages m
+        JOIN users u ON m.sender = u.id
+        WHERE m.thread = :thread_id {condition}
+        ORDER BY m.sent_time {order}, m.id {order}
+        LIMIT :limit
+        """)
+        params = {"thread_id": self.id, "limit": limit}
+        if cursor:
+            params["cursor_time"], params["cursor_id"] = cursor
+        return [Message.from_row(row, self.id, self.title) for row in Database().fetch_rows(sql, params)]
+
+    @property
+    def stats(self):
+        """
+        Aggregated statistics of the thread, loaded on first access unless prefetched.
+
+        Returns:
+            dict: The message count and last message time of the thread.
+        """
+
+        if self._stats is None:
+            loaders.prefetch_thread_stats([self])
+        return self._stats
 
     @property
     def message_count(self):
@@ -73,8 +231,18 @@ JOIN areas a on t.area = a.id WHERE m.thread = :thread_id ORDER BY m.sent_time""
             int: The count of messages within the thread.
         """
 
-        sql = text("""SELECT COUNT(*) FROM messages m WHERE m.thread = :thread_id""")
-        return self.db.fetch_one(sql, {"thread_id": self.id})["count"]
+        return self.stats["message_count"]
+
+    @property
+    def last_message_time(self):
+        """
+        The time of the last message sent in the thread.
+
+        Returns:
+            datetime or None: The time the last message was sent, or None if no messages.
+        """
+
+        return self.stats["last_message_time"]
 
     @property
     def last_message(self):
@@ -85,11 +253,10 @@ JOIN areas a on t.area = a.id WHERE m.thread = :thread_id ORDER BY m.sent_time""
             str or None: A human-readable string of the time since the last message was sent, or None if no messages.
         """
 
-        sql = text("""SELECT MAX(m.sent_time) FROM messages m WHERE m.thread = :thread_id""")
-        result = self.db.fetch_one(sql, {"thread_id": self.id})["max"]
-        if result:
-            return helpers.time_ago(result)
-        return result
+        last_message_time = self.stats["last_message_time"]
+        if last_message_time:
+            return helpers.time_ago(last_message_time)
+        return None
 
     def insert(self):
         """
@@ -102,5 +269,8 @@ JOIN areas a on t.area = a.id WHERE m.thread = :thread_id ORDER BY m.sent_time""
         """
 
         sql = text("""INSERT INTO threads (area, title, owner_id) VALUES (:area, :title, :owner_id) RETURNING id""")
-        self.id = self.db.execute(sql, {"area": self.area, "title": self.title, "owner_id": self.owner_id})["id"]
+        db = Database()
+        with db.transaction():
+            self.id = db.execute(sql, {"area": self.area, "title": self.title, "owner_id": self.owner_id})["id"]
+            stats.record_thread(self.id, self.area)
         return self
@@ -0,0 +1,200 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import text
+from ..utils.db import Database
+from ..utils import live
+
+
+# Restricts a query to the areas visible to a user: admins see every area, other users the
+# public areas and the secret areas they have been given access to. The area must be aliased
+# as "a" and the user ID bound as :user_id.
+VISIBLE_AREA_CONDITION = """
+    EXISTS (
+        SELECT 1 FROM users u
+        LEFT JOIN secret_area_privileges sap ON sap.area_id = a.id AND sap.user_id = u.id
+        WHERE u.id = :user_id AND (u.is_admin = true OR a.is_secret = false OR sap.user_id IS NOT NULL)
+    )
+"""
+
+# Restricts a query to the areas in a set from visible_areas, without repeating the join of
+# VISIBLE_AREA_CONDITION. The area must be aliased as "a" and the IDs bound as :area_ids.
+AREA_IDS_CONDITION = "a.id = ANY(:area_ids)"
+
+# The Postgres channel on which changes to the visible areas are announced, with the ID of the
+# affected user or "*" for every user.
+CHANNEL = "area_access"
+
+# The maximum number of users whose visible areas are kept by each worker process.
+CACHE_SIZE = 10000
+
+# Entries are reloaded after this many seconds even without an invalidation.
+CACHE_TTL = 300
+
+
+class VisibleAreas:
+    """
+    The areas a user may see.
+
+    Attributes:
+        is_admin (bool): Whether the user is an admin.
+        area_ids (frozenset[int]): The IDs of the visible areas.
+    """
+
+    def __init__(self, is_admin, area_ids):
+        """
+        Initializes a VisibleAreas object.
+
+        Args:
+            is_admin (bool): Whether the user is an admin.
+            area_ids (iterable[int]): The IDs of the visible areas.
+        """
+
+        self.is_admin = is_admin
+        self.area_ids = frozenset(area_ids)
+
+    def __contains__(self, area_id):
+        return area_id in self.area_ids
+
+    @property
+    def ids(self):
+        """
+        The IDs of the visible areas, for binding as :area_ids with AREA_IDS_CONDITION.
+
+        Returns:
+            list[int]: The IDs.
+        """
+
+        return list(self.area_ids)
+
+
+class AccessCache:
+    """
+    A thread-safe, size-bounded cache of the areas visible to each user, evicting the least recently used.
+
+    Entries are dropped by invalidate, which also reaches the other worker processes and nodes
+    through Postgres notifications. The cache is only used while the notification listener is
+    connected, so a missed invalidation cannot leave an entry stale for longer than CACHE_TTL.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE, ttl=CACHE_TTL):
+        """
+        Initializes an empty AccessCache object.
+
+        Args:
+            max_entries (int, optional): The maximum number of users kept. Defaults to CACHE_SIZE.
+            ttl (float, optional): Seconds after which an entry is reloaded. Defaults to CACHE_TTL.
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """
+        Returns the areas visible to a user, loading them on a miss.
+
+        Args:
+            user_id (int): The ID of the user.
+
+        Returns:
+            VisibleAreas or None: The visible areas, or None if the user does not exist.
+        """
+
+        live.broker.listen(CHANNEL, self.handle_notification)
+        if not live.broker.connected:
+            return _load(user_id)
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                return entry[0]
+            generation = self._generation
+
+        visible = _load(user_id)
+        with self._lock:
+            # An invalidation during the load may have come after the data was read.
+            if visible is not None and generation == self._generation:
+                self._entries[user_id] = (visible, now + self.ttl)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return visible
+
+    def invalidate(self, user_id=None):
+        """
+        Drops the cached areas of a user, or of every user, in this process.
+
+        Args:
+            user_id (int, optional): The ID of the user. Defaults to every user.
+        """
+
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def handle_notification(self, payload):
+        """
+        Applies an invalidation announced on CHANNEL, possibly by another process.
+
+        Args:
+            payload (str or None): The ID of the affected user, "*" for every user, or None if
+                notifications may have been missed.
+        """
+
+        self.invalidate(int(payload) if payload not in (None, "*") else None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+cache = AccessCache()
+
+
+def visible_areas(user_id):
+    """
+    Returns the areas visible to a user, computed once and cached until they change.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        VisibleAreas or None: The visible areas, or None if the user does not exist.
+    """
+
+    return cache.get(user_id)
+
+
+def invalidate(user_id=None):
+    """
+    Announces that the areas visible to a user, or to every user, have changed.
+
+    Inside a unit of work, the other processes are only told once the transaction commits.
+
+    Args:
+        user_id (int, optional): The ID of the user. Defaults to every user, for example when
+            an area is created or deleted.
+    """
+
+    cache.invalidate(user_id)
+    payload = "*" if user_id is None else str(user_id)
+    Database().execute(text("""SELECT pg_notify(:channel, :payload)"""), {"channel": CHANNEL, "payload": payload}, False)
+
+
+def _load(user_id):
+    sql = text(f"""
+        SELECT u.is_admin, ARRAY(SELECT a.id FROM areas a WHERE {VISIBLE_AREA_CONDITION}) AS area_ids
+        FROM users u
+        WHERE u.id = :user_id
+    """)
+    row = Database().fetch_one(sql, {"user_id": user_id})
+    if row is None:
+        return None
+    return VisibleAreas(row["is_admin"], row["area_ids"])
@@ -0,0 +1,187 @@
+import re
+from flask import make_response
+from sqlalchemy import text
+from ..utils.db import Database
+from ..utils import storage
+
+
+# Attachments are served by the application under this URL, named by the hash of their content,
+# and stored by the backend of app.utils.storage.
+ATTACHMENT_URL = "/attachments/"
+
+# The content behind a name never changes, so browsers and proxies may keep it for a year without revalidating.
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Attachments left without references are deleted by sweep once orphaned for this long. The
+# grace period covers the time between an upload and the insert of the message referencing it.
+ORPHAN_GRACE_SECONDS = 3600
+
+# Names are a SHA-256 hex digest, optionally followed by a variant suffix, and an extension.
+_NAME_PATTERN = re.compile(r"[0-9a-f]{64}(_[0-9a-z]+)?\.[0-9a-z]+")
+
+
+def attachment_name(image_url):
+    """
+    Extracts the name of a stored attachment from its URL.
+
+    Args:
+        image_url (str): The URL of an image attached to a message.
+
+    Returns:
+        str or None: The name of the attachment, or None if the URL is not an attachment URL,
+        like those of images uploaded before attachments were stored by content.
+    """
+
+    if not image_url or not image_url.startswith(ATTACHMENT_URL):
+        return None
+    name = image_url[len(ATTACHMENT_URL):]
+    return name if _NAME_PATTERN.fullmatch(name) else None
+
+
+def store(name, encode):
+    """
+    Stores an attachment under its content-derived name, unless an identical one is already stored.
+
+    The stored attachment starts out orphaned; it is kept once a message references it with acquire.
+
+    Args:
+        name (str): The name of the main file, derived from a hash of the uploaded content.
+        encode (callable): Returns a dictionary of file names and contents, the main file and its
+            variants. Only called if the attachment is not stored yet, so repeated uploads of the
+            same content skip the processing.
+
+    Returns:
+        str: The URL of the attachment.
+    """
+
+    # An orphaned attachment gets a new grace period, so that the sweeper does not delete it before
+    # the message is inserted. If the sweeper is deleting it right now, this waits until it is gone.
+    touch_sql = text("""
+        UPDATE attachments
+        SET orphaned_time = CASE WHEN orphaned_time IS NULL THEN NULL ELSE (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') END
+        WHERE name = :name
+        RETURNING name
+    """)
+    db = Database()
+    if db.execute(touch_sql, {"name": name}) is None:
+        files = encode()
+        backend = storage.get_backend()
+        # The main file is written last, so its presence implies that the variants are complete.
+        for file_name in sorted(files, key=lambda file_name: file_name == name):
+            backend.put(file_name, files[file_name])
+
+        sql = text("""
+            INSERT INTO attachments (name, files, size, orphaned_time)
+            VALUES (:name, :files, :size, (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'))
+            ON CONFLICT (name) DO UPDATE SET orphaned_time = CASE
+                WHEN attachments.orphaned_time IS NULL THEN NULL ELSE (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+            END
+        """)
+        db.execute(sql, {"name": name, "files": sorted(files), "size": sum(len(data) for data in files.values())}, False)
+    return f"{ATTACHMENT_URL}{name}"
+
+
+def acquire(image_url):
+    """
+    Records that a message references an attachment. Run in the unit of work inserting the message.
+
+    Args:
+        image_url (str): The URL of the attachment. URLs of other images are ignored.
+    """
+
+    name = attachment_name(image_url)
+    if name is not None:
+        sql = text("""UPDATE attachments SET ref_count = ref_count + 1, orphaned_time = NULL WHERE name = :name""")
+        Database().execute(sql, {"name": name}, False)
+
+
+def release(image_urls):
+    """
+    Records that messages no longer reference their attachments, and marks the attachments left
+    without references as orphaned. Run in the unit of work deleting the messages.
+
+    No files are deleted here, so deleting a large area costs one statement; sweep deletes the
+    files of orphaned attachments in the background.
+
+    Args:
+        image_urls (list[str]): The URLs of the images of the messages, one per message. URLs of
+            other images are ignored.
+    """
+
+    counts = {}
+    for image_url in image_urls:
+        name = attachment_name(image_url)
+        if name is not None:
+            counts[name] = counts.get(name, 0) + 1
+    if not counts:
+        return
+
+    sql = text("""
+        UPDATE attachments a
+        SET ref_count = GREATEST(a.ref_count - r.count, 0),
+            orphaned_time = CASE WHEN a.ref_count - r.count <= 0 THEN (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') END
+        FROM unnest(CAST(:names AS text[]), CAST(:counts AS integer[])) AS r(name, count)
+        WHERE a.name = r.name
+    """)
+    Database().execute(sql, {"names": list(counts), "counts": list(counts.values())}, False)
+
+
+def sweep(grace_seconds=ORPHAN_GRACE_SECONDS, batch_size=500):
+    """
+    Deletes the attachments that have been orphaned for longer than the grace period, with their files.
+
+    Each batch is its own transaction. Its rows are locked with SKIP LOCKED, so several sweepers
+    can run at once, and the files are deleted before the rows, so a failed batch is retried by
+    the next sweep. Files that no longer exist are ignored.
+
+    Args:
+        grace_seconds (int, optional): How long an attachment stays orphaned before it is deleted.
+            Defaults to ORPHAN_GRACE_SECONDS.
+        batch_size (int, optional): The maximum number of attachments deleted per transaction. Defaults to 500.
+
+    Returns:
+        tuple: The number of deleted attachments and the number of bytes reclaimed.
+    """
+
+    select_sql = text("""
+        SELECT a.name, a.files, a.size FROM attachments a
+        WHERE a.orphaned_time < (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') - make_interval(secs => :grace_seconds)
+            AND a.ref_count = 0
+        ORDER BY a.orphaned_time
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    """)
+    delete_sql = text("""DELETE FROM attachments WHERE name = ANY(:names)""")
+
+    db = Database()
+    backend = storage.get_backend()
+    deleted = reclaimed = 0
+    while True:
+        with db.transaction():
+            rows = db.fetch_all(select_sql, {"grace_seconds": grace_seconds, "batch_size": batch_size}).all()
+            if rows:
+                backend.delete([file_name for row in rows for file_name in row["files"]])
+                db.execute(delete_sql, {"names": [row["name"] for row in rows]}, False)
+        deleted += len(rows)
+        reclaimed += sum(row["size"] for row in rows)
+        if len(rows) < batch_size:
+            return deleted, reclaimed
+
+
+def send(name):
+    """
+    Creates the response serving a stored file from the storage backend.
+
+    Args:
+        name (str): The name of the file.
+
+    Returns:
+        Response: The response, or a 404 response if the name is not a valid attachment name.
+    """
+
+    if not _NAME_PATTERN.fullmatch(name):
+        return make_response("", 404)
+    response = storage.get_backend().send(name)
+    if response.status_code in (200, 301):
+        response.headers["Cache-Control"] = CACHE_CONTROL
+    return response
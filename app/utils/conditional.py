@@ -0,0 +1,173 @@
+import hashlib
+import time
+from flask import make_response, request, session
+from sqlalchemy import text
+from ..utils.db import Database
+from ..utils import access
+from ..utils.access import AREA_IDS_CONDITION
+
+
+# Pages contain relative times and a CSRF token, which go stale even when the data does not
+# change, so validators also roll over after this many seconds.
+VALIDATOR_LIFETIME = 300
+
+_UNREAD_NOTIFICATIONS = """
+    (SELECT COUNT(*) FROM notifications n WHERE n.user_id = :user_id AND NOT n.is_read {condition}) AS unread
+"""
+
+
+def index_version(user_id):
+    """
+    Reads the version of the index page: the statistics of every area visible to the user and
+    the user's unread notification count.
+
+    Args:
+        user_id (int): The ID of the user viewing the page.
+
+    Returns:
+        str or None: The version of the page, or None if the user does not exist.
+    """
+
+    visible = access.visible_areas(user_id)
+    if visible is None:
+        return None
+    sql = text(f"""
+        SELECT md5(string_agg(
+                   concat_ws(':', a.id, s.thread_count, s.message_count, s.last_message_id), ',' ORDER BY a.id
+               )) AS areas,
+               {_UNREAD_NOTIFICATIONS.format(condition="")}
+        FROM areas a
+        LEFT JOIN area_stats s ON s.area_id = a.id
+        WHERE {AREA_IDS_CONDITION}
+    """)
+    return _version(Database().fetch_one(sql, {"area_ids": visible.ids, "user_id": user_id}))
+
+
+def area_version(area_id, user_id):
+    """
+    Reads the version of an area page: the statistics of the area, the latest thread activity,
+    the access list and the user's unread notification count.
+
+    Args:
+        area_id (int): The ID of the area.
+        user_id (int): The ID of the user viewing the page.
+
+    Returns:
+        str or None: The version of the page, or None if the area does not exist or is not visible to the user.
+    """
+
+    visible = access.visible_areas(user_id)
+    if visible is None or area_id not in visible:
+        return None
+    sql = text(f"""
+        SELECT s.thread_count, s.message_count, s.last_message_id,
+               (SELECT MAX(ts.last_activity) FROM thread_stats ts WHERE ts.area_id = a.id) AS last_activity,
+               (SELECT string_agg(sap.user_id::text, ',' ORDER BY sap.user_id)
+                FROM secret_area_privileges sap WHERE sap.area_id = a.id) AS access_list,
+               {_UNREAD_NOTIFICATIONS.format(condition="")}
+        FROM areas a
+        LEFT JOIN area_stats s ON s.area_id = a.id
+        WHERE a.id = :area_id
+    """)
+    return _version(Database().fetch_one(sql, {"area_id": area_id, "user_id": user_id}))
+
+
+def thread_version(thread_id, user_id):
+    """
+    Reads the version of a thread page: the last message, message count and edit counter of the
+    thread, the user's subscription and the user's unread notification count.
+
+    Notifications about the thread itself are not counted, as viewing the thread marks them read.
+
+    Args:
+        thread_id (int): The ID of the thread.
+        user_id (int): The ID of the user viewing the page.
+
+    Returns:
+        str or None: The version of the page, or None if the thread does not exist.
+    """
+
+    sql = text(f"""
+        SELECT s.last_message_id, s.message_count, s.edit_count,
+               EXISTS (
+                   SELECT 1 FROM thread_subscriptions ts WHERE ts.thread_id = t.id AND ts.user_id = :user_id
+               ) AS is_subscribed,
+               {_UNREAD_NOTIFICATIONS.format(condition="AND n.thread_id != t.id")}
+        FROM threads t
+        LEFT JOIN thread_stats s ON s.thread_id = t.id
+        WHERE t.id = :thread_id
+    """)
+    return _version(Database().fetch_one(sql, {"thread_id": thread_id, "user_id": user_id}))
+
+
+def page_etag(version):
+    """
+    Derives the ETag of a page for the current user from its version.
+
+    Args:
+        version (str or None): The version of the page.
+
+    Returns:
+        str or None: The ETag, or None if the response must not be validated, because the page
+        does not exist or flashed messages are waiting to be shown.
+    """
+
+    if version is None or session.get("_flashes"):
+        return None
+    lifetime_window = int(time.time() // VALIDATOR_LIFETIME)
+    key = f"{session.get('user_id')}|{lifetime_window}|{request.full_path}|{version}"
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def is_not_modified(etag):
+    """
+    Checks whether the client already has the current version of the page.
+
+    Args:
+        etag (str or None): The ETag of the page.
+
+    Returns:
+        bool: True if the request's If-None-Match header contains the ETag.
+    """
+
+    return etag is not None and request.if_none_match.contains_weak(etag)
+
+
+def not_modified(etag):
+    """
+    Creates a 304 Not Modified response.
+
+    Args:
+        etag (str): The ETag of the page.
+
+    Returns:
+        Response: The empty response.
+    """
+
+    return with_etag(make_response("", 304), etag)
+
+
+def with_etag(response, etag):
+    """
+    Adds the ETag to a page and makes the browser revalidate it on every visit.
+
+    Args:
+        response (Response or str): The response or rendered page.
+        etag (str or None): The ETag of the page, or None to leave the response unvalidated.
+
+    Returns:
+        Response: The response with ETag and Cache-Control headers.
+    """
+
+    response = make_response(response)
+    if etag is not None:
+        # Weak, as the page embeds a CSRF token that differs between renders of the same version.
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def _version(row):
+    if row is None:
+        return None
+    return "|".join(str(value) for value in row.values())
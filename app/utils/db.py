@@ -1,7 +1,10 @@
+from contextlib import contextmanager
 from os import getenv
-from threading import Lock
+from threading import Lock, local
+from flask import g, has_app_context
 from sqlalchemy import create_engine, text
 from ..utils import helpers
+from ..utils import migrations
 
 
 class Database:
@@ -9,88 +12,54 @@ class Database:
     A singleton class that represents the database connection.
 
     This class ensures that only one instance of the database connection is created
-    (singleton pattern). It handles the creation, initialization, and management of
-    database tables and provides methods for executing and fetching data from the database.
+    (singleton pattern). On creation it verifies that the schema is at the version of the
+    latest migration, and it provides methods for executing and fetching data from the database.
 
     Attributes:
         _instance (Database): A static instance of the Database class.
         _lock (Lock): A threading lock to ensure thread-safe singleton instantiation.
         _engine (Engine): An SQLAlchemy engine instance for database connections.
+        _local (local): Thread-local storage holding the connection of a unit of work outside of a request.
     """
 
     _instance = None
     _lock = Lock()
     _engine = None
+    _local = local()
 
     def __new__(cls):
+        # The instance is only published once fully initialized, so no lock is needed to read it.
+        if cls._instance is not None:
+            return cls._instance
+
         with cls._lock:
             if cls._instance is None:
-                cls._instance = super(Database, cls).__new__(cls)
-                cls._instance._engine = create_engine(getenv("DB_URL"))
-                if getenv("ENV") == "TEST" or True:
-                    cls._instance._drop_tables()  # Drop tables if in test environment
-                cls._instance._initialize_tables()
-                cls._instance._create_admin_user()
+                instance = super(Database, cls).__new__(cls)
+                instance._engine = create_engine(getenv("DB_URL"))
+                if getenv("ENV") == "TEST":
+                    # Tests start from an empty database on every run.
+                    instance._drop_tables()
+                    migrations.upgrade(instance._engine)
+                instance._check_schema_version()
+                instance._create_admin_user()
+                cls._instance = instance
         return cls._instance
 
     def _drop_tables(self):
         drop_tables_sql = """
-        DROP TABLE IF EXISTS messages, threads, areas, users, secret_area_privileges CASCADE;
+        DROP TABLE IF EXISTS messages, threads, areas, users, secret_area_privileges, thread_subscriptions,
+            notifications, area_stats, thread_stats, attachments, rate_limits, schema_migrations CASCADE;
         """
         with self._engine.connect() as connection:
             with connection.begin():
                 connection.execute(text(drop_tables_sql))
 
-    def _initialize_tables(self):
-        table_creation_sql = """
-        CREATE TABLE IF NOT EXISTS areas (
-            id SERIAL PRIMARY KEY,
-            topic TEXT NOT NULL,
-            is_secret boolean NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            username TEXT NOT NULL UNIQUE,
-            password bytea NOT NULL,
-            is_admin boolean NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS threads (
-            id SERIAL PRIMARY KEY,
-            area integer NOT NULL REFERENCES areas(id) ON DELETE CASCADE,
-            title TEXT NOT NULL,
-            owner_id integer NOT NULL REFERENCES users(id)
-        );
-        CREATE TABLE IF NOT EXISTS messages (
-            id SERIAL PRIMARY KEY,
-            thread integer NOT NULL REFERENCES threads(id) ON DELETE CASCADE,
-            sender integer NOT NULL REFERENCES users(id),
-            text TEXT NOT NULL,
-            image_url TEXT,
-            sent_time TIMESTAMP WITHOUT TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
-        );
-        CREATE TABLE IF NOT EXISTS secret_area_privileges (
-            id SERIAL PRIMARY KEY,
-            area_id integer NOT NULL REFERENCES areas(id) ON DELETE CASCADE,
-            user_id integer NOT NULL UNIQUE REFERENCES users(id)
-        );
-        CREATE TABLE IF NOT EXISTS thread_subscriptions (
-            id SERIAL PRIMARY KEY,
-            thread_id integer NOT NULL REFERENCES threads(id) ON DELETE CASCADE,
-            user_id integer NOT NULL REFERENCES users(id),
-            UNIQUE (thread_id, user_id)
-        );
-        CREATE TABLE IF NOT EXISTS notifications (
-            id SERIAL PRIMARY KEY,
-            user_id integer NOT NULL REFERENCES users(id),
-            thread_id integer NOT NULL REFERENCES threads(id) ON DELETE CASCADE,
-            sender_id integer NOT NULL REFERENCES users(id),
-            message TEXT NOT NULL,
-            sent_time TIMESTAMP WITHOUT TIME ZONE DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
-        );
-        """
-        with self._engine.connect() as connection:
-            with connection.begin():
-                connection.execute(text(table_creation_sql))
+    def _check_schema_version(self):
+        # Schema changes are applied with "flask db upgrade", startup only verifies the version.
+        version = migrations.current_version(self._engine)
+        expected = migrations.latest_version()
+        if version != expected:
+            raise RuntimeError(f"Database schema is at version {version}, expected {expected}. Run 'flask db upgrade'.")
 
     def _create_admin_user(self):
         admin_creation_sql = text("""INSERT INTO users (username, password, is_admin) VALUES (:username, :password, :is_admin) ON CONFLICT (username) DO NOTHING""")
@@ -98,6 +67,61 @@ class Database:
             with connection.begin():
                 connection.execute(admin_creation_sql, {"username": "admin", "password": helpers.hash_password(getenv("ADMIN_PASSWORD")), "is_admin": True})
 
+    def _state(self):
+        # During a request the connection is kept on flask.g, elsewhere on the current thread.
+        return g if has_app_context() else self._local
+
+    @contextmanager
+    def _connection(self):
+        # Connections are in autocommit mode outside of a unit of work, so that single statements
+        # need no BEGIN and COMMIT round trips and reads do not keep a transaction open.
+        state = self._state()
+        connection = getattr(state, "db_connection", None)
+        if connection is not None:
+            yield connection
+        elif has_app_context():
+            # One connection per request, returned to the pool by close_connection.
+            state.db_connection = self._engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+            yield state.db_connection
+        else:
+            with self._engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+                yield connection
+
+    def _in_transaction(self):
+        return getattr(self._state(), "db_transaction", False)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the statements executed inside the block as a single unit of work.
+
+        While the block is active, fetch_all, fetch_one and execute calls made by the same request
+        (or thread, outside of a request) run in one transaction, which is committed once when the
+        block exits and rolled back if it raises. Nested blocks join the outermost transaction.
+        """
+        state = self._state()
+        if getattr(state, "db_transaction", False):
+            yield
+            return
+
+        with self._connection() as connection:
+            scoped = getattr(state, "db_connection", None) is connection
+            state.db_connection = connection
+
+            # Leave autocommit mode for the duration of the unit of work.
+            if connection.in_transaction():
+                connection.commit()
+            connection.execution_options(isolation_level=self._engine.dialect.default_isolation_level)
+            state.db_transaction = True
+            try:
+                with connection.begin():
+                    yield
+            finally:
+                state.db_transaction = False
+                connection.execution_options(isolation_level="AUTOCOMMIT")
+                if not scoped:
+                    state.db_connection = None
+
     def fetch_all(self, sql, params=None):
         """
         Executes a SQL query and returns all results.
@@ -109,9 +133,46 @@ class Database:
         Returns:
             ResultProxy: A list of dictionaries containing the query results.
         """
-        with self._engine.connect() as connection:
+        with self._connection() as connection:
             return connection.execute(sql, params).mappings()
 
+    def fetch_rows(self, sql, params=None):
+        """
+        Executes a SQL query and returns all results as tuples.
+
+        Rows are not converted to dictionaries, so this suits queries returning many rows that
+        are unpacked by position, like those loading a page of messages.
+
+        Args:
+            sql (str): The SQL query to be executed.
+            params (dict, optional): Parameters to be used in the SQL query.
+
+        Returns:
+            Result: The query results, each row a tuple of the selected columns in order.
+        """
+        with self._connection() as connection:
+            return connection.execute(sql, params)
+
+    def stream_rows(self, sql, params=None, batch_size=500):
+        """
+        Executes a SQL query and yields its results as tuples, fetched in batches from a server-side cursor.
+
+        Only one batch is held in memory at a time, however many rows the query returns. The
+        cursor needs a transaction, so the query runs in a unit of work that stays open until the
+        rows are exhausted or the generator is closed.
+
+        Args:
+            sql (str): The SQL query to be executed.
+            params (dict, optional): Parameters to be used in the SQL query.
+            batch_size (int, optional): The number of rows fetched at a time. Defaults to 500.
+
+        Yields:
+            Row: Each row of the query results, a tuple of the selected columns in order.
+        """
+        with self.transaction():
+            with self._connection() as connection:
+                yield from connection.execute(sql.execution_options(yield_per=batch_size), params)
+
     def fetch_one(self, sql, params=None):
         """
         Executes a SQL query and returns the first result.
@@ -123,9 +184,11 @@ class Database:
         Returns:
             dict: A dictionary containing the first row of the query results.
         """
-        with self._engine.connect() as connection:
+        with self._connection() as connection:
+            if self._in_transaction():
+                return connection.execute(sql, params).mappings().first()
             try:
-                return next(connection.execute(sql, params).mappings())
+                return connection.execute(sql, params).mappings().first()
             except Exception:
                 return None
 
@@ -141,11 +204,30 @@ class Database:
         Returns:
             dict or None: A dictionary containing the first row of the query results if return_result is True, else None.
         """
-        with self._engine.connect() as connection:
-            with connection.begin():
-                try:
-                    result = connection.execute(sql, params)
-                    if return_result:
-                        return next(result.mappings())
-                except Exception:
-                    return None
+        with self._connection() as connection:
+            if self._in_transaction():
+                # Inside a unit of work errors propagate so that the whole transaction is rolled back.
+                result = connection.execute(sql, params)
+                return result.mappings().first() if return_result else None
+
+            try:
+                result = connection.execute(sql, params)
+                if return_result:
+                    return result.mappings().first()
+            except Exception:
+                return None
+
+
+def close_connection(exception=None):
+    """
+    Returns the connection used by the current request to the pool.
+
+    Registered as an app context teardown function.
+
+    Args:
+        exception (Exception, optional): The exception that ended the request, if any.
+    """
+
+    connection = g.pop("db_connection", None)
+    if connection is not None:
+        connection.close()
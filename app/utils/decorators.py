@@ -1,6 +1,7 @@
 from functools import wraps
-from flask import request, session, redirect, url_for, flash
+from flask import request, session, redirect, url_for, flash, jsonify
 from ..utils import helpers
+from ..utils import ratelimit
 
 
 def login_required(f):
@@ -24,6 +25,64 @@ def login_required(f):
     return _login_required
 
 
+def api_login_required(f):
+    """
+    Decorator to enforce user login for JSON API routes.
+
+    Unlike login_required, a request without a logged in user gets a 401 response with a JSON
+    error instead of a redirect to the login page.
+
+    Args:
+        f (function): The view function to be wrapped by the decorator.
+
+    Returns:
+        function: The decorated view function which includes login check logic.
+    """
+    @wraps(f)
+    def _api_login_required(*args, **kwargs):
+        if "user_id" not in session:
+            return jsonify(error="Login required"), 401
+        return f(*args, **kwargs)
+    return _api_login_required
+
+
+def rate_limited(name, limit, period, scope="ip", methods=("POST",)):
+    """
+    Decorator factory to limit how often a client may call a route.
+
+    The check runs before the view and before any decorators below it, so a rejected request
+    gets a 429 response without touching bcrypt, Turnstile or the database beyond the limiter.
+
+    Args:
+        name (str): The name of the limit, keeping the counts of different routes apart.
+        limit (int): The number of requests allowed per period, and the allowed burst.
+        period (float): The period, in seconds.
+        scope (str, optional): What is counted: "ip" for the client's address, "user" for the
+            logged in user (the address for anonymous requests), or "username" for the username
+            submitted in the form. Defaults to "ip".
+        methods (tuple, optional): The HTTP methods that are counted. Defaults to ("POST",).
+
+    Returns:
+        function: The decorator.
+    """
+    def decorator(f):
+        @wraps(f)
+        def _rate_limited(*args, **kwargs):
+            if request.method in methods:
+                if scope == "username":
+                    client = request.form.get("username", "").lower()
+                elif scope == "user" and "user_id" in session:
+                    client = f"user:{session['user_id']}"
+                else:
+                    client = request.remote_addr
+                retry_after = ratelimit.hit(f"{name}:{scope}:{client}", limit, period)
+                if retry_after:
+                    return ratelimit.too_many_requests(retry_after)
+            return f(*args, **kwargs)
+        return _rate_limited
+    return decorator
+
+
 def captcha_required(f):
     """
     Decorator to enforce CAPTCHA validation on form submissions.
@@ -0,0 +1,181 @@
+from datetime import datetime
+from sqlalchemy import text
+from ..utils import helpers
+from ..utils import uploads
+from ..utils.db import Database
+from ..utils import access
+
+
+# The default and maximum number of items returned by one incremental fetch.
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+def message_data(row):
+    """
+    Converts a message row into a JSON-serializable dictionary.
+
+    Args:
+        row (dict): A row with the id, sender, sender_name, text, image_url and sent_time of a message.
+
+    Returns:
+        dict: The message, with its times as ISO 8601 strings.
+    """
+
+    return {
+        "id": row["id"],
+        "sender": row["sender"],
+        "sender_name": row["sender_name"],
+        "text": row["text"],
+        "image_url": row["image_url"],
+        "thumbnail_url": uploads.thumbnail_url(row["image_url"]) if row["image_url"] else None,
+        "thumbnail_srcset": uploads.thumbnail_srcset(row["image_url"]) if row["image_url"] else None,
+        "sent_time": helpers.iso_time(row["sent_time"]),
+    }
+
+
+def fetch_messages_after(thread_id, after_id, limit=DEFAULT_LIMIT):
+    """
+    Fetches the messages of a thread with an ID greater than the given one, without access checks.
+
+    Args:
+        thread_id (int): The ID of the thread.
+        after_id (int): The ID of the last message the client has.
+        limit (int, optional): The maximum number of messages. Defaults to DEFAULT_LIMIT.
+
+    Returns:
+        tuple: A list of message dictionaries, oldest first, and whether there are more messages.
+    """
+
+    sql = text("""
+        SELECT m.id, m.sender, u.username AS sender_name, m.text, m.image_url, m.sent_time
+        FROM messages m
+        JOIN users u ON m.sender = u.id
+        WHERE m.thread = :thread_id AND m.id > :after_id
+        ORDER BY m.id
+        LIMIT :limit
+    """)
+    rows = Database().fetch_all(sql, {"thread_id": thread_id, "after_id": after_id, "limit": limit + 1}).all()
+    return [message_data(row) for row in rows[:limit]], len(rows) > limit
+
+
+def thread_messages_after(thread_id, user_id, after_id=0, limit=DEFAULT_LIMIT):
+    """
+    Fetches the messages posted to a thread after the given message, if the user may read the thread.
+
+    The access check and the ID of the newest message are read with a single query, so a poll
+    that finds nothing new costs one index lookup.
+
+    Args:
+        thread_id (int): The ID of the thread.
+        user_id (int): The ID of the user making the request.
+        after_id (int, optional): The ID of the last message the client has. Defaults to 0.
+        limit (int, optional): The maximum number of messages. Defaults to DEFAULT_LIMIT.
+
+    Returns:
+        tuple or None: A list of message dictionaries and whether there are more messages, or None
+        if the thread does not exist or is not visible to the user.
+    """
+
+    visible = access.visible_areas(user_id)
+    if visible is None:
+        return None
+    sql = text("""
+        SELECT t.area, s.last_message_id
+        FROM threads t
+        LEFT JOIN thread_stats s ON s.thread_id = t.id
+        WHERE t.id = :thread_id
+    """)
+    head = Database().fetch_one(sql, {"thread_id": thread_id})
+    if head is None or head["area"] not in visible:
+        return None
+    if head["last_message_id"] is None or head["last_message_id"] <= after_id:
+        return [], False
+    return fetch_messages_after(thread_id, after_id, limit)
+
+
+def parse_since(value):
+    """
+    Parses the position from which changed threads are listed.
+
+    Args:
+        value (str): A cursor returned by area_threads_since, or an ISO 8601 timestamp. A timestamp
+            with an offset or a "Z" suffix is converted to the server's local time, which the
+            activity times are stored in; one without is taken to be in local time already.
+
+    Returns:
+        tuple or None: A (time, thread_id) pair, or None if the value is invalid.
+    """
+
+    cursor = helpers.decode_cursor(value)
+    if cursor:
+        return cursor
+    try:
+        since_time = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if since_time.tzinfo is not None:
+        since_time = since_time.astimezone().replace(tzinfo=None)
+    return since_time, 0
+
+
+def area_threads_since(area_id, user_id, since=None, limit=DEFAULT_LIMIT):
+    """
+    Fetches the threads of an area with activity after the given position, if the user may see the area.
+
+    Threads are ordered by (last_activity, id), so a client can page through the changes by passing
+    the returned cursor back. The access check and the latest activity of the area are read with a
+    single query, so a poll that finds nothing new costs one index lookup.
+
+    Args:
+        area_id (int): The ID of the area.
+        user_id (int): The ID of the user making the request.
+        since (tuple, optional): A (time, thread_id) pair from parse_since. Defaults to the beginning.
+        limit (int, optional): The maximum number of threads. Defaults to DEFAULT_LIMIT.
+
+    Returns:
+        tuple or None: A list of thread dictionaries, whether there are more threads and the cursor
+        to continue from, or None if the area does not exist or is not visible to the user.
+    """
+
+    visible = access.visible_areas(user_id)
+    if visible is None or area_id not in visible:
+        return None
+    head_sql = text("""
+        SELECT (SELECT MAX(s.last_activity) FROM thread_stats s WHERE s.area_id = a.id) AS last_activity
+        FROM areas a
+        WHERE a.id = :area_id
+    """)
+    db = Database()
+    head = db.fetch_one(head_sql, {"area_id": area_id})
+    if head is None:
+        return None
+
+    since_time, since_id = since or (datetime.min, 0)
+    cursor = helpers.encode_cursor(since_time, since_id)
+    if head["last_activity"] is None or head["last_activity"] < since_time:
+        return [], False, cursor
+
+    sql = text("""
+        SELECT t.id, t.title, t.owner_id, s.message_count, s.last_message_time, s.last_activity
+        FROM thread_stats s
+        JOIN threads t ON t.id = s.thread_id
+        WHERE s.area_id = :area_id AND (s.last_activity, s.thread_id) > (:since_time, :since_id)
+        ORDER BY s.last_activity, s.thread_id
+        LIMIT :limit
+    """)
+    rows = db.fetch_all(sql, {"area_id": area_id, "since_time": since_time, "since_id": since_id, "limit": limit + 1}).all()
+    threads = [
+        {
+            "id": row["id"],
+            "title": row["title"],
+            "owner_id": row["owner_id"],
+            "message_count": row["message_count"],
+            "last_message_time": row["last_message_time"].isoformat() if row["last_message_time"] else None,
+            "last_activity": row["last_activity"].isoformat(),
+        }
+        for row in rows[:limit]
+    ]
+    if threads:
+        cursor = helpers.encode_cursor(rows[len(threads) - 1]["last_activity"], threads[-1]["id"])
+    return threads, len(rows) > limit, cursor
@@ -0,0 +1,184 @@
+from collections import OrderedDict
+from threading import Lock
+from flask import Response, render_template, stream_template
+from markupsafe import Markup
+
+
+# The maximum number of rendered fragments kept by each worker process.
+CACHE_SIZE = 1000
+
+# Streamed pages are sent in chunks of about this many characters, rather than one write per template statement.
+STREAM_CHUNK_SIZE = 16384
+
+
+class FragmentCache:
+    """
+    A thread-safe, size-bounded cache of rendered template fragments, evicting the least recently used.
+
+    Keys include the version of the data a fragment was rendered from, so changed data is never
+    served from the cache and stale entries simply age out. Fragments must not depend on the
+    user viewing them.
+
+    Attributes:
+        max_entries (int): The maximum number of fragments kept.
+        hits (int): The number of lookups answered from the cache.
+        misses (int): The number of lookups that rendered the fragment.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE):
+        """
+        Initializes an empty FragmentCache object.
+
+        Args:
+            max_entries (int, optional): The maximum number of fragments kept. Defaults to CACHE_SIZE.
+        """
+
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def render(self, key, template_name, load_context):
+        """
+        Returns the cached fragment for the key, loading its data and rendering it on a miss.
+
+        Args:
+            key (tuple): The cache key, including the version of the rendered data.
+            template_name (str): The template rendering the fragment.
+            load_context (callable): Returns the variables passed to the template. Only called on a miss,
+                so the queries loading the data are skipped on a hit.
+
+        Returns:
+            Markup: The rendered fragment.
+        """
+
+        with self._lock:
+            fragment = self._entries.get(key)
+            if fragment is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return fragment
+
+        # Rendered outside of the lock; two requests missing the same key both render it, which is harmless.
+        fragment = Markup(render_template(template_name, **load_context()))
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = fragment
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return fragment
+
+    def clear(self):
+        """
+        Removes all cached fragments.
+        """
+
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+cache = FragmentCache()
+
+
+def message_list(thread, before=None, after=None, around=None, first=False):
+    """
+    Renders one page of a thread's messages, loading them only if the page is not cached.
+
+    Args:
+        thread (Thread): The thread, loaded with create_from_db so that its version is set.
+        before (str, optional): Cursor of a message; the page of messages preceding it.
+        after (str, optional): Cursor of a message; the page of messages following it.
+        around (int, optional): ID of a message; the page containing it.
+        first (bool, optional): If true, the oldest page. Defaults to False.
+
+    Returns:
+        Markup: The rendered message list.
+    """
+
+    def load_context():
+        return {"thread": thread.load_messages(before=before, after=after, around=around, first=first)}
+
+    if thread.version is None or thread.version[1] is None:
+        # Without statistics there is no version to key the page by.
+        return Markup(render_template("fragments/message_list.html", **load_context()))
+    key = ("messages", thread.id, thread.version, before, after, around, first)
+    return cache.render(key, "fragments/message_list.html", load_context)
+
+
+def thread_list(area, after=None):
+    """
+    Renders one page of an area's threads, loading them only if the page is not cached.
+
+    Args:
+        area (Area): The area, loaded with create_from_db so that its version is set.
+        after (str, optional): Cursor of a thread; the page of threads following it.
+
+    Returns:
+        Markup: The rendered thread list.
+    """
+
+    def load_context():
+        return {"area": area.load_threads(after=after), "after": after}
+
+    if area.version is None:
+        return Markup(render_template("fragments/thread_list.html", **load_context()))
+    key = ("threads", area.id, area.version, after)
+    return cache.render(key, "fragments/thread_list.html", load_context)
+
+
+def area_list(areas):
+    """
+    Renders the cards of a list of areas with their statistics.
+
+    Args:
+        areas (list[Area]): The areas, with statistics prefetched.
+
+    Returns:
+        Markup: The rendered area cards.
+    """
+
+    key = ("areas",) + tuple((area.id, area.thread_count, area.message_count, area.last_message_time) for area in areas)
+    return cache.render(key, "fragments/area_list.html", lambda: {"areas": areas})
+
+
+def stream_page(template_name, **context):
+    """
+    Renders a page while it is being sent, for pages too large to build in memory.
+
+    The template is rendered as the client reads the response, so it can iterate over
+    generators reading rows from server-side cursors: the first bytes are sent before the last
+    rows are read, and memory use does not depend on the size of the page. The request context
+    stays available to the template until the page is complete.
+
+    Args:
+        template_name (str): The template rendering the page.
+        **context: The variables passed to the template.
+
+    Returns:
+        Response: The streamed response.
+    """
+
+    # stream_template keeps the request context for the generator, so it is called while the request is active.
+    rendered = stream_template(template_name, **context)
+
+    def chunks():
+        buffered, size = [], 0
+        try:
+            for chunk in rendered:
+                buffered.append(chunk)
+                size += len(chunk)
+                if size >= STREAM_CHUNK_SIZE:
+                    yield "".join(buffered)
+                    buffered, size = [], 0
+            if buffered:
+                yield "".join(buffered)
+        finally:
+            # A client that disconnects closes this generator; the cursors read by the template are closed with it.
+            rendered.close()
+
+    return Response(chunks(), mimetype="text/html", headers={"X-Accel-Buffering": "no"})
@@ -1,15 +1,24 @@
-from datetime import datetime
-import os
+from datetime import datetime, timedelta
 from os import getenv
 from sqlalchemy import text
-import bcrypt
-from zxcvbn import zxcvbn
-import requests
 from flask import session
 from ..utils.db import Database
+from ..utils import loaders
+from ..utils import access
+from ..utils import stats
+from ..utils import search
+from ..utils import live
+from ..utils import passwords
+from ..utils import turnstile
+from ..utils import attachments
+from ..utils import uploads
 from ..models.area import Area, Thread
 
 
+# The number of notifications shown on one page of the notifications view.
+NOTIFICATIONS_PER_PAGE = 30
+
+
 def get_areas(user_id):
     """
     Fetches a list of areas accessible to a specific user.
@@ -23,19 +32,20 @@ def get_areas(user_id):
 
     areas: list[Area] = []
 
-    sql = text("""
+    visible = access.visible_areas(user_id)
+    if visible is None:
+        return areas
+
+    sql = text(f"""
         SELECT a.id, a.topic, a.is_secret
         FROM areas a
-        LEFT JOIN secret_area_privileges sap ON a.id = sap.area_id AND sap.user_id = :user_id
-        INNER JOIN users u ON u.id = :user_id
-        WHERE u.is_admin = true OR a.is_secret = false OR sap.user_id IS NOT NULL
+        WHERE {access.AREA_IDS_CONDITION}
     """)
 
-    for result in Database().fetch_all(sql, {"user_id": user_id}):
-        area = Area(result["topic"], result["is_secret"], result["id"])
-        areas.append(area)
+    for area_id, topic, is_secret in Database().fetch_rows(sql, {"area_ids": visible.ids}):
+        areas.append(Area(topic, is_secret, area_id))
 
-    return areas
+    return loaders.prefetch_area_stats(areas)
 
 
 def username_exists(username):
@@ -55,13 +65,16 @@ def username_exists(username):
 
 def verify_login(request):
     """
-    Verifies user login credentials.
+    Verifies user login credentials, and rehashes the password if the bcrypt cost has changed.
 
     Args:
         request (Request): The Flask request object containing form data.
 
     Returns:
         tuple: A tuple containing user ID and role if credentials are valid, otherwise (None, None).
+
+    Raises:
+        PoolBusyError: If password hashing is saturated.
     """
 
     username = request.form["username"]
@@ -72,24 +85,36 @@ def verify_login(request):
         return (None, None)
 
     # Check password validity with bcrypt and return user details if authentication succeeds.
-    if bcrypt.checkpw(request.form["password"].encode('utf-8'), result["password"].tobytes()):
-        return (result["id"], "admin" if result["is_admin"] else "user")
+    hashed = result["password"].tobytes()
+    if not passwords.check_password(request.form["password"], hashed):
+        return (None, None)
 
-    return (None, None)
+    if passwords.needs_rehash(hashed):
+        try:
+            update_sql = text("""UPDATE users SET password = :password WHERE id = :user_id""")
+            params = {"password": passwords.hash_password(request.form["password"]), "user_id": result["id"]}
+            Database().execute(update_sql, params, False)
+        except passwords.PoolBusyError:
+            # The login still succeeds; the password is rehashed on a later login.
+            pass
+    return (result["id"], "admin" if result["is_admin"] else "user")
 
 
 def hash_password(password):
     """
-    Hashes a password using bcrypt.
+    Hashes a password using bcrypt, at the cost configured with BCRYPT_ROUNDS.
 
     Args:
         password (str): The password to hash.
 
     Returns:
         str: The hashed password.
+
+    Raises:
+        PoolBusyError: If password hashing is saturated.
     """
 
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    return passwords.hash_password(password)
 
 
 def is_password_secure(password):
@@ -101,9 +126,12 @@ def is_password_secure(password):
 
     Returns:
         bool: True if the password is considered secure, False otherwise.
+
+    Raises:
+        PoolBusyError: If password hashing is saturated.
     """
 
-    return zxcvbn(password)["score"] >= 4
+    return passwords.password_score(password) >= 4
 
 
 def verify_turnstile(request):
@@ -120,19 +148,9 @@ def verify_turnstile(request):
     if getenv("USE_TURNSTILE", "") != "True":
         return True
 
-    # Prepare data for Turnstile verification request.
-    turnstile_response = request.form.get("cf-turnstile-response", "")
-    remote_ip = request.form.get("CF-Connecting-IP", "")
-    data = {
-        'secret': getenv("TURNSTILE_SECRET", ""),
-        'response': turnstile_response,
-        'remoteip': remote_ip
-    }
-
-    # Send verification request and interpret the outcome.
-    response = requests.post('https://challenges.cloudflare.com/turnstile/v0/siteverify', data=data).json()
-
-    return response.get('success')
+    # Cloudflare passes the client address in a header when the site is proxied through it.
+    remote_ip = request.headers.get("CF-Connecting-IP", request.remote_addr)
+    return turnstile.verify(request.form.get("cf-turnstile-response", ""), remote_ip, request.endpoint)
 
 
 def time_ago(date):
@@ -170,6 +188,59 @@ def time_ago(date):
         return f"{int(years)} years ago"
 
 
+def iso_time(date):
+    """
+    Formats a time for a <time datetime> attribute, which the browser renders as relative time.
+
+    Times are stored in the server's local time without a time zone, so the server's UTC offset
+    is added for the browser to interpret them correctly.
+
+    Args:
+        date (datetime): The time to format.
+
+    Returns:
+        str: The time in ISO 8601 format with a UTC offset.
+    """
+
+    return date.astimezone().isoformat()
+
+
+def encode_cursor(sort_time, row_id):
+    """
+    Encodes a keyset pagination cursor from a row's sort time and ID.
+
+    Args:
+        sort_time (datetime): The timestamp the rows are ordered by.
+        row_id (int): The ID of the row, breaking ties between equal timestamps.
+
+    Returns:
+        str: The cursor, safe to be used in a URL query string.
+    """
+
+    return f"{sort_time.isoformat()}_{row_id}"
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a keyset pagination cursor created with encode_cursor.
+
+    Args:
+        cursor (str or None): The cursor to decode.
+
+    Returns:
+        tuple or None: A (datetime, int) tuple, or None if the cursor is missing or malformed.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        sort_time, row_id = cursor.rsplit("_", 1)
+        return (datetime.fromisoformat(sort_time), int(row_id))
+    except ValueError:
+        return None
+
+
 def is_valid_area_topic(topic):
     """
     Validates the topic of an area.
@@ -241,8 +312,17 @@ def add_user_to_secret_area(username, area_id):
         area_id (int): The ID of the secret area.
     """
 
-    sql = text("""INSERT INTO secret_area_privileges (area_id, user_id) VALUES (:area_id, (SELECT id FROM users WHERE username = :username))""")
-    Database().execute(sql, {"username": username, "area_id": area_id}, False)
+    sql = text("""
+        INSERT INTO secret_area_privileges (area_id, user_id)
+        VALUES (:area_id, (SELECT id FROM users WHERE username = :username))
+        ON CONFLICT DO NOTHING
+        RETURNING user_id
+    """)
+    db = Database()
+    with db.transaction():
+        added = db.execute(sql, {"username": username, "area_id": area_id})
+        if added:
+            access.invalidate(added["user_id"])
 
 
 def remove_user_from_secret_area(username, area_id):
@@ -254,8 +334,16 @@ def remove_user_from_secret_area(username, area_id):
         area_id (int): The ID of the secret area.
     """
 
-    sql = text("""DELETE FROM secret_area_privileges WHERE area_id = :area_id AND user_id = (SELECT id FROM users WHERE username = :username)""")
-    Database().execute(sql, {"area_id": area_id, "username": username}, False)
+    sql = text("""
+        DELETE FROM secret_area_privileges
+        WHERE area_id = :area_id AND user_id = (SELECT id FROM users WHERE username = :username)
+        RETURNING user_id
+    """)
+    db = Database()
+    with db.transaction():
+        removed = db.execute(sql, {"area_id": area_id, "username": username})
+        if removed:
+            access.invalidate(removed["user_id"])
 
 
 def get_access_list(area_id):
@@ -273,24 +361,9 @@ def get_access_list(area_id):
     return Database().fetch_all(sql, {"area_id": area_id})
 
 
-def get_message_image(message_id):
-    """
-    Retrieves the image URL associated with a specific message.
-
-    Args:
-        message_id (int): The ID of the message.
-
-    Returns:
-        str: The URL of the image associated with the message.
-    """
-
-    sql = text("""SELECT image_url FROM messages WHERE id = :message_id""")
-    return Database().fetch_one(sql, {"message_id": message_id})["image_url"]
-
-
 def delete_message(thread_id, message_id, user_id):
     """
-    Deletes a message from a thread.
+    Deletes a message from a thread. Its image is deleted in the background once no other message references it.
 
     Args:
         thread_id (int): The ID of the thread containing the message.
@@ -305,47 +378,80 @@ def delete_message(thread_id, message_id, user_id):
                 SELECT thread FROM messages WHERE id = :message_id
             )
         ) = 1
+        RETURNING area, (SELECT m.image_url FROM messages m WHERE m.thread = :thread_id) AS image_url
     """)
-    Database().execute(delete_thread_sql, {"thread_id": thread_id, "message_id": message_id}, False)
+    sql = text("""DELETE FROM messages m WHERE m.id = :message_id AND m.sender = :user_id RETURNING m.thread, m.image_url""")
 
-    sql = text("""DELETE FROM messages m WHERE m.id = :message_id AND m.sender = :user_id""")
-    Database().execute(sql, {"message_id": message_id, "user_id": user_id}, False)
+    db = Database()
+    image_urls = []
+    with db.transaction():
+        deleted_thread = db.execute(delete_thread_sql, {"thread_id": thread_id, "message_id": message_id})
+        if deleted_thread:
+            stats.remove_thread(deleted_thread["area"], 1)
+            deleted = deleted_thread
+        else:
+            deleted = db.execute(sql, {"message_id": message_id, "user_id": user_id})
+            if deleted:
+                stats.remove_message(deleted["thread"])
+                live.publish(deleted["thread"], "delete", message_id)
+        if deleted and deleted["image_url"]:
+            image_urls = [deleted["image_url"]]
+        attachments.release(image_urls)
+    uploads.delete_released(image_urls)
 
 
 def delete_thread(thread_id):
     """
-    Deletes a thread and its associated messages.
+    Deletes a thread and its associated messages. Their images are deleted in the background once no
+    other message references them.
 
     Args:
         thread_id (int): The ID of the thread to be deleted.
     """
 
-    sql = text("""SELECT image_url FROM messages WHERE thread = :thread_id""")
-    image_urls = Database().fetch_all(sql, {"thread_id": thread_id})
-    for image_url in image_urls:
-        if image_url["image_url"]:
-            os.remove("./app" + image_url["image_url"])
-
-    sql = text("""DELETE FROM threads WHERE id = :thread_id""")
-    Database().execute(sql, {"thread_id": thread_id}, False)
+    # The statistics row and the messages are removed by the cascade, RETURNING still sees them.
+    sql = text("""
+        DELETE FROM threads WHERE id = :thread_id
+        RETURNING area, (SELECT message_count FROM thread_stats WHERE thread_id = :thread_id) AS message_count,
+            ARRAY(SELECT m.image_url FROM messages m WHERE m.thread = :thread_id AND m.image_url IS NOT NULL) AS image_urls
+    """)
+    db = Database()
+    image_urls = []
+    with db.transaction():
+        deleted = db.execute(sql, {"thread_id": thread_id})
+        if deleted:
+            stats.remove_thread(deleted["area"], deleted["message_count"])
+            image_urls = deleted["image_urls"]
+        attachments.release(image_urls)
+    uploads.delete_released(image_urls)
 
 
 def delete_area(area_id):
     """
-    Deletes an area and its associated threads and messages.
+    Deletes an area and its associated threads and messages. Their images are deleted in the background
+    once no other message references them.
 
     Args:
         area_id (int): The ID of the area to be deleted.
     """
 
-    sql = text("""SELECT image_url FROM messages WHERE thread in (SELECT id FROM threads WHERE area = :area_id)""")
-    image_urls = Database().fetch_all(sql, {"area_id": area_id})
-    for image_url in image_urls:
-        if not image_url["image_url"]:
-            os.remove("./app" + image_url["image_url"])
-
-    sql = text("""DELETE FROM areas WHERE id = :area_id""")
-    Database().execute(sql, {"area_id": area_id}, False)
+    # The threads and messages are removed by the cascade, RETURNING still sees them.
+    sql = text("""
+        DELETE FROM areas WHERE id = :area_id
+        RETURNING ARRAY(
+            SELECT m.image_url FROM messages m JOIN threads t ON m.thread = t.id
+            WHERE t.area = :area_id AND m.image_url IS NOT NULL
+        ) AS image_urls
+    """)
+    db = Database()
+    image_urls = []
+    with db.transaction():
+        deleted = db.execute(sql, {"area_id": area_id})
+        if deleted:
+            image_urls = deleted["image_urls"]
+            access.invalidate()
+        attachments.release(image_urls)
+    uploads.delete_released(image_urls)
 
 
 def get_turnstile_sitekey():
@@ -361,71 +467,80 @@ def get_turnstile_sitekey():
     return getenv("TURNSTILE_SITEKEY", None)
 
 
-def full_search(query):
+def full_search(query, user_id, page=1):
     """
     Performs a full text search across areas, threads, and messages in the database.
 
-    The function executes SQL queries to search for the provided query string in
-    topics of areas, titles of threads, and text of messages.
+    The search uses the indexed search_vector columns, ranks the results and only returns
+    items in areas the user has access to.
 
     Args:
         query (str): The search query string.
+        user_id (int): The ID of the user performing the search.
+        page (int or None, optional): The page of results to return, or None to stream every
+            match while the results are rendered. Defaults to 1.
 
     Returns:
-        tuple: A tuple containing three lists for areas, threads, and messages
-               where each list contains dictionaries of the respective query results.
+        tuple: A tuple containing SearchResults, or StreamedResults, for areas, threads, and messages.
     """
 
-    area_sql = text("SELECT id, topic FROM areas WHERE topic ILIKE :query")
-    thread_sql = text("""
-        SELECT t.title, t.id, a.topic as area_topic
-        FROM threads t
-        JOIN areas a ON t.area = a.id
-        WHERE t.title ILIKE :query
-    """)
-    message_sql = text("""
-        SELECT m.text, m.thread, t.title as thread_title, a.topic as area_topic, u.username as sender_name
-        FROM messages m
-        JOIN threads t ON m.thread = t.id
-        JOIN areas a ON t.area = a.id
-        JOIN users u ON m.sender = u.id
-        WHERE m.text ILIKE :query
-    """)
-
-    areas = Database().fetch_all(area_sql, {"query": f"%{query}%"})
-    threads = Database().fetch_all(thread_sql, {"query": f"%{query}%"})
-    messages = Database().fetch_all(message_sql, {"query": f"%{query}%"})
-
-    return areas, threads, messages
+    return (
+        search.search_areas(query, user_id, page),
+        search.search_threads(query, user_id, page),
+        search.search_messages(query, user_id, page),
+    )
 
 
 def is_admin():
     """
     Checks if the current session is associated with an admin user.
 
-    This function checks the user's session to determine if the current user
-    is marked as an 'admin' in the session data.
+    The role is read from the user's cached visible areas rather than the session, so that a
+    change of role applies to sessions that are already logged in.
 
     Returns:
         bool: True if the current session is for an admin user, False otherwise.
     """
 
-    return session["user"] == "admin"
+    visible = access.visible_areas(session["user_id"])
+    return visible is not None and visible.is_admin
 
 
-def get_notifications(user_id):
+def count_unread_notifications(user_id):
     """
-    Retrieves notifications for a given user.
+    Counts the unread notifications of a user.
+
+    Args:
+        user_id (int): The ID of the user.
+
+    Returns:
+        int: The number of unread notifications.
+    """
+
+    sql = text("""SELECT COUNT(*) FROM notifications n WHERE n.user_id = :user_id AND NOT n.is_read""")
+    return Database().fetch_one(sql, {"user_id": user_id})["count"]
+
+
+def get_notifications(user_id, before=None, limit=NOTIFICATIONS_PER_PAGE):
+    """
+    Retrieves one page of notifications for a given user, newest first.
+
+    There is one notification per subscribed thread, holding its latest message and the number
+    of messages posted since the user last read the thread.
 
     Args:
         user_id (int): The ID of the user to retrieve notifications for.
+        before (str, optional): Cursor of a notification; retrieves the page following it.
+        limit (int, optional): The maximum number of notifications on a page. Defaults to NOTIFICATIONS_PER_PAGE.
 
     Returns:
-        list: A list of notifications for the user.
+        tuple: A list of notifications and the cursor of the next page, or None if this is the last page.
     """
 
-    sql = text("""
-        SELECT n.id, n.thread_id, n.message, n.sent_time, n.sender_id,
+    cursor = decode_cursor(before)
+    condition = "AND (n.sent_time, n.id) < (:cursor_time, :cursor_id)" if cursor else ""
+    sql = text(f"""
+        SELECT n.id, n.thread_id, n.message, n.sent_time, n.sender_id, n.is_read, n.unread_count,
                t.area, t.title as thread_title,
                a.topic as area_topic,
                u.username as sender_name
@@ -433,52 +548,113 @@ def get_notifications(user_id):
         JOIN threads t ON n.thread_id = t.id
         JOIN areas a ON t.area = a.id
         JOIN users u ON n.sender_id = u.id
-        WHERE n.user_id = :user_id
-        ORDER BY n.sent_time DESC
+        WHERE n.user_id = :user_id {condition}
+        ORDER BY n.sent_time DESC, n.id DESC
+        LIMIT :limit
     """)
-    raw_notifications = Database().fetch_all(sql, {"user_id": user_id})
+    params = {"user_id": user_id, "limit": limit + 1}
+    if cursor:
+        params["cursor_time"], params["cursor_id"] = cursor
+    notifications = [dict(notification) for notification in Database().fetch_all(sql, params)]
 
-    notifications = []
-    for raw_notification in raw_notifications:
-        notification = dict(raw_notification)
-        notification['sent_time_ago'] = time_ago(notification['sent_time'])
-        notifications.append(notification)
+    next_cursor = None
+    if len(notifications) > limit:
+        notifications = notifications[:limit]
+        next_cursor = encode_cursor(notifications[-1]["sent_time"], notifications[-1]["id"])
 
-    return notifications
+    return notifications, next_cursor
+
+
+def mark_notifications_read(user_id, thread_id=None):
+    """
+    Marks the notifications of a user as read.
+
+    Args:
+        user_id (int): The ID of the user.
+        thread_id (int, optional): If given, only notifications about this thread are marked as read.
+    """
+
+    thread_condition = "AND n.thread_id = :thread_id" if thread_id is not None else ""
+    sql = text(f"""
+        UPDATE notifications n SET is_read = true, unread_count = 0
+        WHERE n.user_id = :user_id AND NOT n.is_read {thread_condition}
+    """)
+    Database().execute(sql, {"user_id": user_id, "thread_id": thread_id}, False)
+
+
+def prune_notifications(read_days=30, unread_days=180, batch_size=5000):
+    """
+    Deletes old notifications in batches, so that the table does not grow without limit.
+
+    Each batch is its own short transaction, so pruning a large backlog does not hold locks for long.
+
+    Args:
+        read_days (int, optional): Read notifications older than this many days are deleted. Defaults to 30.
+        unread_days (int, optional): Unread notifications older than this many days are deleted. Defaults to 180.
+        batch_size (int, optional): The maximum number of rows deleted per statement. Defaults to 5000.
+
+    Returns:
+        int: The number of deleted notifications.
+    """
+
+    now = datetime.now()
+    sql = text("""
+        WITH deleted AS (
+            DELETE FROM notifications WHERE id IN (
+                SELECT n.id FROM notifications n
+                WHERE (n.is_read AND n.sent_time < :read_before) OR n.sent_time < :unread_before
+                LIMIT :batch_size
+            )
+            RETURNING 1
+        )
+        SELECT COUNT(*) FROM deleted
+    """)
+    params = {
+        "read_before": now - timedelta(days=read_days),
+        "unread_before": now - timedelta(days=unread_days),
+        "batch_size": batch_size,
+    }
+
+    total = 0
+    while True:
+        result = Database().execute(sql, params)
+        deleted = result["count"] if result else 0
+        total += deleted
+        if deleted < batch_size:
+            return total
 
 
 def create_notification(thread_id, message_text):
     """
-    Creates a new notification in the database.
+    Notifies every subscriber of the thread about a new message.
+
+    Each subscriber has at most one notification per thread. A new message updates it with the
+    latest sender, text and time and increments its unread_count, so a busy thread costs one
+    row per subscriber instead of one per message. All rows are written by a single upsert.
 
     Args:
         thread_id (int): The ID of the thread associated with the notification.
         message_text (str): The message associated with the notification.
     """
 
-    db = Database()
-    subscribers_sql = text("""
-        SELECT user_id FROM thread_subscriptions
-        WHERE thread_id = :thread_id AND user_id != :sender_id
-    """)
-    subscribers_sql = text("""
-        SELECT user_id FROM thread_subscriptions
-        WHERE thread_id = :thread_id AND user_id != :sender_id
+    sql = text("""
+        INSERT INTO notifications (user_id, thread_id, sender_id, message, sent_time, unread_count, is_read)
+        SELECT s.user_id, s.thread_id, :sender_id, :message, :time, 1, false
+        FROM thread_subscriptions s
+        WHERE s.thread_id = :thread_id AND s.user_id != :sender_id
+        ON CONFLICT (user_id, thread_id) DO UPDATE
+        SET sender_id = EXCLUDED.sender_id,
+            message = EXCLUDED.message,
+            sent_time = EXCLUDED.sent_time,
+            unread_count = notifications.unread_count + 1,
+            is_read = false
     """)
-    subscribers = db.fetch_all(subscribers_sql, {"thread_id": thread_id, "sender_id": session["user_id"]})
-
-    for subscriber in subscribers:
-        notification_sql = text("""
-            INSERT INTO notifications (user_id, thread_id, sender_id, message, sent_time)
-            VALUES (:user_id, :thread_id, :sender_id, :message, :time)
-        """)
-        db.execute(notification_sql, {
-            "user_id": subscriber["user_id"],
-            "thread_id": thread_id,
-            "sender_id": session["user_id"],
-            "message": message_text[:100],
-            "time": datetime.now()
-        }, return_result=False)
+    Database().execute(sql, {
+        "thread_id": thread_id,
+        "sender_id": session["user_id"],
+        "message": message_text[:100],
+        "time": datetime.now()
+    }, return_result=False)
 
 
 def toggle_subscription(thread_id, user_id):
@@ -0,0 +1,160 @@
+import logging
+import time
+from collections import Counter
+from os import getenv
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+logger = logging.getLogger("webchat.sql")
+
+
+class QueryStats:
+    """
+    Counts and times the SQL statements executed during one request.
+
+    Attributes:
+        count (int): The number of statements executed.
+        total_time (float): The total time spent executing statements, in seconds.
+        statements (Counter): The number of executions of each distinct statement text.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty QueryStats object.
+        """
+
+        self.count = 0
+        self.total_time = 0.0
+        self.statements = Counter()
+
+    @property
+    def total_ms(self):
+        """
+        The total time spent executing statements.
+
+        Returns:
+            float: The time in milliseconds.
+        """
+
+        return self.total_time * 1000
+
+    def record(self, statement, duration):
+        """
+        Records one executed statement.
+
+        Args:
+            statement (str): The SQL text of the statement, with placeholders instead of values.
+            duration (float): The execution time in seconds.
+        """
+
+        self.count += 1
+        self.total_time += duration
+        self.statements[statement] += 1
+
+    def suspects(self, threshold):
+        """
+        Finds statements executed repeatedly, which usually indicates an N+1 query pattern.
+
+        Args:
+            threshold (int): The number of executions from which a statement is reported.
+
+        Returns:
+            list[tuple]: (statement, count) pairs, most executed first.
+        """
+
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+
+def init_app(app):
+    """
+    Enables SQL instrumentation for the application.
+
+    Statement counts and durations are reported in a Server-Timing response header, and
+    optionally in a footer on HTML pages when SQL_DEBUG_FOOTER is "True". Statements slower
+    than SLOW_QUERY_MS milliseconds are logged with their parameter values redacted, and
+    statements repeated at least N_PLUS_ONE_THRESHOLD times in one request are logged as
+    N+1 suspects.
+
+    Args:
+        app (Flask): The application to instrument.
+    """
+
+    app.config.setdefault("SLOW_QUERY_MS", float(getenv("SLOW_QUERY_MS", "200")))
+    app.config.setdefault("N_PLUS_ONE_THRESHOLD", int(getenv("N_PLUS_ONE_THRESHOLD", "5")))
+    app.config.setdefault("SQL_DEBUG_FOOTER", getenv("SQL_DEBUG_FOOTER", "") == "True")
+
+    _listen()
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def add_server_timing(response):
+        stats = g.get("query_stats")
+        if stats is None:
+            return response
+
+        timings = [f'db;dur={stats.total_ms:.1f};desc="{stats.count} queries"']
+        if "request_started" in g:
+            timings.append(f"app;dur={(time.perf_counter() - g.request_started) * 1000:.1f}")
+        response.headers.add("Server-Timing", ", ".join(timings))
+
+        for statement, count in stats.suspects(app.config["N_PLUS_ONE_THRESHOLD"]):
+            logger.warning("N+1 suspect in %s %s: executed %d times: %s",
+                           request.method, request.path, count, _compact(statement))
+        return response
+
+    @app.context_processor
+    def inject_query_stats():
+        if not app.config["SQL_DEBUG_FOOTER"]:
+            return {}
+        return {"query_stats": g.get("query_stats"), "n_plus_one_threshold": app.config["N_PLUS_ONE_THRESHOLD"]}
+
+
+def _listen():
+    # The listeners are attached to the Engine class, so they cover engines created later.
+    if event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        return
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start_time"].pop()
+    if not has_app_context():
+        return
+
+    stats = g.get("query_stats")
+    if stats is not None:
+        stats.record(statement, duration)
+
+    if duration * 1000 >= current_app.config.get("SLOW_QUERY_MS", 200):
+        logger.warning("Slow query (%.1f ms): %s; parameters: %s", duration * 1000, _compact(statement), _redact(parameters))
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute, so its start time is discarded here.
+    if context.connection is not None and context.connection.info.get("query_start_time"):
+        context.connection.info["query_start_time"].pop()
+
+
+def _compact(statement):
+    return " ".join(statement.split())
+
+
+def _redact(parameters):
+    # Only parameter names are logged, values may contain passwords or private messages.
+    if isinstance(parameters, dict):
+        return ", ".join(f"{name}=?" for name in parameters) or "none"
+    if isinstance(parameters, (list, tuple)):
+        return f"{len(parameters)} values"
+    return "none"
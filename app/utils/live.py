@@ -0,0 +1,386 @@
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from os import getenv
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import NullPool
+from ..utils import delta
+from ..utils.db import Database
+
+
+logger = logging.getLogger("webchat.live")
+
+# The Postgres channel on which message changes are announced.
+CHANNEL = "thread_events"
+
+# Seconds between comments sent on an idle stream, which keep proxies from closing the connection.
+KEEPALIVE_SECONDS = 15
+
+# The maximum number of events buffered for one client before it is told to reload instead.
+QUEUE_SIZE = 100
+
+# The maximum number of missed messages sent on reconnect before the client is told to reload instead.
+RESUME_LIMIT = 50
+
+
+def publish(thread_id, event, message_id):
+    """
+    Announces a change to a message of a thread to every connected client.
+
+    The notification is sent with pg_notify, so inside a unit of work it is only delivered once
+    the transaction commits, and not at all if it is rolled back.
+
+    Args:
+        thread_id (int): The ID of the thread containing the message.
+        event (str): "message" for a new message, "edit" or "delete".
+        message_id (int): The ID of the message.
+    """
+
+    payload = json.dumps({"thread": thread_id, "event": event, "id": message_id})
+    Database().execute(text("""SELECT pg_notify(:channel, :payload)"""), {"channel": CHANNEL, "payload": payload}, False)
+
+
+def missed_messages(thread_id, last_id):
+    """
+    Fetches the messages posted to a thread after the last one a client has received.
+
+    Args:
+        thread_id (int): The ID of the thread.
+        last_id (int): The ID of the last message the client has received.
+
+    Returns:
+        tuple: A list of message events, oldest first, and whether more than RESUME_LIMIT messages were missed.
+    """
+
+    return delta.fetch_messages_after(thread_id, last_id, RESUME_LIMIT)
+
+
+def latest_message_id(thread_id):
+    """
+    Finds the ID of the newest message in a thread, where a new stream starts from.
+
+    Args:
+        thread_id (int): The ID of the thread.
+
+    Returns:
+        int: The highest message ID in the thread, or 0 if it has no messages.
+    """
+
+    sql = text("""SELECT COALESCE(MAX(m.id), 0) AS id FROM messages m WHERE m.thread = :thread_id""")
+    row = Database().fetch_one(sql, {"thread_id": thread_id})
+    return row["id"] if row else 0
+
+
+def format_event(event, data, event_id=None):
+    """
+    Formats one Server-Sent Event.
+
+    Args:
+        event (str): The event name.
+        data (dict): The event data, sent as JSON.
+        event_id (int, optional): The event ID, which the browser sends back as Last-Event-ID on reconnect.
+
+    Returns:
+        str: The event in text/event-stream format.
+    """
+
+    lines = [f"id: {event_id}"] if event_id is not None else []
+    lines += [f"event: {event}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+class Subscription:
+    """
+    The queue of events for one client following a thread.
+
+    Attributes:
+        thread_id (int): The ID of the followed thread.
+        events (Queue): (event, data) pairs waiting to be sent to the client.
+    """
+
+    def __init__(self, thread_id):
+        """
+        Initializes a Subscription object.
+
+        Args:
+            thread_id (int): The ID of the followed thread.
+        """
+
+        self.thread_id = thread_id
+        self.events = queue.Queue(QUEUE_SIZE)
+
+    def put(self, event, data):
+        """
+        Queues an event for the client.
+
+        A client too slow to keep up gets a single reset event instead, after which it reloads the thread.
+
+        Args:
+            event (str): The event name.
+            data (dict): The event data.
+        """
+
+        try:
+            self.events.put_nowait((event, data))
+        except queue.Full:
+            with self.events.mutex:
+                self.events.queue.clear()
+            self.events.put_nowait(("reset", {}))
+
+    def get(self, timeout):
+        """
+        Waits for the next event.
+
+        Args:
+            timeout (float): The maximum time to wait, in seconds.
+
+        Returns:
+            tuple or None: The next (event, data) pair, or None if none arrived in time.
+        """
+
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+def event_stream(thread_id, last_id=None):
+    """
+    Generates the Server-Sent Events of a client following a thread.
+
+    A client that has already received messages gets the ones it missed first, or a reset event if
+    it missed more than RESUME_LIMIT. Then new, edited and deleted messages are sent as they are
+    announced, with a keep-alive comment every KEEPALIVE_SECONDS while the thread is quiet.
+
+    The generator runs after the request has ended, so it does not hold the request's database connection.
+
+    Args:
+        thread_id (int): The ID of the thread.
+        last_id (int, optional): The ID of the last message the client has. Defaults to the newest message.
+
+    Yields:
+        str: The events in text/event-stream format.
+    """
+
+    # Subscribe before looking up missed messages, so that nothing posted in between is lost.
+    subscription = broker.subscribe(thread_id)
+    try:
+        yield "retry: 3000\n\n"
+        if last_id is None:
+            last_id = latest_message_id(thread_id)
+        else:
+            missed, overflow = missed_messages(thread_id, last_id)
+            if overflow:
+                yield format_event("reset", {})
+                return
+            for data in missed:
+                last_id = data["id"]
+                yield format_event("message", data, last_id)
+        yield from _follow(subscription, last_id)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def _follow(subscription, last_id):
+    while True:
+        event = subscription.get(KEEPALIVE_SECONDS)
+        if event is None:
+            yield ": keep-alive\n\n"
+            continue
+        name, data = event
+        if name == "message":
+            # Messages already sent while resuming are announced again, and skipped here.
+            if data["id"] <= last_id:
+                continue
+            last_id = data["id"]
+            yield format_event(name, data, last_id)
+        else:
+            yield format_event(name, data)
+        if name == "reset":
+            return
+
+
+class Broker:
+    """
+    Fans out message notifications from Postgres to the clients connected to this process.
+
+    A single background thread per process LISTENs on its own connection, outside of the pool.
+    Each notification is loaded from the database once, however many clients follow the thread.
+    Other modules can receive the notifications of further channels over the same connection with listen.
+
+    Attributes:
+        reconnect_delay (float): Seconds to wait before reconnecting after the connection is lost.
+    """
+
+    def __init__(self, reconnect_delay=1.0):
+        """
+        Initializes a Broker object. The listener thread is started by the first subscription.
+
+        Args:
+            reconnect_delay (float, optional): Seconds to wait before reconnecting. Defaults to 1.0.
+        """
+
+        self.reconnect_delay = reconnect_delay
+        self._subscriptions = {}
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connection = None
+        self._listening = threading.Event()
+
+    @property
+    def connected(self):
+        """
+        Whether the listener is connected, so that notifications are being received.
+
+        Returns:
+            bool: True while the listener is connected.
+        """
+
+        return self._connection is not None
+
+    def subscribe(self, thread_id, timeout=5.0):
+        """
+        Starts following a thread.
+
+        Returns once the listener is connected, so no change committed after this call is missed.
+
+        Args:
+            thread_id (int): The ID of the thread.
+            timeout (float, optional): Seconds to wait for the listener to connect. Defaults to 5.0.
+
+        Returns:
+            Subscription: The queue the events of the thread are delivered to.
+        """
+
+        subscription = Subscription(thread_id)
+        with self._lock:
+            self._subscriptions.setdefault(thread_id, set()).add(subscription)
+            self._start()
+        if not self._listening.wait(timeout):
+            logger.warning("Live update listener is not connected")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Stops following a thread.
+
+        Args:
+            subscription (Subscription): The subscription returned by subscribe.
+        """
+
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.thread_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.thread_id]
+
+    def listen(self, channel, handler):
+        """
+        Delivers the notifications of another channel to a handler, starting the listener if needed.
+
+        The handler runs on the listener thread and must return quickly. It is called with the
+        payload of each notification, and with None whenever notifications may have been missed
+        because the connection was lost. Registering the same channel again replaces the handler.
+
+        Args:
+            channel (str): The Postgres channel.
+            handler (callable): Called with the payload, or None.
+        """
+
+        with self._lock:
+            if self._handlers.get(channel) is handler:
+                return
+            self._handlers[channel] = handler
+            if self._connection is not None:
+                with self._connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {channel}")
+            self._start()
+
+    def _start(self):
+        # Started lazily, so that every forked worker process gets its own listener.
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._listen, name="webchat-live", daemon=True)
+            self._thread.start()
+
+    def _listen(self):
+        engine = create_engine(getenv("DB_URL"), poolclass=NullPool)
+        while True:
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                connection.driver_connection.autocommit = True
+                with self._lock:
+                    with connection.cursor() as cursor:
+                        for channel in [CHANNEL, *self._handlers]:
+                            cursor.execute(f"LISTEN {channel}")
+                    self._connection = connection.driver_connection
+                    handlers = list(self._handlers.values())
+                if not self._listening.is_set():
+                    self._listening.set()
+                else:
+                    # Changes made while reconnecting were missed, so every client has to catch up.
+                    self._broadcast("reset", {})
+                for handler in handlers:
+                    handler(None)
+                self._receive(connection.driver_connection)
+            except Exception:
+                logger.exception("Live update listener lost its connection")
+            finally:
+                with self._lock:
+                    self._connection = None
+                if connection is not None:
+                    connection.close()
+            time.sleep(self.reconnect_delay)
+
+    def _receive(self, connection):
+        while True:
+            if not select.select([connection], [], [], 60)[0]:
+                continue
+            with self._lock:
+                connection.poll()
+                notifies = list(connection.notifies)
+                connection.notifies.clear()
+            for notify in notifies:
+                if notify.channel == CHANNEL:
+                    self._dispatch(notify.payload)
+                elif notify.channel in self._handlers:
+                    self._handlers[notify.channel](notify.payload)
+
+    def _dispatch(self, payload):
+        notification = json.loads(payload)
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(notification["thread"], ()))
+        if not subscriptions:
+            return
+
+        if notification["event"] == "delete":
+            data = {"id": notification["id"]}
+        else:
+            sql = text("""
+                SELECT m.id, m.sender, u.username AS sender_name, m.text, m.image_url, m.sent_time
+                FROM messages m
+                JOIN users u ON m.sender = u.id
+                WHERE m.id = :message_id
+            """)
+            row = Database().fetch_one(sql, {"message_id": notification["id"]})
+            if row is None:
+                # Deleted before it could be loaded, a delete event follows.
+                return
+            data = delta.message_data(row)
+
+        for subscription in subscriptions:
+            subscription.put(notification["event"], data)
+
+    def _broadcast(self, event, data):
+        with self._lock:
+            subscriptions = [subscription for subscriptions in self._subscriptions.values() for subscription in subscriptions]
+        for subscription in subscriptions:
+            subscription.put(event, data)
+
+
+broker = Broker()
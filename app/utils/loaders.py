@@ -0,0 +1,71 @@
+from sqlalchemy import text
+from ..utils.db import Database
+
+
+def prefetch_area_stats(areas):
+    """
+    Loads the thread count, message count and last message time for a collection of areas.
+
+    The aggregates are read from area_stats with a single query and attached to each Area object,
+    so that rendering a list of areas costs one query instead of one per area and property.
+
+    Args:
+        areas (list[Area]): The areas to load statistics for.
+
+    Returns:
+        list[Area]: The same list of areas, with statistics attached.
+    """
+
+    if not areas:
+        return areas
+
+    sql = text("""
+        SELECT s.area_id AS id, s.thread_count, s.message_count, s.last_message_time
+        FROM area_stats s
+        WHERE s.area_id = ANY(:area_ids)
+    """)
+    stats = {row["id"]: row for row in Database().fetch_all(sql, {"area_ids": [area.id for area in areas]})}
+
+    for area in areas:
+        row = stats.get(area.id)
+        area._stats = {
+            "thread_count": row["thread_count"] if row else 0,
+            "message_count": row["message_count"] if row else 0,
+            "last_message_time": row["last_message_time"] if row else None,
+        }
+
+    return areas
+
+
+def prefetch_thread_stats(threads):
+    """
+    Loads the message count and last message time for a collection of threads.
+
+    The aggregates are read from thread_stats with a single query and attached to each Thread object,
+    so that rendering a list of threads costs one query instead of one per thread and property.
+
+    Args:
+        threads (list[Thread]): The threads to load statistics for.
+
+    Returns:
+        list[Thread]: The same list of threads, with statistics attached.
+    """
+
+    if not threads:
+        return threads
+
+    sql = text("""
+        SELECT s.thread_id AS id, s.message_count, s.last_message_time
+        FROM thread_stats s
+        WHERE s.thread_id = ANY(:thread_ids)
+    """)
+    stats = {row["id"]: row for row in Database().fetch_all(sql, {"thread_ids": [thread.id for thread in threads]})}
+
+    for thread in threads:
+        row = stats.get(thread.id)
+        thread._stats = {
+            "message_count": row["message_count"] if row else 0,
+            "last_message_time": row["last_message_time"] if row else None,
+        }
+
+    return threads
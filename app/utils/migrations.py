@@ -0,0 +1,191 @@
+import importlib
+import pkgutil
+import re
+from sqlalchemy import text
+from .. import migrations as migrations_package
+
+
+# Arbitrary key for the advisory lock that keeps concurrent upgrades from running the same migration.
+_MIGRATION_LOCK_KEY = 7216402
+
+_MIGRATION_NAME = re.compile(r"^(\d+)_(\w+)$")
+
+# The name of the index created by a CREATE INDEX statement.
+_CREATED_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.IGNORECASE
+)
+
+
+class Migration:
+    """
+    A single schema migration loaded from the app.migrations package.
+
+    Attributes:
+        version (int): The version the schema is at after the migration has been applied.
+        name (str): The descriptive part of the module name.
+        statements (list[str]): The SQL statements of the migration.
+        transactional (bool): Whether the statements are run in a single transaction.
+    """
+
+    def __init__(self, version, name, statements, transactional=True):
+        """
+        Initializes a Migration object.
+
+        Args:
+            version (int): The version the schema is at after the migration has been applied.
+            name (str): The descriptive part of the module name.
+            statements (list[str]): The SQL statements of the migration.
+            transactional (bool, optional): Whether the statements are run in a single transaction. Defaults to True.
+        """
+
+        self.version = version
+        self.name = name
+        self.statements = statements
+        self.transactional = transactional
+
+
+def available_migrations():
+    """
+    Loads all migrations in the app.migrations package.
+
+    Returns:
+        list[Migration]: The migrations ordered by version.
+    """
+
+    found = []
+    for module_info in pkgutil.iter_modules(migrations_package.__path__):
+        match = _MIGRATION_NAME.match(module_info.name)
+        if not match:
+            continue
+        module = importlib.import_module(f"{migrations_package.__name__}.{module_info.name}")
+        found.append(Migration(int(match.group(1)), match.group(2), module.STATEMENTS, getattr(module, "TRANSACTIONAL", True)))
+    return sorted(found, key=lambda migration: migration.version)
+
+
+def latest_version():
+    """
+    The version the schema is at once all available migrations have been applied.
+
+    Returns:
+        int: The highest available migration version, or 0 if there are none.
+    """
+
+    migrations = available_migrations()
+    return migrations[-1].version if migrations else 0
+
+
+def current_version(engine):
+    """
+    Reads the version of the schema in the database.
+
+    This is a single cheap query, suitable for running on application startup.
+
+    Args:
+        engine (Engine): The engine connected to the database.
+
+    Returns:
+        int: The version of the last applied migration, or 0 if none has been applied.
+    """
+
+    with engine.connect() as connection:
+        exists = connection.execute(text("""SELECT to_regclass('schema_migrations') IS NOT NULL""")).scalar()
+        if not exists:
+            return 0
+        return connection.execute(text("""SELECT COALESCE(MAX(version), 0) FROM schema_migrations""")).scalar()
+
+
+def status(engine):
+    """
+    Lists all available migrations and whether they have been applied.
+
+    Args:
+        engine (Engine): The engine connected to the database.
+
+    Returns:
+        list[tuple]: (Migration, applied_at) pairs, where applied_at is None for pending migrations.
+    """
+
+    applied = {}
+    if current_version(engine) > 0:
+        with engine.connect() as connection:
+            for row in connection.execute(text("""SELECT version, applied_at FROM schema_migrations""")).mappings():
+                applied[row["version"]] = row["applied_at"]
+    return [(migration, applied.get(migration.version)) for migration in available_migrations()]
+
+
+def upgrade(engine, target=None):
+    """
+    Applies all pending migrations up to the target version.
+
+    Transactional migrations are applied together with their version row in one transaction.
+    Other migrations, such as concurrent index builds, run statement by statement in autocommit
+    mode; they must be idempotent so that a failed run can be retried.
+
+    Args:
+        engine (Engine): The engine connected to the database.
+        target (int, optional): The version to upgrade to. Defaults to the latest version.
+
+    Returns:
+        list[Migration]: The migrations that were applied.
+    """
+
+    applied = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("""SELECT pg_advisory_lock(:key)"""), {"key": _MIGRATION_LOCK_KEY})
+        try:
+            connection.execute(text("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version integer PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+                )
+            """))
+            version = connection.execute(text("""SELECT COALESCE(MAX(version), 0) FROM schema_migrations""")).scalar()
+
+            for migration in available_migrations():
+                if migration.version <= version or (target is not None and migration.version > target):
+                    continue
+                _apply(engine, connection, migration)
+                applied.append(migration)
+        finally:
+            connection.execute(text("""SELECT pg_advisory_unlock(:key)"""), {"key": _MIGRATION_LOCK_KEY})
+    return applied
+
+
+def _apply(engine, connection, migration):
+    record_sql = text("""INSERT INTO schema_migrations (version, name) VALUES (:version, :name)""")
+    params = {"version": migration.version, "name": migration.name}
+
+    if migration.transactional:
+        with engine.begin() as transaction:
+            for statement in migration.statements:
+                transaction.execute(text(statement))
+            transaction.execute(record_sql, params)
+        return
+
+    for statement in migration.statements:
+        connection.execute(text(statement))
+
+    # A failed concurrent build leaves an invalid index behind, which IF NOT EXISTS would then skip.
+    # Only the migration's own indexes are checked, invalid indexes elsewhere are not its concern.
+    created = [name for statement in migration.statements for name in _CREATED_INDEX.findall(statement)]
+    invalid = _invalid_indexes(connection, created)
+    if invalid:
+        raise RuntimeError(
+            f"Migration {migration.version} left invalid indexes: {', '.join(invalid)}. Drop them and upgrade again."
+        )
+    connection.execute(record_sql, params)
+
+
+def _invalid_indexes(connection, names):
+    if not names:
+        return []
+    sql = text("""
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid AND n.nspname = current_schema() AND c.relname = ANY(:names)
+        ORDER BY c.relname
+    """)
+    return connection.execute(sql, {"names": names}).scalars().all()
@@ -0,0 +1,208 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import getenv
+from threading import BoundedSemaphore, Lock
+import bcrypt
+from zxcvbn import zxcvbn
+
+
+# zxcvbn time grows with the length of the password, and nothing is gained from checking more of it.
+MAX_CHECKED_LENGTH = 100
+
+
+class PoolBusyError(Exception):
+    """
+    Raised when password hashing is saturated and a request would have to wait longer than
+    AUTH_QUEUE_TIMEOUT seconds for it. The message is suitable for showing to the user.
+    """
+
+
+def bcrypt_rounds():
+    """
+    The bcrypt cost of new password hashes, configured with BCRYPT_ROUNDS.
+
+    Returns:
+        int: The base-2 logarithm of the number of rounds. Defaults to 12.
+    """
+
+    return int(getenv("BCRYPT_ROUNDS", "12"))
+
+
+def hash_password(password):
+    """
+    Hashes a password with bcrypt at the configured cost, in the worker pool.
+
+    Args:
+        password (str): The password to hash.
+
+    Returns:
+        bytes: The hashed password.
+
+    Raises:
+        PoolBusyError: If the worker pool is saturated.
+    """
+
+    return get_pool().run(_hash, password.encode("utf-8"), bcrypt_rounds())
+
+
+def check_password(password, hashed):
+    """
+    Checks a password against a bcrypt hash, in the worker pool.
+
+    Args:
+        password (str): The password to check.
+        hashed (bytes): The stored hash.
+
+    Returns:
+        bool: True if the password matches.
+
+    Raises:
+        PoolBusyError: If the worker pool is saturated.
+    """
+
+    return get_pool().run(bcrypt.checkpw, password.encode("utf-8"), hashed)
+
+
+def needs_rehash(hashed):
+    """
+    Checks whether a hash was made at a different cost than the configured one.
+
+    Args:
+        hashed (bytes): The stored hash, in the $2b$<cost>$... format.
+
+    Returns:
+        bool: True if the password should be hashed again.
+    """
+
+    try:
+        return int(hashed.split(b"$")[2]) != bcrypt_rounds()
+    except (IndexError, ValueError):
+        return True
+
+
+def password_score(password):
+    """
+    Estimates the strength of a password with zxcvbn, in the worker pool.
+
+    Args:
+        password (str): The password to rate.
+
+    Returns:
+        int: The zxcvbn score, from 0 (weakest) to 4 (strongest).
+
+    Raises:
+        PoolBusyError: If the worker pool is saturated.
+    """
+
+    return get_pool().run(_score, password[:MAX_CHECKED_LENGTH])
+
+
+class WorkerPool:
+    """
+    A bounded pool of processes for CPU-heavy authentication work, so that a burst of logins or
+    registrations cannot occupy every request thread.
+
+    At most twice as many tasks as there are processes are admitted at once: one running and one
+    waiting per process. A task that cannot be admitted within the queue timeout fails instead of
+    waiting, so an overload is shed quickly. The processes are started on first use, so every
+    forked web worker gets its own pool.
+
+    Attributes:
+        workers (int): The number of processes. With 0, tasks run on the calling thread.
+        queue_timeout (float): Seconds to wait for a task to be admitted.
+    """
+
+    def __init__(self, workers=None, queue_timeout=None):
+        """
+        Initializes a WorkerPool object.
+
+        Args:
+            workers (int, optional): The number of processes. Defaults to AUTH_WORKERS, or 2.
+            queue_timeout (float, optional): Seconds to wait for a task to be admitted. Defaults to AUTH_QUEUE_TIMEOUT, or 2.
+        """
+
+        self.workers = workers if workers is not None else int(getenv("AUTH_WORKERS", "2"))
+        self.queue_timeout = queue_timeout if queue_timeout is not None else float(getenv("AUTH_QUEUE_TIMEOUT", "2"))
+        self._slots = BoundedSemaphore(max(self.workers, 1) * 2)
+        self._lock = Lock()
+        self._executor = None
+        self._pid = None
+
+    def run(self, function, *args):
+        """
+        Runs a function in a worker process and waits for its result.
+
+        Args:
+            function (callable): A module-level function, so that it can be sent to the process.
+            *args: The arguments of the function.
+
+        Returns:
+            The return value of the function.
+
+        Raises:
+            PoolBusyError: If the task is not admitted within the queue timeout, or the pool broke.
+        """
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise PoolBusyError("The server is busy, please try again in a moment")
+        try:
+            if self.workers == 0:
+                return function(*args)
+            return self._get_executor().submit(function, *args).result()
+        except BrokenProcessPool as error:
+            # A worker process died; the next task starts a new pool.
+            with self._lock:
+                self._executor = None
+            raise PoolBusyError("The server is busy, please try again in a moment") from error
+        finally:
+            self._slots.release()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                # Spawned rather than forked, as the web process runs other threads.
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                self._pid = os.getpid()
+            return self._executor
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _score(password):
+    return zxcvbn(password)["score"]
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    """
+    Returns the worker pool of this process, created on first use from the environment.
+
+    Returns:
+        WorkerPool: The pool.
+    """
+
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = WorkerPool()
+    return _pool
+
+
+def set_pool(new_pool):
+    """
+    Replaces the worker pool.
+
+    Args:
+        new_pool (WorkerPool or None): The pool, or None to create it from the environment again on next use.
+    """
+
+    global _pool
+    _pool = new_pool
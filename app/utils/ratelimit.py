@@ -0,0 +1,207 @@
+import math
+import time
+from os import getenv
+from threading import Lock
+from flask import Response
+from sqlalchemy import text
+from ..utils.db import Database
+
+
+# The number of keys tracked by a process before the ones that can no longer limit anything are dropped.
+MAX_KEYS = 10000
+
+# The Postgres backend deletes stale buckets after this many checks in a process. No limit may
+# have a period longer than STALE_AFTER_SECONDS, as a bucket untouched that long counts as full.
+CLEANUP_EVERY = 1000
+STALE_AFTER_SECONDS = 86400
+
+
+class MemoryBackend:
+    """
+    Keeps token buckets in the memory of the process.
+
+    Every gunicorn worker counts separately, so a client may get up to the number of workers
+    times the limit. Suitable for a single process and for development.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty MemoryBackend object.
+        """
+
+        self._buckets = {}
+        self._lock = Lock()
+
+    def hit(self, key, capacity, rate):
+        """
+        Takes a token from a bucket, if one is available.
+
+        Args:
+            key (str): The bucket.
+            capacity (int): The maximum number of tokens, the allowed burst.
+            rate (float): The number of tokens added per second.
+
+        Returns:
+            float: 0 if the request is allowed, otherwise the number of seconds until it would be.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _, _ = self._buckets.get(key, (capacity, now, capacity, rate))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now, capacity, rate)
+            if len(self._buckets) > MAX_KEYS:
+                self._prune(now)
+        return 0 if allowed else (1 - tokens) / rate
+
+    def _prune(self, now):
+        # A bucket that has refilled completely behaves exactly like a missing one.
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[3] < bucket[2]
+        }
+
+
+class PostgresBackend:
+    """
+    Keeps token buckets in the rate_limits table, shared by every worker and node.
+
+    A check is a single upsert on the request's connection. A process remembers when a rejected
+    key can be allowed again, so further requests from a client that is over its limit are
+    rejected without a query. If the database cannot be reached, requests are allowed.
+    """
+
+    def __init__(self):
+        """
+        Initializes a PostgresBackend object.
+        """
+
+        self._blocked_until = {}
+        self._lock = Lock()
+        self._hits = 0
+
+    def hit(self, key, capacity, rate):
+        """
+        Takes a token from a bucket, if one is available.
+
+        Args:
+            key (str): The bucket.
+            capacity (int): The maximum number of tokens, the allowed burst.
+            rate (float): The number of tokens added per second.
+
+        Returns:
+            float: 0 if the request is allowed, otherwise the number of seconds until it would be.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            blocked_until = self._blocked_until.get(key)
+        if blocked_until is not None and blocked_until > now:
+            return blocked_until - now
+
+        # The bucket is refilled for the time since its last update, then a token is taken if available.
+        sql = text("""
+            INSERT INTO rate_limits AS r (key, tokens, allowed, updated_time)
+            VALUES (:key, :capacity - 1, true, NOW())
+            ON CONFLICT (key) DO UPDATE SET
+                allowed = LEAST(:capacity, r.tokens + EXTRACT(EPOCH FROM NOW() - r.updated_time) * :rate) >= 1,
+                tokens = LEAST(:capacity, r.tokens + EXTRACT(EPOCH FROM NOW() - r.updated_time) * :rate)
+                    - CASE WHEN LEAST(:capacity, r.tokens + EXTRACT(EPOCH FROM NOW() - r.updated_time) * :rate) >= 1
+                           THEN 1 ELSE 0 END,
+                updated_time = NOW()
+            RETURNING allowed, tokens
+        """)
+        db = Database()
+        row = db.execute(sql, {"key": key, "capacity": capacity, "rate": rate})
+
+        with self._lock:
+            self._hits += 1
+            cleanup = self._hits % CLEANUP_EVERY == 0
+            if len(self._blocked_until) > MAX_KEYS:
+                self._blocked_until = {key: until for key, until in self._blocked_until.items() if until > now}
+        if cleanup:
+            sql = text("""DELETE FROM rate_limits WHERE updated_time < NOW() - make_interval(secs => :seconds)""")
+            db.execute(sql, {"seconds": STALE_AFTER_SECONDS}, False)
+
+        if row is None or row["allowed"]:
+            return 0
+        retry_after = (1 - row["tokens"]) / rate
+        with self._lock:
+            self._blocked_until[key] = now + retry_after
+        return retry_after
+
+
+_backend = None
+_backend_lock = Lock()
+
+
+def get_backend():
+    """
+    Returns the rate limiter backend, created on first use from the environment.
+
+    RATE_LIMIT_BACKEND selects "postgres" (the default), shared by every worker and node, or
+    "memory", counted separately by every process.
+
+    Returns:
+        PostgresBackend or MemoryBackend: The backend.
+    """
+
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                kind = getenv("RATE_LIMIT_BACKEND", "postgres").lower()
+                if kind not in ("postgres", "memory"):
+                    raise RuntimeError(f"Unknown RATE_LIMIT_BACKEND {kind!r}, expected 'postgres' or 'memory'")
+                _backend = PostgresBackend() if kind == "postgres" else MemoryBackend()
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replaces the rate limiter backend.
+
+    Args:
+        backend (PostgresBackend or MemoryBackend or None): The backend, or None to create it from the
+            environment again on next use.
+    """
+
+    global _backend
+    _backend = backend
+
+
+def hit(key, limit, period):
+    """
+    Counts a request against a limit of requests per period.
+
+    The limit is a token bucket holding up to limit tokens, refilled at limit / period tokens per
+    second, so a client may burst up to the limit and then continue at the average rate.
+
+    Args:
+        key (str): What is limited, for example the action and the client's IP address.
+        limit (int): The number of requests allowed per period.
+        period (float): The period, in seconds.
+
+    Returns:
+        float: 0 if the request is allowed, otherwise the number of seconds until it would be.
+    """
+
+    return get_backend().hit(key, limit, limit / period)
+
+
+def too_many_requests(retry_after):
+    """
+    Creates the response to a rejected request. It is a short plain text response, so that a
+    client over its limit costs no template rendering or session update.
+
+    Args:
+        retry_after (float): The number of seconds until the request would be allowed.
+
+    Returns:
+        Response: The 429 Too Many Requests response.
+    """
+
+    seconds = max(1, math.ceil(retry_after))
+    return Response(f"Too many requests, please try again in {seconds} seconds.\n", 429,
+                    {"Retry-After": str(seconds)}, mimetype="text/plain")
@@ -0,0 +1,247 @@
+import re
+from markupsafe import Markup, escape
+from sqlalchemy import text
+from ..utils.db import Database
+from ..utils import access
+from ..utils.access import AREA_IDS_CONDITION
+
+
+# Text search configuration used for the search_vector columns and for parsing queries.
+# 'simple' does no stemming or stop word removal, which suits user content in mixed languages.
+SEARCH_CONFIG = "simple"
+
+# The number of results per section on one page of search results.
+RESULTS_PER_PAGE = 20
+
+# Matches are counted up to this limit, beyond which the total is reported as an estimate.
+COUNT_LIMIT = 1000
+
+# Control characters marking highlighted words in ts_headline output. They cannot occur in
+# escaped HTML, so the snippet can be escaped first and the markers replaced afterwards.
+_HIGHLIGHT_START = "\x02"
+_HIGHLIGHT_STOP = "\x03"
+_HEADLINE_OPTIONS = f"StartSel={_HIGHLIGHT_START}, StopSel={_HIGHLIGHT_STOP}, MaxWords=35, MinWords=15"
+
+
+class SearchResults:
+    """
+    One page of search results for a single kind of item.
+
+    Attributes:
+        items (list[dict]): The results on the page, best match first.
+        total (int): The number of matches, counted up to COUNT_LIMIT.
+        is_estimate (bool): True if there are more than COUNT_LIMIT matches.
+        page (int): The page number, starting from 1.
+        has_next (bool): Whether there is a following page of results.
+    """
+
+    def __init__(self, items=None, total=0, page=1, has_next=False):
+        """
+        Initializes a SearchResults object.
+
+        Args:
+            items (list[dict], optional): The results on the page. Defaults to an empty list.
+            total (int, optional): The capped number of matches, only shown to the user. Defaults to 0.
+            page (int, optional): The page number. Defaults to 1.
+            has_next (bool, optional): Whether there is a following page of results. Defaults to False.
+        """
+
+        self.items = items or []
+        self.total = total
+        self.is_estimate = total >= COUNT_LIMIT
+        self.page = page
+        self.has_next = has_next
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class StreamedResults:
+    """
+    Every match for a single kind of item, read from a server-side cursor while the page is rendered.
+
+    The matches are not counted, so total is None and there are no further pages.
+
+    Attributes:
+        total (None): The number of matches, which is not known in advance.
+        is_estimate (bool): Always False.
+        page (None): There are no pages.
+        has_next (bool): Always False.
+    """
+
+    total = None
+    is_estimate = False
+    page = None
+    has_next = False
+
+    def __init__(self, items):
+        """
+        Initializes a StreamedResults object.
+
+        Args:
+            items (iterable[dict]): The matches, best match first, typically a generator.
+        """
+
+        self._items = items
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+def build_tsquery(query):
+    """
+    Converts free-form user input into a tsquery string matching all words as prefixes.
+
+    Args:
+        query (str): The search query entered by the user.
+
+    Returns:
+        str or None: A string for to_tsquery, or None if the query contains no searchable words.
+    """
+
+    words = re.findall(r"\w+", query)
+    if not words:
+        return None
+    return " & ".join(f"{word}:*" for word in words)
+
+
+def highlight(snippet):
+    """
+    Escapes a ts_headline snippet and marks the matched words with <mark> tags.
+
+    Args:
+        snippet (str): The snippet returned by ts_headline.
+
+    Returns:
+        Markup: The HTML-safe highlighted snippet.
+    """
+
+    escaped = str(escape(snippet))
+    return Markup(escaped.replace(_HIGHLIGHT_START, "<mark>").replace(_HIGHLIGHT_STOP, "</mark>"))
+
+
+def search_areas(query, user_id, page=1):
+    """
+    Searches area topics visible to the user.
+
+    Args:
+        query (str): The search query entered by the user.
+        user_id (int): The ID of the user performing the search.
+        page (int or None, optional): The page number, or None for every match. Defaults to 1.
+
+    Returns:
+        SearchResults or StreamedResults: The matching areas with their id and topic.
+    """
+
+    sql = f"""
+        SELECT a.id, a.topic, ts_rank(a.search_vector, q.query) AS rank
+        FROM areas a, to_tsquery('{SEARCH_CONFIG}', :query) q(query)
+        WHERE a.search_vector @@ q.query AND {AREA_IDS_CONDITION}
+    """
+    return _search(sql, "ORDER BY rank DESC, id DESC", query, user_id, page)
+
+
+def search_threads(query, user_id, page=1):
+    """
+    Searches thread titles in areas visible to the user.
+
+    Args:
+        query (str): The search query entered by the user.
+        user_id (int): The ID of the user performing the search.
+        page (int or None, optional): The page number, or None for every match. Defaults to 1.
+
+    Returns:
+        SearchResults or StreamedResults: The matching threads with their id, title and area_topic.
+    """
+
+    sql = f"""
+        SELECT t.id, t.title, a.topic AS area_topic, ts_rank(t.search_vector, q.query) AS rank
+        FROM threads t
+        JOIN areas a ON t.area = a.id,
+        to_tsquery('{SEARCH_CONFIG}', :query) q(query)
+        WHERE t.search_vector @@ q.query AND {AREA_IDS_CONDITION}
+    """
+    return _search(sql, "ORDER BY rank DESC, id DESC", query, user_id, page)
+
+
+def search_messages(query, user_id, page=1):
+    """
+    Searches message texts in areas visible to the user.
+
+    Args:
+        query (str): The search query entered by the user.
+        user_id (int): The ID of the user performing the search.
+        page (int or None, optional): The page number, or None for every match. Defaults to 1.
+
+    Returns:
+        SearchResults or StreamedResults: The matching messages with their id, text, highlighted snippet, thread,
+        thread_title, area_topic and sender_name.
+    """
+
+    sql = f"""
+        SELECT m.id, m.text, m.thread, t.title AS thread_title, a.topic AS area_topic,
+               m.sender, ts_rank(m.search_vector, q.query) AS rank
+        FROM messages m
+        JOIN threads t ON m.thread = t.id
+        JOIN areas a ON t.area = a.id,
+        to_tsquery('{SEARCH_CONFIG}', :query) q(query)
+        WHERE m.search_vector @@ q.query AND {AREA_IDS_CONDITION}
+    """
+    # Snippets and sender names are only produced for the rows on the page.
+    outer = f"""
+        SELECT r.id, r.text, r.thread, r.thread_title, r.area_topic, u.username AS sender_name,
+               ts_headline('{SEARCH_CONFIG}', r.text, to_tsquery('{SEARCH_CONFIG}', :query), :headline_options) AS snippet
+        FROM ({{page}}) r
+        JOIN users u ON r.sender = u.id
+        ORDER BY r.rank DESC, r.id DESC
+    """
+    results = _search(sql, "ORDER BY rank DESC, id DESC", query, user_id, page, outer)
+    if page is None:
+        return StreamedResults(dict(item, snippet=highlight(item["snippet"])) for item in results)
+    for item in results.items:
+        item["snippet"] = highlight(item["snippet"])
+    return results
+
+
+def _search(sql, order_by, query, user_id, page, outer=None):
+    tsquery = build_tsquery(query)
+    visible = access.visible_areas(user_id)
+    if not tsquery or visible is None:
+        return StreamedResults([]) if page is None else SearchResults(page=page)
+
+    if page is None:
+        return _stream(sql, order_by, tsquery, visible, outer)
+
+    params = {
+        "query": tsquery,
+        "area_ids": visible.ids,
+        "limit": RESULTS_PER_PAGE + 1,
+        "offset": (page - 1) * RESULTS_PER_PAGE,
+        "count_limit": COUNT_LIMIT,
+        "headline_options": _HEADLINE_OPTIONS,
+    }
+
+    db = Database()
+    count_sql = text(f"SELECT COUNT(*) FROM ({sql} LIMIT :count_limit) matches")
+    total = db.fetch_one(count_sql, params)["count"]
+    # Below the cap the count is exact, so a page past the end needs no query. Above it the
+    # count is only shown, and whether there are more pages is found out by fetching one extra row.
+    if total < COUNT_LIMIT and total <= params["offset"]:
+        return SearchResults(total=total, page=page)
+
+    page_sql = f"SELECT * FROM ({sql}) matches {order_by} LIMIT :limit OFFSET :offset"
+    if outer:
+        page_sql = outer.replace("{page}", page_sql)
+    items = [dict(row) for row in db.fetch_all(text(page_sql), params)]
+    return SearchResults(items[:RESULTS_PER_PAGE], total, page, len(items) > RESULTS_PER_PAGE)
+
+
+def _stream(sql, order_by, tsquery, visible, outer=None):
+    params = {"query": tsquery, "area_ids": visible.ids, "headline_options": _HEADLINE_OPTIONS}
+    all_sql = f"SELECT * FROM ({sql}) matches {order_by}"
+    if outer:
+        all_sql = outer.replace("{page}", all_sql)
+    return StreamedResults(dict(row._mapping) for row in Database().stream_rows(text(all_sql), params))
@@ -0,0 +1,215 @@
+from datetime import datetime
+from sqlalchemy import text
+from ..utils.db import Database
+
+
+# Statistics are denormalized into area_stats and thread_stats. The functions in this module are
+# called from the write paths inside the same transaction as the change they account for.
+
+
+def create_area_stats(area_id):
+    """
+    Creates the statistics row for a newly inserted area.
+
+    Args:
+        area_id (int): The ID of the area.
+    """
+
+    sql = text("""INSERT INTO area_stats (area_id) VALUES (:area_id) ON CONFLICT (area_id) DO NOTHING""")
+    Database().execute(sql, {"area_id": area_id}, False)
+
+
+def record_thread(thread_id, area_id):
+    """
+    Creates the statistics row for a newly inserted thread and counts it in its area.
+
+    Args:
+        thread_id (int): The ID of the thread.
+        area_id (int): The ID of the area containing the thread.
+    """
+
+    sql = text("""
+        WITH ts AS (
+            INSERT INTO thread_stats (thread_id, area_id, last_activity) VALUES (:thread_id, :area_id, :created_time)
+            RETURNING area_id
+        )
+        INSERT INTO area_stats (area_id, thread_count)
+        SELECT area_id, 1 FROM ts
+        ON CONFLICT (area_id) DO UPDATE SET thread_count = area_stats.thread_count + 1
+    """)
+    # Message times come from the application clock, so thread activity uses the same clock.
+    Database().execute(sql, {"thread_id": thread_id, "area_id": area_id, "created_time": datetime.now()}, False)
+
+
+def record_message(thread_id, message_id, sent_time):
+    """
+    Counts a newly inserted message in its thread and area and updates their last message.
+
+    Args:
+        thread_id (int): The ID of the thread containing the message.
+        message_id (int): The ID of the message.
+        sent_time (datetime): The time the message was sent.
+    """
+
+    sql = text("""
+        WITH ts AS (
+            UPDATE thread_stats
+            SET message_count = message_count + 1,
+                last_message_id = CASE WHEN last_message_time IS NULL OR last_message_time <= :sent_time
+                                       THEN :message_id ELSE last_message_id END,
+                last_message_time = GREATEST(last_message_time, :sent_time),
+                last_activity = GREATEST(last_activity, :sent_time)
+            WHERE thread_id = :thread_id
+            RETURNING area_id
+        )
+        UPDATE area_stats
+        SET message_count = message_count + 1,
+            last_message_id = CASE WHEN last_message_time IS NULL OR last_message_time <= :sent_time
+                                   THEN :message_id ELSE last_message_id END,
+            last_message_time = GREATEST(last_message_time, :sent_time)
+        WHERE area_id = (SELECT area_id FROM ts)
+    """)
+    Database().execute(sql, {"thread_id": thread_id, "message_id": message_id, "sent_time": sent_time}, False)
+
+
+def record_edit(thread_id):
+    """
+    Counts an edited message in its thread, so that the version of the thread page changes.
+
+    Args:
+        thread_id (int): The ID of the thread containing the message.
+    """
+
+    sql = text("""UPDATE thread_stats SET edit_count = edit_count + 1 WHERE thread_id = :thread_id""")
+    Database().execute(sql, {"thread_id": thread_id}, False)
+
+
+def remove_message(thread_id):
+    """
+    Accounts for a message deleted from a thread.
+
+    The counters are decremented, the edit counter of the thread is incremented and the last
+    message of the thread and its area is looked up again.
+
+    Args:
+        thread_id (int): The ID of the thread the message was deleted from.
+    """
+
+    sql = text("""
+        WITH ts AS (
+            UPDATE thread_stats
+            SET message_count = message_count - 1,
+                edit_count = edit_count + 1,
+                (last_message_id, last_message_time) = (
+                    SELECT m.id, m.sent_time FROM messages m
+                    WHERE m.thread = :thread_id
+                    ORDER BY m.sent_time DESC, m.id DESC
+                    LIMIT 1
+                )
+            WHERE thread_id = :thread_id
+            RETURNING area_id
+        )
+        UPDATE area_stats SET message_count = message_count - 1
+        WHERE area_id = (SELECT area_id FROM ts)
+        RETURNING area_id
+    """)
+    result = Database().execute(sql, {"thread_id": thread_id})
+    if result:
+        refresh_area(result["area_id"])
+
+
+def remove_thread(area_id, message_count):
+    """
+    Accounts for a thread deleted from an area.
+
+    Args:
+        area_id (int): The ID of the area the thread was deleted from.
+        message_count (int): The number of messages the thread contained.
+    """
+
+    sql = text("""
+        UPDATE area_stats
+        SET thread_count = thread_count - 1,
+            message_count = message_count - :message_count
+        WHERE area_id = :area_id
+    """)
+    Database().execute(sql, {"area_id": area_id, "message_count": message_count or 0}, False)
+    refresh_area(area_id)
+
+
+def refresh_area(area_id):
+    """
+    Looks up the last message of an area again after one of its threads or messages has been deleted.
+
+    Args:
+        area_id (int): The ID of the area.
+    """
+
+    sql = text("""
+        UPDATE area_stats
+        SET (last_message_id, last_message_time) = (
+            SELECT ts.last_message_id, ts.last_message_time FROM thread_stats ts
+            WHERE ts.area_id = :area_id AND ts.last_message_time IS NOT NULL
+            ORDER BY ts.last_message_time DESC, ts.last_message_id DESC
+            LIMIT 1
+        )
+        WHERE area_id = :area_id
+    """)
+    Database().execute(sql, {"area_id": area_id}, False)
+
+
+def rebuild_stats():
+    """
+    Recomputes all area and thread statistics from the messages and threads tables.
+
+    Intended to be run after restoring a backup or whenever the statistics are suspected to be
+    out of sync. The rebuild runs in a single transaction.
+
+    Returns:
+        tuple: The number of area and thread statistics rows written.
+    """
+
+    db = Database()
+    with db.transaction():
+        db.execute(text("""DELETE FROM thread_stats"""), None, False)
+        db.execute(text("""DELETE FROM area_stats"""), None, False)
+        thread_count = db.execute(text("""
+            WITH inserted AS (
+                INSERT INTO thread_stats (thread_id, area_id, message_count, last_message_time, last_message_id, last_activity)
+                SELECT t.id, t.area, COALESCE(c.message_count, 0), last.sent_time, last.id,
+                       COALESCE(last.sent_time, :now)
+                FROM threads t
+                LEFT JOIN (
+                    SELECT m.thread, COUNT(*) AS message_count FROM messages m GROUP BY m.thread
+                ) c ON c.thread = t.id
+                LEFT JOIN LATERAL (
+                    SELECT m.id, m.sent_time FROM messages m
+                    WHERE m.thread = t.id
+                    ORDER BY m.sent_time DESC, m.id DESC
+                    LIMIT 1
+                ) last ON true
+                RETURNING 1
+            )
+            SELECT COUNT(*) FROM inserted
+        """), {"now": datetime.now()})["count"]
+        area_count = db.execute(text("""
+            WITH inserted AS (
+                INSERT INTO area_stats (area_id, thread_count, message_count, last_message_time, last_message_id)
+                SELECT a.id, COALESCE(c.thread_count, 0), COALESCE(c.message_count, 0),
+                       last.last_message_time, last.last_message_id
+                FROM areas a
+                LEFT JOIN (
+                    SELECT ts.area_id, COUNT(*) AS thread_count, SUM(ts.message_count) AS message_count
+                    FROM thread_stats ts GROUP BY ts.area_id
+                ) c ON c.area_id = a.id
+                LEFT JOIN LATERAL (
+                    SELECT ts.last_message_id, ts.last_message_time FROM thread_stats ts
+                    WHERE ts.area_id = a.id AND ts.last_message_time IS NOT NULL
+                    ORDER BY ts.last_message_time DESC, ts.last_message_id DESC
+                    LIMIT 1
+                ) last ON true
+                RETURNING 1
+            )
+            SELECT COUNT(*) FROM inserted
+        """))["count"]
+    return area_count, thread_count
@@ -0,0 +1,254 @@
+import mimetypes
+import os
+import uuid
+from os import getenv
+from pathlib import Path
+from threading import Lock
+from flask import Response, make_response, redirect, send_from_directory
+
+
+# Objects are deleted in batches of at most this many keys, the limit of the S3 DeleteObjects call.
+S3_DELETE_BATCH = 1000
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class LocalStorage:
+    """
+    Stores attachment files in a directory of the local filesystem.
+
+    Only suitable for a single web node, or for several sharing the directory over a network filesystem.
+
+    Attributes:
+        directory (Path): The directory the files are stored in.
+        sendfile (str): "x-accel-redirect" or "x-sendfile" to let the reverse proxy send the files,
+            otherwise the application sends them.
+        accel_prefix (str): The internal nginx location mapped to the directory, used with X-Accel-Redirect.
+    """
+
+    def __init__(self, directory, sendfile="", accel_prefix="/internal/attachments/"):
+        """
+        Initializes a LocalStorage object.
+
+        Args:
+            directory (str or Path): The directory the files are stored in.
+            sendfile (str, optional): "x-accel-redirect" or "x-sendfile" to let the reverse proxy send
+                the files. Defaults to "".
+            accel_prefix (str, optional): The internal nginx location mapped to the directory.
+                Defaults to "/internal/attachments/".
+        """
+
+        self.directory = Path(directory)
+        self.sendfile = sendfile.lower()
+        self.accel_prefix = accel_prefix
+
+    def put(self, name, data):
+        """
+        Writes a file. Readers never see a partially written file, and writing the same file
+        concurrently just replaces it.
+
+        Args:
+            name (str): The name of the file.
+            data (bytes): The contents of the file.
+        """
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / name
+        temporary_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.part")
+        try:
+            temporary_path.write_bytes(data)
+            os.replace(temporary_path, path)
+        finally:
+            temporary_path.unlink(missing_ok=True)
+
+    def delete(self, names):
+        """
+        Deletes files. Files that do not exist are ignored.
+
+        Args:
+            names (list[str]): The names of the files.
+        """
+
+        for name in names:
+            (self.directory / os.path.basename(name)).unlink(missing_ok=True)
+
+    def send(self, name):
+        """
+        Creates the response serving a file.
+
+        With X-Accel-Redirect or X-Sendfile the response only carries a header naming the file,
+        and the worker is free as soon as it is written.
+
+        Args:
+            name (str): The name of the file.
+
+        Returns:
+            Response: The response.
+        """
+
+        if self.sendfile not in ("x-accel-redirect", "x-sendfile"):
+            return send_from_directory(self.directory.resolve(), name)
+
+        response = make_response("")
+        response.mimetype = _mimetype(name)
+        if self.sendfile == "x-accel-redirect":
+            response.headers["X-Accel-Redirect"] = self.accel_prefix + name
+        else:
+            response.headers["X-Sendfile"] = str((self.directory / name).resolve())
+        return response
+
+
+class S3Storage:
+    """
+    Stores attachment files as objects in an S3-compatible object store, shared by every web node.
+
+    Attributes:
+        client: A boto3 S3 client, or any object implementing put_object, delete_objects and get_object.
+        bucket (str): The name of the bucket.
+        prefix (str): Prepended to the names of the files to form the object keys.
+        public_url (str): The URL under which the objects are publicly readable, for example
+            through a CDN. If set, files are served by redirecting there, otherwise they are
+            streamed through the application.
+    """
+
+    def __init__(self, bucket, client=None, prefix="", public_url="", endpoint_url=None, region=None):
+        """
+        Initializes an S3Storage object.
+
+        Args:
+            bucket (str): The name of the bucket.
+            client (optional): The S3 client. Defaults to a boto3 client for endpoint_url and region,
+                with credentials taken from the environment as usual for boto3.
+            prefix (str, optional): Prepended to the names of the files to form the object keys. Defaults to "".
+            public_url (str, optional): The URL under which the objects are publicly readable. Defaults to "".
+            endpoint_url (str, optional): The endpoint of an S3-compatible store such as MinIO. Defaults to AWS.
+            region (str, optional): The region of the bucket.
+        """
+
+        if client is None:
+            try:
+                import boto3
+            except ImportError as error:
+                raise RuntimeError("ATTACHMENT_STORAGE=s3 requires the boto3 package") from error
+            client = boto3.client("s3", endpoint_url=endpoint_url, region_name=region)
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_url = public_url.rstrip("/")
+
+    def put(self, name, data):
+        """
+        Uploads a file. Objects are written whole, so readers never see a partially written file.
+
+        Args:
+            name (str): The name of the file.
+            data (bytes): The contents of the file.
+        """
+
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + name,
+            Body=data,
+            ContentType=_mimetype(name),
+            CacheControl="public, max-age=31536000, immutable",
+        )
+
+    def delete(self, names):
+        """
+        Deletes files. Files that do not exist are ignored.
+
+        Args:
+            names (list[str]): The names of the files.
+        """
+
+        keys = [{"Key": self.prefix + name} for name in names]
+        for start in range(0, len(keys), S3_DELETE_BATCH):
+            batch = keys[start:start + S3_DELETE_BATCH]
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": batch, "Quiet": True})
+
+    def send(self, name):
+        """
+        Creates the response serving a file, a redirect to its public URL or the streamed object.
+
+        Args:
+            name (str): The name of the file.
+
+        Returns:
+            Response: The response, or a 404 response if the object does not exist.
+        """
+
+        if self.public_url:
+            return redirect(f"{self.public_url}/{self.prefix}{name}", 301)
+
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self.prefix + name)
+        except self.client.exceptions.NoSuchKey:
+            return make_response("", 404)
+        body = obj["Body"]
+
+        def stream():
+            try:
+                yield from body.iter_chunks(_CHUNK_SIZE)
+            finally:
+                body.close()
+
+        return Response(stream(), mimetype=_mimetype(name), headers={"Content-Length": str(obj["ContentLength"])})
+
+
+_backend = None
+_backend_lock = Lock()
+
+
+def get_backend():
+    """
+    Returns the storage backend of attachment files, created on first use from the environment.
+
+    ATTACHMENT_STORAGE selects "local" (the default) or "s3". The local backend stores files in
+    ATTACHMENT_DIR and honours ATTACHMENT_SENDFILE and ATTACHMENT_ACCEL_PREFIX. The S3 backend
+    uses S3_BUCKET, S3_PREFIX, S3_PUBLIC_URL, S3_ENDPOINT_URL and S3_REGION.
+
+    Returns:
+        LocalStorage or S3Storage: The backend.
+    """
+
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _create_backend()
+    return _backend
+
+
+def set_backend(backend):
+    """
+    Replaces the storage backend, for example with one using a preconfigured client.
+
+    Args:
+        backend (LocalStorage or S3Storage or None): The backend, or None to create it from the environment again on next use.
+    """
+
+    global _backend
+    _backend = backend
+
+
+def _create_backend():
+    kind = getenv("ATTACHMENT_STORAGE", "local").lower()
+    if kind == "s3":
+        return S3Storage(
+            getenv("S3_BUCKET"),
+            prefix=getenv("S3_PREFIX", ""),
+            public_url=getenv("S3_PUBLIC_URL", ""),
+            endpoint_url=getenv("S3_ENDPOINT_URL") or None,
+            region=getenv("S3_REGION") or None,
+        )
+    if kind == "local":
+        return LocalStorage(
+            getenv("ATTACHMENT_DIR", "./attachments"),
+            sendfile=getenv("ATTACHMENT_SENDFILE", ""),
+            accel_prefix=getenv("ATTACHMENT_ACCEL_PREFIX", "/internal/attachments/"),
+        )
+    raise RuntimeError(f"Unknown ATTACHMENT_STORAGE {kind!r}, expected 'local' or 's3'")
+
+
+def _mimetype(name):
+    return mimetypes.guess_type(name)[0] or "application/octet-stream"
@@ -0,0 +1,161 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from os import getenv
+from threading import Lock
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger("webchat.turnstile")
+
+DEFAULT_VERIFY_URL = "https://challenges.cloudflare.com/turnstile/v0/siteverify"
+
+# A Turnstile token is valid for five minutes, so a verified one is remembered for as long.
+TOKEN_LIFETIME = 300
+
+# The maximum number of verified tokens remembered by each worker process.
+CACHE_SIZE = 10000
+
+# Connections kept open to the verifier; one per request thread is enough.
+POOL_SIZE = 32
+
+
+class TokenCache:
+    """
+    A thread-safe, size-bounded set of verified tokens that expire after TOKEN_LIFETIME seconds.
+
+    Tokens are stored as hashes, as they are credentials, together with the client address and
+    the form they were verified for. A token is only accepted again from the same client for the
+    same form, so a solved challenge cannot be replayed elsewhere.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE, lifetime=TOKEN_LIFETIME):
+        """
+        Initializes an empty TokenCache object.
+
+        Args:
+            max_entries (int, optional): The maximum number of tokens kept. Defaults to CACHE_SIZE.
+            lifetime (float, optional): Seconds a token is kept. Defaults to TOKEN_LIFETIME.
+        """
+
+        self.max_entries = max_entries
+        self.lifetime = lifetime
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def add(self, token, remote_ip=None, form=None):
+        """
+        Remembers a verified token.
+
+        Args:
+            token (str): The token.
+            remote_ip (str, optional): The address of the client the token was verified for.
+            form (str, optional): The form the token was submitted with.
+        """
+
+        key = _digest(token)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.lifetime, remote_ip, form)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def accepts(self, token, remote_ip=None, form=None):
+        """
+        Checks whether a token has been verified for the same client and form, and has not expired.
+
+        Args:
+            token (str): The token.
+            remote_ip (str, optional): The address of the client.
+            form (str, optional): The form the token is submitted with.
+
+        Returns:
+            bool: True if the token can be accepted without verifying it again.
+        """
+
+        key = _digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            expires, verified_ip, verified_form = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return False
+            return verified_ip == remote_ip and verified_form == form
+
+    def clear(self):
+        """
+        Forgets all tokens.
+        """
+
+        with self._lock:
+            self._entries.clear()
+
+
+verified_tokens = TokenCache()
+
+_session = None
+_session_lock = Lock()
+
+
+def verify(token, remote_ip=None, form=None):
+    """
+    Verifies a Turnstile token with the siteverify endpoint.
+
+    Requests go through a pooled session with connect and read timeouts, configured in seconds
+    with TURNSTILE_CONNECT_TIMEOUT and TURNSTILE_READ_TIMEOUT. A token that has been verified is
+    accepted again without a request for TOKEN_LIFETIME seconds from the same client for the
+    same form, for example when the form is submitted again after a validation error. If the
+    endpoint cannot be reached or gives no valid answer, TURNSTILE_FAIL_MODE decides: "closed"
+    (the default) rejects the request and "open" accepts it.
+
+    Args:
+        token (str): The cf-turnstile-response form value.
+        remote_ip (str, optional): The address of the client, passed on to Cloudflare.
+        form (str, optional): The form the token is submitted with, such as the endpoint of the view.
+
+    Returns:
+        bool: True if the token is valid.
+    """
+
+    if not token:
+        return False
+    if verified_tokens.accepts(token, remote_ip, form):
+        return True
+
+    data = {"secret": getenv("TURNSTILE_SECRET", ""), "response": token}
+    if remote_ip:
+        data["remoteip"] = remote_ip
+    timeout = (float(getenv("TURNSTILE_CONNECT_TIMEOUT", "2")), float(getenv("TURNSTILE_READ_TIMEOUT", "3")))
+    try:
+        response = _get_session().post(getenv("TURNSTILE_VERIFY_URL", DEFAULT_VERIFY_URL), data=data, timeout=timeout)
+        response.raise_for_status()
+        success = response.json().get("success") is True
+    except (requests.RequestException, ValueError) as error:
+        fail_open = getenv("TURNSTILE_FAIL_MODE", "closed").lower() == "open"
+        logger.warning("Turnstile verification unavailable, %s request: %s", "accepting" if fail_open else "rejecting", error)
+        return fail_open
+
+    if success:
+        verified_tokens.add(token, remote_ip, form)
+    return success
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # No retries: a slow verifier must not hold the worker for longer than the timeouts.
+                session.mount("https://", HTTPAdapter(pool_maxsize=POOL_SIZE, max_retries=0))
+                session.mount("http://", HTTPAdapter(pool_maxsize=POOL_SIZE, max_retries=0))
+                _session = session
+    return _session
+
+
+def _digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
@@ -0,0 +1,187 @@
+import hashlib
+import io
+import os
+import tempfile
+from os import getenv
+from pathlib import Path
+from PIL import Image, ImageOps, UnidentifiedImageError
+from ..utils import attachments
+
+
+# Images uploaded before attachments were stored by content, served by the static route under UPLOAD_URL.
+UPLOAD_DIR = Path("./app/static/uploads")
+UPLOAD_URL = "/static/uploads/"
+
+# Formats accepted as uploads; everything is re-encoded to OUTPUT_FORMAT.
+ALLOWED_FORMATS = {"JPEG", "PNG", "GIF", "WEBP"}
+OUTPUT_FORMAT = "WEBP"
+OUTPUT_EXTENSION = ".webp"
+OUTPUT_QUALITY = 80
+
+# Images are downscaled to fit this size, and thumbnails are generated at these widths.
+MAX_DIMENSION = 2048
+THUMBNAIL_WIDTHS = (320, 640)
+
+# Images with more pixels than this are rejected before decoding, to guard against decompression bombs.
+MAX_PIXELS = 40_000_000
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """
+    Raised when an uploaded file is rejected. The message is suitable for showing to the user.
+    """
+
+
+def save_image(file):
+    """
+    Validates an uploaded image and stores it re-encoded, with its thumbnails, as an attachment.
+
+    The upload is streamed to a temporary file, hashed on the way, and rejected as soon as it
+    exceeds max_upload_bytes(). Attachments are named by that hash, so an image that has been
+    uploaded before is not decoded again and shares the stored files. Otherwise the image is
+    decoded, rotated according to its EXIF orientation, downscaled to fit MAX_DIMENSION and
+    re-encoded without any metadata. Animated images keep their first frame.
+
+    Args:
+        file (FileStorage): The uploaded file.
+
+    Returns:
+        str: The URL of the stored image. Thumbnail URLs are derived from it with thumbnail_url.
+
+    Raises:
+        UploadError: If the file is too large or is not a valid image in an allowed format.
+    """
+
+    with tempfile.TemporaryFile() as upload:
+        content_hash = _stream_to_disk(file, upload)
+
+        def encode():
+            upload.seek(0)
+            image = _open_image(upload)
+            image = image.convert("RGBA" if _has_transparency(image) else "RGB")
+            image.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.LANCZOS)
+            # No exif or icc_profile is passed on, so location and camera data are dropped.
+            files = {f"{content_hash}{OUTPUT_EXTENSION}": _encode(image)}
+            for width in THUMBNAIL_WIDTHS:
+                thumbnail = image.copy()
+                thumbnail.thumbnail((width, MAX_DIMENSION), Image.LANCZOS)
+                files[f"{content_hash}_{width}{OUTPUT_EXTENSION}"] = _encode(thumbnail)
+            return files
+
+        return attachments.store(f"{content_hash}{OUTPUT_EXTENSION}", encode)
+
+
+def max_upload_bytes():
+    """
+    The maximum size of an uploaded image, configured in megabytes with MAX_UPLOAD_MB.
+
+    Returns:
+        int: The size in bytes. Defaults to 10 MB.
+    """
+
+    return int(float(getenv("MAX_UPLOAD_MB", "10")) * 1024 * 1024)
+
+
+def thumbnail_url(image_url, width=THUMBNAIL_WIDTHS[-1]):
+    """
+    Derives the URL of a thumbnail of a stored image.
+
+    Images uploaded before thumbnails were generated have none, so their own URL is returned.
+
+    Args:
+        image_url (str): The URL returned by save_image.
+        width (int, optional): One of THUMBNAIL_WIDTHS. Defaults to the largest.
+
+    Returns:
+        str: The URL of the thumbnail.
+    """
+
+    if not image_url.endswith(OUTPUT_EXTENSION):
+        return image_url
+    return f"{image_url[:-len(OUTPUT_EXTENSION)]}_{width}{OUTPUT_EXTENSION}"
+
+
+def thumbnail_srcset(image_url):
+    """
+    Builds an img srcset attribute listing the thumbnails of a stored image.
+
+    Args:
+        image_url (str): The URL returned by save_image.
+
+    Returns:
+        str or None: The srcset value, or None if the image has no thumbnails.
+    """
+
+    if not image_url.endswith(OUTPUT_EXTENSION):
+        return None
+    return ", ".join(f"{thumbnail_url(image_url, width)} {width}w" for width in THUMBNAIL_WIDTHS)
+
+
+def delete_released(image_urls):
+    """
+    Deletes the images of deleted messages that were uploaded before attachments were stored by
+    content, once the deletion has committed. Attachments are deleted by attachments.sweep.
+
+    Args:
+        image_urls (list[str]): The URLs of the images of the deleted messages.
+    """
+
+    for image_url in image_urls:
+        if attachments.attachment_name(image_url) is None:
+            delete_image(image_url)
+
+
+def delete_image(image_url):
+    """
+    Deletes an image uploaded before attachments were stored by content, and its thumbnails.
+    Files that do not exist are ignored.
+
+    Args:
+        image_url (str): The URL of the image.
+    """
+
+    urls = {image_url} | {thumbnail_url(image_url, width) for width in THUMBNAIL_WIDTHS}
+    for url in urls:
+        if url.startswith(UPLOAD_URL):
+            (UPLOAD_DIR / os.path.basename(url)).unlink(missing_ok=True)
+
+
+def _stream_to_disk(file, output):
+    limit = max_upload_bytes()
+    size = 0
+    content_hash = hashlib.sha256()
+    while True:
+        chunk = file.stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise UploadError(f"Image is too large, the maximum size is {limit / (1024 * 1024):g} MB")
+        content_hash.update(chunk)
+        output.write(chunk)
+    return content_hash.hexdigest()
+
+
+def _encode(image):
+    output = io.BytesIO()
+    image.save(output, OUTPUT_FORMAT, quality=OUTPUT_QUALITY)
+    return output.getvalue()
+
+
+def _open_image(file):
+    try:
+        with Image.open(file) as image:
+            if image.format not in ALLOWED_FORMATS:
+                raise UploadError("Unsupported image format")
+            if image.width * image.height > MAX_PIXELS:
+                raise UploadError("Image dimensions are too large")
+            # Returns a decoded copy, so the file can be closed.
+            return ImageOps.exif_transpose(image)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError, ValueError) as error:
+        raise UploadError("Invalid image file") from error
+
+
+def _has_transparency(image):
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
@@ -1,3 +1,7 @@
+import io
+import os
+import re
+import time
 import pytest
 from app import create_app
 from dotenv import load_dotenv
@@ -131,11 +135,13 @@ def test_send_invalid_message(test_client):
 
 def test_search(test_client):
     response = test_client.get('/search?query=t', follow_redirects=True)
+    # Matched words in message snippets are highlighted
+    data = response.data.replace(b"<mark>", b"").replace(b"</mark>", b"")
 
-    assert b"Test Area 123" in response.data
-    assert b"Test Thread 123" in response.data
-    assert b"Thread initial message" in response.data
-    assert b"New message in thread" in response.data
+    assert b"Test Area 123" in data
+    assert b"Test Thread 123" in data
+    assert b"Thread initial message" in data
+    assert b"New message in thread" in data
 
 
 def test_delete_message(test_client):
@@ -150,3 +156,646 @@ def test_delete_thread(test_client):
 
     assert response.status_code == 200
     assert b"Test Thread 123" not in response.data
+
+
+def test_thread_pagination(test_client):
+    test_client.post('/create_area', data={"topic": "Paging Area"}, follow_redirects=True)
+    test_client.post('/area/2/create_thread', data=dict(
+        title="Paging Thread",
+        message="Paging message 0"
+    ), follow_redirects=True)
+    for i in range(1, 60):
+        test_client.post('/thread/2/send_message', data={"message": f"Paging message {i}"})
+
+    response = test_client.get('/thread/2')
+    assert b"Paging message 59<" in response.data
+    assert b"Paging message 9<" not in response.data
+    assert b"Older messages" in response.data
+
+    older_url = re.search(rb'href="(/thread/2\?before=[^"]+)"', response.data).group(1).decode().replace("&amp;", "&")
+    response = test_client.get(older_url)
+    assert b"Paging message 9<" in response.data
+    assert b"Paging message 10<" not in response.data
+    assert b"Newer messages" in response.data
+
+    response = test_client.get('/thread/2?first=1')
+    assert b"Paging message 0<" in response.data
+    assert b"Paging message 59<" not in response.data
+    assert b"Newer messages" in response.data
+
+
+def test_thread_jump_to_message(test_client):
+    # Message 3 is the first message of the paging thread
+    response = test_client.get('/thread/2?around=3')
+
+    assert b'id="message-3"' in response.data
+    assert b"Older messages" not in response.data
+    assert b"Newer messages" in response.data
+
+
+def test_area_threads_ordered_by_activity(test_client):
+    test_client.post('/area/2/create_thread', data={"title": "Quiet Thread", "message": "First"}, follow_redirects=True)
+
+    response = test_client.get('/area/2')
+    assert response.data.index(b"Quiet Thread") < response.data.index(b"Paging Thread")
+
+    # Posting in the older thread bumps it to the top of the area
+    test_client.post('/thread/2/send_message', data={"message": "Bump"})
+    response = test_client.get('/area/2')
+    assert response.data.index(b"Paging Thread") < response.data.index(b"Quiet Thread")
+
+
+def test_server_timing_header(test_client):
+    response = test_client.get('/')
+
+    assert response.status_code == 200
+    assert "db;dur=" in response.headers["Server-Timing"]
+
+
+def test_subscriber_notified(test_client):
+    subscriber = {"username": "testuser4", "password": "VBt8fETYzn$64ecARjmG", "confirm_password": "VBt8fETYzn$64ecARjmG"}
+    logout(test_client)
+    test_client.post('/register', data=subscriber, follow_redirects=True)
+    login(test_client, subscriber["username"], subscriber["password"])
+    test_client.post('/toggle_subscription/2', follow_redirects=True)
+
+    logout(test_client)
+    login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG")
+    test_client.post('/thread/2/send_message', data={"message": "First for subscribers"})
+    test_client.post('/thread/2/send_message', data={"message": "Hello subscribers"})
+
+    logout(test_client)
+    response = login(test_client, subscriber["username"], subscriber["password"])
+    assert b'<span class="unread-count">1</span> unread' in response.data
+    response = test_client.get('/notifications')
+    assert b"Hello subscribers" in response.data
+    assert b'class="unread"' in response.data
+    assert b'<time datetime="' in response.data
+    assert b"2 new messages" in response.data
+    assert b"First for subscribers" not in response.data
+
+    test_client.get('/thread/2')
+    response = test_client.get('/notifications')
+    assert b"Hello subscribers" in response.data
+    assert b'class="unread"' not in response.data
+    assert b"No unread notifications" in response.data
+
+    logout(test_client)
+    login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG")
+
+
+def test_thread_events(test_client):
+    response = test_client.get('/thread/2')
+    last_id = int(re.findall(r'id="message-(\d+)"', response.data.decode())[-1])
+
+    # Resuming from the previous message replays the last one, then new changes are pushed.
+    response = test_client.get('/thread/2/events', headers={"Last-Event-ID": str(last_id - 1)}, buffered=False)
+    assert response.mimetype == "text/event-stream"
+    events = (chunk.decode() for chunk in response.response)
+    assert next(events).startswith("retry:")
+    assert next(events).startswith(f"id: {last_id}\nevent: message\n")
+
+    test_client.post('/thread/2/send_message', data={"message": "Live message"})
+    event = next(events)
+    assert "event: message" in event and "Live message" in event
+    new_id = int(re.search(r"^id: (\d+)", event).group(1))
+    assert new_id > last_id
+
+    test_client.post(f'/thread/2/edit_message/{new_id}', data={"edited_message": "Edited live message"})
+    event = next(events)
+    assert "event: edit" in event and "Edited live message" in event
+
+    test_client.post(f'/delete_message/{new_id}/2')
+    event = next(events)
+    assert "event: delete" in event and f'"id": {new_id}' in event
+    response.close()
+
+
+def test_delta_api(test_client):
+    data = test_client.get('/api/threads/2/messages?limit=200').get_json()
+    assert not data["has_more"]
+    assert data["last_id"] == data["messages"][-1]["id"]
+
+    # Polling from the last message returns nothing until a new message is posted.
+    data = test_client.get(f'/api/threads/2/messages?after={data["last_id"]}').get_json()
+    assert data["messages"] == []
+    test_client.post('/thread/2/send_message', data={"message": "Delta message"})
+    data = test_client.get(f'/api/threads/2/messages?after={data["last_id"]}').get_json()
+    assert [message["text"] for message in data["messages"]] == ["Delta message"]
+
+    data = test_client.get('/api/areas/2/threads').get_json()
+    assert {"Paging Thread", "Quiet Thread"} <= {thread["title"] for thread in data["threads"]}
+    cursor = data["cursor"]
+    assert test_client.get('/api/areas/2/threads', query_string={"since": cursor}).get_json()["threads"] == []
+    assert test_client.get('/api/areas/2/threads?since=yesterday').status_code == 400
+
+    # Timestamps with an offset are compared in the server's local time, like the stored activity times.
+    response = test_client.get('/api/areas/2/threads', query_string={"since": "2000-01-01T00:00:00Z"})
+    assert response.status_code == 200
+    assert {"Paging Thread", "Quiet Thread"} <= {thread["title"] for thread in response.get_json()["threads"]}
+    response = test_client.get('/api/areas/2/threads', query_string={"since": "2999-01-01T00:00:00+02:00"})
+    assert response.status_code == 200 and response.get_json()["threads"] == []
+
+    # Secret areas and their threads are hidden from users without access.
+    logout(test_client)
+    login(test_client, "admin", os.getenv("ADMIN_PASSWORD"))
+    test_client.post('/create_area', data={"topic": "Hidden Area", "is_secret": "on"}, follow_redirects=True)
+    test_client.post('/area/3/create_thread', data={"title": "Hidden Thread", "message": "Secret"}, follow_redirects=True)
+    hidden_thread = test_client.get('/api/areas/3/threads').get_json()["threads"][0]
+    assert hidden_thread["title"] == "Hidden Thread"
+
+    logout(test_client)
+    assert test_client.get('/api/areas/3/threads').status_code == 401
+    login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG")
+    assert test_client.get('/api/areas/3/threads').status_code == 404
+    assert test_client.get(f'/api/threads/{hidden_thread["id"]}/messages').status_code == 404
+
+
+def test_conditional_get(test_client):
+    for url in ['/', '/area/2', '/thread/2']:
+        response = test_client.get(url)
+        etag = response.headers["ETag"]
+        response = test_client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b""
+
+    # Editing a message changes the version of the thread page.
+    etag = test_client.get('/thread/2').headers["ETag"]
+    message_id = re.findall(r'id="message-(\d+)"', test_client.get('/thread/2').data.decode())[-1]
+    test_client.post(f'/thread/2/edit_message/{message_id}', data={"edited_message": "Edited for revalidation"})
+    response = test_client.get('/thread/2', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert b"Edited for revalidation" in response.data
+
+    # A new message changes the version of the index page.
+    etag = test_client.get('/').headers["ETag"]
+    test_client.post('/thread/2/send_message', data={"message": "Revalidate index"})
+    assert test_client.get('/', headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_fragment_cache(test_client):
+    from app.utils import fragments
+
+    test_client.get('/thread/2')
+    hits, misses = fragments.cache.hits, fragments.cache.misses
+    response = test_client.get('/thread/2')
+    assert (fragments.cache.hits, fragments.cache.misses) == (hits + 1, misses)
+
+    # Owner buttons are in the shared fragment and revealed for the user's own messages by the page.
+    assert b'class="owner-actions"' in response.data
+    assert b'data-sender="' in response.data
+    assert re.search(rb'<time datetime="[^"]+[+-]\d\d:\d\d">', response.data)
+
+    message_id = re.findall(r'id="message-(\d+)"', response.data.decode())[-1]
+    test_client.post(f'/thread/2/edit_message/{message_id}', data={"edited_message": "Edited after caching"})
+    response = test_client.get('/thread/2')
+    assert fragments.cache.misses == misses + 1
+    assert b"Edited after caching" in response.data
+
+
+def png_upload(color, size=(1200, 800)):
+    from PIL import Image
+
+    upload = io.BytesIO()
+    Image.new("RGB", size, color).save(upload, "PNG")
+    upload.seek(0)
+    return upload
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    from app.utils import storage
+
+    storage.set_backend(storage.LocalStorage(tmp_path))
+    yield tmp_path
+    storage.set_backend(None)
+
+
+def test_image_upload(test_client, monkeypatch, local_storage):
+    from PIL import Image
+    from app.utils import attachments
+
+    tmp_path = local_storage
+    test_client.post('/thread/2/send_message', data=dict(
+        message="With image",
+        image=(png_upload((200, 30, 30)), "photo.png")
+    ), content_type="multipart/form-data")
+
+    response = test_client.get('/thread/2')
+    image_url = re.search(r'href="(/attachments/[0-9a-f]{64}\.webp)"', response.data.decode()).group(1)
+    name = os.path.basename(image_url)
+    assert b"_640.webp 640w" in response.data
+    for file_name in [name, name.replace(".webp", "_320.webp"), name.replace(".webp", "_640.webp")]:
+        assert (tmp_path / file_name).exists()
+    with Image.open(tmp_path / name) as stored:
+        assert stored.format == "WEBP" and stored.size == (1200, 800)
+
+    response = test_client.post('/thread/2/send_message', data=dict(
+        message="Not an image",
+        image=(io.BytesIO(b"not an image"), "fake.png")
+    ), content_type="multipart/form-data", follow_redirects=True)
+    assert b"Invalid image file" in response.data
+
+    monkeypatch.setenv("MAX_UPLOAD_MB", "0.001")
+    response = test_client.post('/thread/2/send_message', data=dict(
+        message="Too large",
+        image=(io.BytesIO(os.urandom(5000)), "big.png")
+    ), content_type="multipart/form-data", follow_redirects=True)
+    assert b"Image is too large" in response.data
+
+    # Deleting the message orphans the image, the sweeper removes it and its thumbnails.
+    message_id = re.findall(r'id="message-(\d+)"', test_client.get('/thread/2').data.decode())[-1]
+    test_client.post(f'/delete_message/{message_id}/2')
+    assert len(os.listdir(tmp_path)) == 3
+    assert attachments.sweep() == (0, 0)
+    size = sum(path.stat().st_size for path in tmp_path.iterdir())
+    assert attachments.sweep(grace_seconds=0) == (1, size)
+    assert not os.listdir(tmp_path)
+
+
+def test_attachment_dedup(test_client, local_storage):
+    from app.utils import attachments, storage
+
+    tmp_path = local_storage
+    for _ in range(2):
+        test_client.post('/thread/2/send_message', data=dict(
+            message="Same image",
+            image=(png_upload((30, 200, 30)), "same.png")
+        ), content_type="multipart/form-data")
+
+    page = test_client.get('/thread/2').data.decode()
+    image_urls = re.findall(r'href="(/attachments/[0-9a-f]{64}\.webp)"', page)
+    assert len(image_urls) == 2 and image_urls[0] == image_urls[1]
+    assert len(os.listdir(tmp_path)) == 3
+
+    response = test_client.get(image_urls[0])
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+    assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+    assert test_client.get('/attachments/../.env').status_code == 404
+
+    storage.set_backend(storage.LocalStorage(tmp_path, sendfile="x-accel-redirect"))
+    response = test_client.get(image_urls[0])
+    assert response.headers["X-Accel-Redirect"] == "/internal/attachments/" + os.path.basename(image_urls[0])
+    assert response.data == b""
+
+    # The files are kept until the last message referencing them is deleted.
+    message_ids = re.findall(r'id="message-(\d+)"', page)[-2:]
+    test_client.post(f'/delete_message/{message_ids[0]}/2')
+    assert attachments.sweep(grace_seconds=0) == (0, 0)
+    assert len(os.listdir(tmp_path)) == 3
+    test_client.post(f'/delete_message/{message_ids[1]}/2')
+    assert attachments.sweep(grace_seconds=0)[0] == 1
+    assert not os.listdir(tmp_path)
+
+
+class FakeS3Client:
+    """
+    A local stand-in for the parts of the boto3 S3 client used by S3Storage.
+    """
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    class Body:
+        def __init__(self, data):
+            self.data = data
+
+        def iter_chunks(self, chunk_size):
+            for start in range(0, len(self.data), chunk_size):
+                yield self.data[start:start + chunk_size]
+
+        def close(self):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, ContentType, CacheControl):
+        self.objects[(Bucket, Key)] = (Body, ContentType)
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey()
+        data = self.objects[(Bucket, Key)][0]
+        return {"Body": self.Body(data), "ContentLength": len(data)}
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete["Objects"]:
+            self.objects.pop((Bucket, obj["Key"]), None)
+
+
+def test_s3_storage(test_client):
+    from app.utils import attachments, storage
+
+    client = FakeS3Client()
+    storage.set_backend(storage.S3Storage("webchat", client=client, prefix="attachments/"))
+    try:
+        test_client.post('/thread/2/send_message', data=dict(
+            message="Stored in S3",
+            image=(png_upload((30, 30, 200)), "s3.png")
+        ), content_type="multipart/form-data")
+        page = test_client.get('/thread/2').data.decode()
+        image_url = re.search(r'href="(/attachments/[0-9a-f]{64}\.webp)"', page).group(1)
+        name = os.path.basename(image_url)
+        expected = [f"attachments/{name.replace('.webp', suffix)}" for suffix in [".webp", "_320.webp", "_640.webp"]]
+        assert sorted(key for _, key in client.objects) == sorted(expected)
+        assert client.objects[("webchat", f"attachments/{name}")][1] == "image/webp"
+
+        response = test_client.get(image_url)
+        assert response.status_code == 200
+        assert response.data == client.objects[("webchat", f"attachments/{name}")][0]
+        assert response.headers["Cache-Control"] == "public, max-age=31536000, immutable"
+        assert test_client.get(image_url.replace(name, "0" * 64 + ".webp")).status_code == 404
+
+        storage.set_backend(storage.S3Storage(
+            "webchat",
+            client=client,
+            prefix="attachments/",
+            public_url="https://cdn.example.com/"
+        ))
+        response = test_client.get(image_url)
+        assert response.status_code == 301
+        assert response.headers["Location"] == f"https://cdn.example.com/attachments/{name}"
+
+        message_id = re.findall(r'id="message-(\d+)"', page)[-1]
+        test_client.post(f'/delete_message/{message_id}/2')
+        assert attachments.sweep(grace_seconds=0)[0] == 1
+        assert not client.objects
+    finally:
+        storage.set_backend(None)
+
+
+def test_delete_area_orphans_attachments(test_client, local_storage):
+    from app.utils import attachments
+
+    logout(test_client)
+    login(test_client, "admin", os.getenv("ADMIN_PASSWORD"))
+    test_client.post('/create_area', data={"topic": "Doomed Area"}, follow_redirects=True)
+    test_client.post('/area/4/create_thread', data={"title": "Doomed Thread", "message": "First"}, follow_redirects=True)
+    thread_id = test_client.get('/api/areas/4/threads').get_json()["threads"][0]["id"]
+    for _ in range(2):
+        test_client.post(f'/thread/{thread_id}/send_message', data=dict(
+            message="Doomed image",
+            image=(png_upload((90, 90, 90)), "doomed.png")
+        ), content_type="multipart/form-data")
+    assert len(os.listdir(local_storage)) == 3
+
+    # Deleting the area only marks its attachments orphaned; the sweeper reclaims the files.
+    test_client.post('/delete_area/4', follow_redirects=True)
+    assert len(os.listdir(local_storage)) == 3
+    deleted, reclaimed = attachments.sweep(grace_seconds=0)
+    assert deleted == 1 and reclaimed > 0
+    assert not os.listdir(local_storage)
+
+    logout(test_client)
+    login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG")
+
+
+def test_password_pool(test_client, monkeypatch):
+    from sqlalchemy import text
+    from app.utils import passwords
+    from app.utils.db import Database
+
+    def stored_hash():
+        return Database().fetch_one(text("SELECT password FROM users WHERE username = 'testuser1'"))["password"].tobytes()
+
+    # A changed bcrypt cost is applied to the stored hash on the next login.
+    monkeypatch.setenv("BCRYPT_ROUNDS", "4")
+    logout(test_client)
+    response = login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG")
+    assert b"Logout" in response.data
+    assert stored_hash().startswith(b"$2b$04$")
+
+    # A saturated pool fails fast with a clear error instead of tying up the request thread.
+    pool = passwords.WorkerPool(workers=1, queue_timeout=0)
+    passwords.set_pool(pool)
+    try:
+        assert pool.run(passwords.needs_rehash, stored_hash()) is False
+        for _ in range(2):
+            pool._slots.acquire()
+        logout(test_client)
+        response = login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG")
+        assert b"The server is busy" in response.data
+        assert b"Logout" not in response.data
+        for _ in range(2):
+            pool._slots.release()
+        assert b"Logout" in login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG").data
+    finally:
+        passwords.set_pool(None)
+
+
+def test_rate_limits(test_client):
+    from app.utils import ratelimit
+
+    # The shared backend allows a burst of the limit, then rejects without a query until a token is due.
+    backend = ratelimit.PostgresBackend()
+    assert [backend.hit("test:ip:127.0.0.1", 3, 3 / 60) for _ in range(3)] == [0, 0, 0]
+    retry_after = backend.hit("test:ip:127.0.0.1", 3, 3 / 60)
+    assert 0 < retry_after <= 20
+    assert 0 < ratelimit.PostgresBackend().hit("test:ip:127.0.0.1", 3, 3 / 60) <= 20
+    assert ratelimit.PostgresBackend().hit("test:ip:127.0.0.2", 3, 3 / 60) == 0
+
+    memory = ratelimit.MemoryBackend()
+    assert [memory.hit("test", 2, 1) for _ in range(2)] == [0, 0]
+    assert 0 < memory.hit("test", 2, 1) <= 1
+
+    ratelimit.set_backend(ratelimit.MemoryBackend())
+    try:
+        for _ in range(20):
+            assert test_client.post('/login', data={"username": "Nobody", "password": "wrong"}).status_code == 200
+        response = test_client.post('/login', data={"username": "nobody", "password": "wrong"})
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+        assert 'desc="0 queries"' in response.headers["Server-Timing"]
+
+        # Other usernames, and viewing the login page, are not affected.
+        assert test_client.post('/login', data={"username": "somebody", "password": "wrong"}).status_code == 200
+        assert test_client.get('/login').status_code == 200
+    finally:
+        ratelimit.set_backend(None)
+
+
+@pytest.fixture
+def turnstile_stub(monkeypatch):
+    import json
+    import threading
+    import time
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs
+    from app.utils import turnstile
+
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+            token = form["response"][0]
+            received.append(token)
+            if token == "slow":
+                time.sleep(0.5)
+            body = json.dumps({"success": token.startswith("good")}).encode()
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up waiting.
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("USE_TURNSTILE", "True")
+    monkeypatch.setenv("TURNSTILE_VERIFY_URL", f"http://127.0.0.1:{server.server_port}/siteverify")
+    monkeypatch.setenv("TURNSTILE_READ_TIMEOUT", "0.2")
+    turnstile.verified_tokens.clear()
+    yield received
+    server.shutdown()
+    server.server_close()
+    turnstile.verified_tokens.clear()
+
+
+def test_turnstile_verification(test_client, turnstile_stub, monkeypatch):
+    from app.utils import turnstile
+
+    # A verified token is accepted again without asking the verifier, but only from the same
+    # client for the same form.
+    assert turnstile.verify("good-token", "127.0.0.1", "auth.login")
+    assert turnstile.verify("good-token", "127.0.0.1", "auth.login")
+    assert turnstile_stub == ["good-token"]
+    assert turnstile.verify("good-token", "10.0.0.1", "auth.login")
+    assert turnstile.verify("good-token", "127.0.0.1", "auth.register")
+    assert turnstile_stub == ["good-token"] * 3
+    assert not turnstile.verify("bad-token")
+    assert not turnstile.verify("")
+    response = test_client.post('/login', data={
+        "username": "testuser1",
+        "password": "wrong",
+        "cf-turnstile-response": "bad-token"
+    }, follow_redirects=True)
+    assert b"CAPTCHA verification failed" in response.data
+
+    # A slow verifier is cut off by the read timeout, and the failure policy decides.
+    started = time.monotonic()
+    assert not turnstile.verify("slow")
+    assert time.monotonic() - started < 0.45
+    monkeypatch.setenv("TURNSTILE_FAIL_MODE", "open")
+    assert turnstile.verify("slow")
+    monkeypatch.setenv("TURNSTILE_VERIFY_URL", "http://127.0.0.1:9/siteverify")
+    assert turnstile.verify("good-unreachable")
+    monkeypatch.setenv("TURNSTILE_FAIL_MODE", "closed")
+    assert not turnstile.verify("good-unreachable")
+
+
+def test_area_access_cache(test_client):
+    from sqlalchemy import text
+    from app.utils import access
+    from app.utils import live
+    from app.utils.db import Database
+
+    user_id = Database().fetch_one(text("SELECT id FROM users WHERE username = 'testuser1'"))["id"]
+    access.visible_areas(user_id)
+    deadline = time.monotonic() + 5
+    while not live.broker.connected and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    # The visible areas are loaded once and then served from the cache.
+    visible = access.visible_areas(user_id)
+    assert 3 not in visible and not visible.is_admin
+    assert access.visible_areas(user_id) is visible
+
+    # Granting and revoking access applies to the user's next request.
+    logout(test_client)
+    login(test_client, "admin", os.getenv("ADMIN_PASSWORD"))
+    test_client.post('/manage_area_access', data=dict(
+        username="testuser1",
+        area_id="3",
+        action="add"
+    ), follow_redirects=True)
+    assert 3 in access.visible_areas(user_id)
+    logout(test_client)
+    login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG")
+    assert test_client.get('/api/areas/3/threads').status_code == 200
+
+    logout(test_client)
+    login(test_client, "admin", os.getenv("ADMIN_PASSWORD"))
+    test_client.post('/manage_area_access', data=dict(
+        username="testuser1",
+        area_id="3",
+        action="remove"
+    ), follow_redirects=True)
+    logout(test_client)
+    login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG")
+    assert test_client.get('/api/areas/3/threads').status_code == 404
+
+    # Invalidations announced by other processes arrive through the notification listener.
+    visible = access.visible_areas(user_id)
+    Database().execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": access.CHANNEL, "payload": str(user_id)})
+    deadline = time.monotonic() + 5
+    while access.visible_areas(user_id) is visible and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert access.visible_areas(user_id) is not visible
+    access.cache.handle_notification("*")
+    assert len(access.cache) == 0
+
+
+def test_slotted_models(test_client):
+    from app.models.area import Area
+    from app.models.thread import Thread
+
+    thread = Thread.create_from_db(2).load_messages(limit=5)
+    assert len(thread.messages) == 5
+    message = thread.messages[-1]
+    assert message.thread == 2 and message.thread_title == thread.title and message.sender_name
+    assert not hasattr(message, "__dict__") and not hasattr(thread, "__dict__")
+
+    user_id = test_client.get('/api/threads/2/messages?limit=1').get_json()["messages"][0]["sender"]
+    area = Area.create_from_db(2, user_id).load_threads(limit=1)
+    assert area.threads[0].area_name == area.topic and area.threads[0].message_count > 0
+
+
+def test_streamed_pages(test_client):
+    # Users get the paged thread, admins can stream the whole thread on one page.
+    assert b"Paging message 0<" not in test_client.get('/thread/2?all=1').data
+
+    logout(test_client)
+    login(test_client, "admin", os.getenv("ADMIN_PASSWORD"))
+    response = test_client.get('/thread/2')
+    assert b"Whole thread" in response.data
+    response = test_client.get('/thread/2?all=1')
+    assert response.is_streamed
+    assert b"Paging message 0<" in response.data and b"Paging message 59<" in response.data
+    assert b"Older messages" not in response.data
+
+    # The whole search result is streamed without counting or pages.
+    response = test_client.get('/search?query=paging')
+    assert b"All results" in response.data
+    response = test_client.get('/search?query=paging&all=1')
+    assert response.is_streamed
+    data = response.data.replace(b"<mark>", b"").replace(b"</mark>", b"")
+    assert data.count(b'class="result-box"') > 60
+    assert b"Paging message 0<" in data and b"Next page" not in data
+
+    logout(test_client)
+    login(test_client, "testuser1", "VBt8fETYzn$64ecARjmG")
+
+
+def test_search_pages_past_count_limit(test_client, monkeypatch):
+    from app.utils import search
+
+    # The capped count is only shown; pages beyond it can still be reached.
+    monkeypatch.setattr(search, "COUNT_LIMIT", 10)
+    monkeypatch.setattr(search, "RESULTS_PER_PAGE", 5)
+    user_id = test_client.get('/api/threads/2/messages?limit=1').get_json()["messages"][0]["sender"]
+    results = search.search_messages("paging", user_id, page=5)
+    assert results.total == 10 and results.is_estimate
+    assert len(results) == 5 and results.has_next
+    last_page = search.search_messages("paging", user_id, page=12)
+    assert len(last_page) == 5 and not last_page.has_next
+    assert len(search.search_messages("paging", user_id, page=13)) == 0